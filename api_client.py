@@ -0,0 +1,141 @@
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from resilience import CircuitBreaker, RetryPolicy
+
+MOLTIN_API_URL = 'https://api.moltin.com'
+YANDEX_GEOCODER_URL = 'https://geocode-maps.yandex.ru'
+
+# carts sit on the path of every button press, files are large
+MOLTIN_ENDPOINT_TIMEOUTS = {
+    '/v2/carts': (3.05, 5),
+    '/v2/files': (3.05, 20),
+}
+
+
+class ApiClient:
+    '''Keep-alive HTTP client over a pooled :class:`requests.Session`.
+
+    One instance is created per upstream at startup and passed to every
+    api_handler function, so connections (and their TLS handshakes) are
+    reused between calls instead of being opened per request.
+
+    ``endpoint_timeouts`` maps path prefixes to their own timeout.
+    With a ``retry_policy`` idempotent requests are retried after
+    connection errors, timeouts and the policy's statuses. With a
+    ``breaker`` requests to ``base_url`` fail fast while it is open.
+    '''
+
+    def __init__(
+        self,
+        base_url: str = '',
+        headers: dict = None,
+        pool_size: int = 10,
+        timeout=(3.05, 10),
+        keep_alive: bool = True,
+        endpoint_timeouts: dict = None,
+        retry_policy: RetryPolicy = None,
+        breaker: CircuitBreaker = None
+    ):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.endpoint_timeouts = dict(endpoint_timeouts or {})
+        self.retry_policy = retry_policy
+        self.breaker = breaker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+        self.session.headers.update(headers or {})
+        self.token_expires = None
+
+    def set_access_token(self, access_token: str, expires: int = None) -> None:
+        self.session.headers['Authorization'] = f'Bearer {access_token}'
+        self.token_expires = expires
+
+    def build_url(self, path: str) -> str:
+        if path.startswith(('http://', 'https://')):
+            return path
+        return f'{self.base_url}/{path.lstrip("/")}'
+
+    def get_timeout(self, path: str):
+        for prefix, timeout in self.endpoint_timeouts.items():
+            if path.startswith(prefix):
+                return timeout
+        return self.timeout
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.get_timeout(path))
+        url = self.build_url(path)
+        # files on a CDN are not the upstream the breaker watches
+        breaker = self.breaker if url.startswith(self.base_url) else None
+        attempts = self.retry_policy.attempts(method) if self.retry_policy else 1
+        for attempt in range(attempts):
+            if breaker:
+                breaker.before_call()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if breaker:
+                    breaker.record_failure()
+                if attempt + 1 == attempts:
+                    raise
+            except Exception:
+                # a broken answer is a failure too, but not worth retrying
+                if breaker:
+                    breaker.record_failure()
+                raise
+            except BaseException:
+                if breaker:
+                    breaker.release()
+                raise
+            else:
+                if breaker:
+                    if response.status_code >= 500:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                if attempt + 1 == attempts or response.status_code not in self.retry_policy.statuses:
+                    return response
+                response.close()
+            time.sleep(self.retry_policy.delay(attempt))
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path: str, **kwargs) -> requests.Response:
+        return self.request('PUT', path, **kwargs)
+
+    def delete(self, path: str, **kwargs) -> requests.Response:
+        return self.request('DELETE', path, **kwargs)
+
+    def close(self) -> None:
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def create_moltin_client(
+    access_token: str,
+    expires: int = None,
+    base_url: str = MOLTIN_API_URL,
+    **kwargs
+) -> ApiClient:
+    kwargs.setdefault('endpoint_timeouts', MOLTIN_ENDPOINT_TIMEOUTS)
+    client = ApiClient(base_url, **kwargs)
+    client.set_access_token(access_token, expires)
+    return client
+
+
+def create_geocoder_client(base_url: str = YANDEX_GEOCODER_URL, **kwargs) -> ApiClient:
+    return ApiClient(base_url, **kwargs)
@@ -1,41 +1,40 @@
-import requests
-import os
-from pathlib import Path
-from googletrans import Translator
+import numpy as np
 from geopy import distance
 
+from api_client import ApiClient
+from metrics import observe_upstream
+from slugs import make_slug
 
-def get_all_products(access_token: str):
-    url = 'https://api.moltin.com/v2/products'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    response = requests.get(url, headers=headers)
+EARTH_RADIUS_KM = 6371.0088
+
+
+@observe_upstream('moltin')
+def get_all_products(client: ApiClient):
+    url = '/v2/products'
+    response = client.get(url)
     response.raise_for_status()
     return response.json()
 
 
-def get_product(product_id: str, access_token: str):
-    url = f'https://api.moltin.com/v2/products/{product_id}'
+@observe_upstream('moltin')
+def get_product(product_id: str, client: ApiClient):
+    url = f'/v2/products/{product_id}'
     headers = {
-        'Authorization': f'Bearer {access_token}',
         'X-MOLTIN-CURRENCY': 'RUB'
     }
-    response = requests.get(url, headers=headers)
+    response = client.get(url, headers=headers)
     response.raise_for_status()
     return response.json()
 
 
+@observe_upstream('moltin')
 def add_product_to_card(
     card_id: str,
     product_id: str,
-    access_token: str,
+    client: ApiClient,
     quantity: int
-) -> None:
-    url = f'https://api.moltin.com/v2/carts/{card_id}/items'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
+):
+    url = f'/v2/carts/{card_id}/items'
     payload = {
         'data': {
             'id': product_id,
@@ -43,68 +42,75 @@ def add_product_to_card(
             'quantity': quantity,
         },
     }
-    response = requests.post(url, headers=headers, json=payload)
+    response = client.post(url, json=payload)
     response.raise_for_status()
+    return response.json()
 
 
-def get_card(card_id: str, access_token: str):
-    url = f'https://api.moltin.com/v2/carts/{card_id}'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
+@observe_upstream('moltin')
+def update_cart_item(card_id: str, cart_item_id: str, quantity: int, client: ApiClient):
+    url = f'/v2/carts/{card_id}/items/{cart_item_id}'
+    payload = {
+        'data': {
+            'type': 'cart_item',
+            'id': cart_item_id,
+            'quantity': quantity,
+        },
     }
-    response = requests.get(url, headers=headers)
+    response = client.put(url, json=payload)
     response.raise_for_status()
     return response.json()
 
 
-def get_card_items(card_id: str, access_token: str):
-    url = f'https://api.moltin.com/v2/carts/{card_id}/items'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    response = requests.get(url, headers=headers)
+@observe_upstream('moltin')
+def get_card(card_id: str, client: ApiClient):
+    url = f'/v2/carts/{card_id}'
+    response = client.get(url)
     response.raise_for_status()
     return response.json()
 
 
-def get_image(image_id: str, access_token: str):
-    url = f'https://api.moltin.com/v2/files/{image_id}'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    response = requests.get(url, headers=headers)
+@observe_upstream('moltin')
+def get_card_items(card_id: str, client: ApiClient):
+    url = f'/v2/carts/{card_id}/items'
+    response = client.get(url)
     response.raise_for_status()
-    file_url = response.json().get('data').get('link').get('href')
-    response = requests.get(file_url)
+    return response.json()
+
+
+@observe_upstream('moltin')
+def get_file_url(file_id: str, client: ApiClient) -> str:
+    url = f'/v2/files/{file_id}'
+    response = client.get(url)
     response.raise_for_status()
-    _, image_name = os.path.split(file_url)
-    path = os.path.join(os.getcwd(), 'store_images')
-    Path(path).mkdir(parents=True, exist_ok=True)
-    named_path = os.path.join(path, image_name)
-    with open(named_path, 'wb') as file:
-        file.write(response.content)
-    return named_path
+    return response.json().get('data').get('link').get('href')
 
 
-def remove_cart_item(card_id: str, product_id: str, access_token: str) -> None:
-    url = f'https://api.moltin.com/v2/carts/{card_id}/items/{product_id}'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    response = requests.delete(url, headers=headers)
+@observe_upstream('cdn')
+def download_file(file_url: str, client: ApiClient, headers: dict = None):
+    '''Response with the file, or a 304 one if it matches the conditional ``headers``.'''
+    # the file is served from a CDN, so the Moltin token must not be sent along
+    response = client.get(file_url, headers={'Authorization': None, **(headers or {})})
+    if response.status_code != 304:
+        response.raise_for_status()
+    return response
+
+
+@observe_upstream('moltin')
+def remove_cart_item(card_id: str, product_id: str, client: ApiClient) -> None:
+    url = f'/v2/carts/{card_id}/items/{product_id}'
+    response = client.delete(url)
     response.raise_for_status()
 
 
+@observe_upstream('moltin')
 def create_customer(
     phone: str,
     email: str,
     password: str,
-    access_token: str
+    client: ApiClient
 ) -> None:
-    url = 'https://api.moltin.com/v2/customers'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
+    url = '/v2/customers'
     payload = {
         'data': {
             'type': 'customer',
@@ -113,34 +119,28 @@ def create_customer(
             'password': password,
         },
     }
-    response = requests.post(url, headers=headers, json=payload)
+    response = client.post(url, json=payload)
     response.raise_for_status()
 
 
-def make_slug(product_name):
-    translator = Translator()
-    translated_text = translator.translate(product_name, src='ru').text
-    chunked_text = translated_text.split(' ')
-    slug_text = '-'.join(chunked_text).lower()
-    return slug_text
+def make_product_description(product):
+    return f"{product['description']}, содержание: жиры {product['food_value']['fats']}г,\
+белки {product['food_value']['proteins']}г, углеводы {product['food_value']['carbohydrates']}г,\
+каллорийность {product['food_value']['kiloCalories']} ккал, вес {product['food_value']['weight']}г"
 
 
-def create_product(product, access_token):
-    url = 'https://api.moltin.com/v2/products'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        }
+@observe_upstream('moltin')
+def create_product(product, client, slug=None):
+    url = '/v2/products'
     product_id = product['id']
     product_name = product['name']
-    product_description = f"{product['description']}, содержание: жиры {product['food_value']['fats']}г,\
-белки {product['food_value']['proteins']}г, углеводы {product['food_value']['carbohydrates']}г,\
-каллорийность {product['food_value']['kiloCalories']} ккал, вес {product['food_value']['weight']}г"
+    product_description = make_product_description(product)
     product_price = product['price']
     payload = {
         'data': {
             'type': 'product',
             'name': product_name,
-            'slug': make_slug(product_name),
+            'slug': slug or make_slug(product_name),
             'sku': str(product_id),
             'manage_stock': False,
             'description': product_description,
@@ -155,51 +155,80 @@ def create_product(product, access_token):
             'commodity_type': 'physical'
             },
         }
-    response = requests.post(url, headers=headers, json=payload)
+    response = client.post(url, json=payload)
     response.raise_for_status()
     return response.json()
 
 
-def create_file(product, access_token):
-    '''file creation'''
-    url = 'https://api.moltin.com/v2/files'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
+@observe_upstream('moltin')
+def update_product(product_id, product, client):
+    url = f'/v2/products/{product_id}'
+    payload = {
+        'data': {
+            'type': 'product',
+            'id': product_id,
+            'name': product['name'],
+            'description': make_product_description(product),
+            'price': [
+                {
+                    'amount': product['price'],
+                    'currency': 'RUB',
+                    'includes_tax': True,
+                    }
+                ],
+            },
         }
+    response = client.put(url, json=payload)
+    response.raise_for_status()
+    return response.json()
+
+
+@observe_upstream('moltin')
+def delete_product(product_id, client):
+    response = client.delete(f'/v2/products/{product_id}')
+    response.raise_for_status()
+
+
+@observe_upstream('moltin')
+def create_file(product, client):
+    '''file creation'''
+    url = '/v2/files'
 
     files = {
             'file_location': (None, product['product_image']['url']),
         }
-    response = requests.post(url, headers=headers, files=files)
+    response = client.post(url, files=files)
     response.raise_for_status()
     return response.json()
 
 
-def link_main_image(product_id, image_id, access_token):
-    url = f'https://api.moltin.com/v2/products/{product_id}/relationships/main-image'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-        }
+@observe_upstream('moltin')
+def delete_file(file_id, client):
+    response = client.delete(f'/v2/files/{file_id}')
+    response.raise_for_status()
+
+
+@observe_upstream('moltin')
+def link_main_image(product_id, image_id, client):
+    url = f'/v2/products/{product_id}/relationships/main-image'
     payload = {
         'data': {
             'type': 'main_image',
             'id': image_id
             },
         }
-    response = requests.post(url, headers=headers, json=payload)
+    response = client.post(url, json=payload)
     response.raise_for_status()
 
 
+@observe_upstream('moltin')
 def create_flow(
     name,
     description,
-    access_token,
+    client,
     enabled=True
         ):
-    url = 'https://api.moltin.com/v2/flows'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-        }
+    url = '/v2/flows'
     payload = {
         'data': {
             'type': 'flow',
@@ -209,24 +238,22 @@ def create_flow(
             'enabled': enabled
             }
         }
-    response = requests.post(url, headers=headers, json=payload)
+    response = client.post(url, json=payload)
     response.raise_for_status()
     return response.json()
 
 
+@observe_upstream('moltin')
 def create_flows_field(
     flow_id,
     field_name,
     field_type,
     description,
-    access_token,
+    client,
     required=True,
     enabled=True,
         ):
-    url = 'https://api.moltin.com/v2/fields'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-        }
+    url = '/v2/fields'
     payload = {
         'data': {
             'type': 'field',
@@ -246,11 +273,12 @@ def create_flows_field(
             }
         }
     }
-    response = requests.post(url, headers=headers, json=payload)
+    response = client.post(url, json=payload)
     response.raise_for_status()
     return response.json()
 
 
+@observe_upstream('moltin')
 def create_entry(
     flow_slug,
     address_slug,
@@ -261,12 +289,9 @@ def create_entry(
     lat_value,
     lon_slug,
     lon_value,
-    access_token
+    client
         ):
-    url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-        }
+    url = f'/v2/flows/{flow_slug}/entries'
     payload = {
         'data': {
             'type': 'entry',
@@ -276,13 +301,14 @@ def create_entry(
             f'{lon_slug}': f'{lon_value}'
         }
     }
-    response = requests.post(url, headers=headers, json=payload)
+    response = client.post(url, json=payload)
     response.raise_for_status()
 
 
-def fetch_coordinates(apikey, address):
-    base_url = "https://geocode-maps.yandex.ru/1.x"
-    response = requests.get(base_url, params={
+@observe_upstream('geocoder')
+def fetch_coordinates(apikey, address, client):
+    url = "/1.x"
+    response = client.get(url, params={
         "geocode": address,
         "apikey": apikey,
         "format": "json",
@@ -296,33 +322,83 @@ def fetch_coordinates(apikey, address):
 
 
 def get_distance(coordinates, restaurant_coordinates):
+    '''Geodesic distance in km between two ``(lon, lat)`` points.'''
     lon, lat = coordinates
     restaurant_lon, restaurant_lat = restaurant_coordinates
     if lon and lat and restaurant_lon and restaurant_lat is not None:
-        return distance.distance(coordinates, restaurant_coordinates).km
+        # geopy expects (lat, lon)
+        return distance.distance((lat, lon), (restaurant_lat, restaurant_lon)).km
+
+
+def parse_coordinates(restaurant_coordinates) -> np.ndarray:
+    '''Turns ``(lon, lat)`` string pairs from Moltin entries into an ``(n, 2)`` float array.'''
+    return np.asarray(restaurant_coordinates, dtype=float).reshape(-1, 2)
+
+
+def get_distances(coordinates, restaurant_points: np.ndarray) -> np.ndarray:
+    '''Distances in km from one ``(lon, lat)`` point to every row of ``restaurant_points``.
+
+    Haversine on a sphere of the mean earth radius, in one vectorized pass.
+    Against geopy's WGS-84 geodesic (:func:`get_distance`) the relative
+    error never exceeds 0.56% and stays under 0.35% at Moscow latitudes,
+    i.e. below 2 m on the 0.5 km delivery threshold.
+    '''
+    lon, lat = np.radians(np.asarray(coordinates, dtype=float))
+    restaurant_lons = np.radians(restaurant_points[:, 0])
+    restaurant_lats = np.radians(restaurant_points[:, 1])
+    haversine = (
+        np.sin((restaurant_lats - lat) / 2) ** 2
+        + np.cos(lat) * np.cos(restaurant_lats) * np.sin((restaurant_lons - lon) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(haversine, 0, 1)))
+
+
+@observe_upstream('moltin')
+def get_all_pages(url, client, limit=100):
+    '''Returns the ``data`` of every page of a paginated Moltin listing.'''
+    items = []
+    params = {'page[limit]': limit}
+    while url:
+        response = client.get(url, params=params)
+        response.raise_for_status()
+        page = response.json()
+        items.extend(page['data'])
+        # the next link already carries the paging parameters
+        url, params = (page.get('links') or {}).get('next'), None
+    return items
+
+
+@observe_upstream('moltin')
+def get_flows(client):
+    response = client.get('/v2/flows')
+    response.raise_for_status()
+    return response.json()
 
 
-def get_all_entries(access_token, flow_slug):
-    url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-        }
-    response = requests.get(url, headers=headers)
+@observe_upstream('moltin')
+def get_flow_fields(flow_id, client):
+    response = client.get(f'/v2/flows/{flow_id}/fields')
     response.raise_for_status()
     return response.json()
 
 
+@observe_upstream('moltin')
+def get_all_entries(client, flow_slug):
+    url = f'/v2/flows/{flow_slug}/entries'
+    response = client.get(url)
+    response.raise_for_status()
+    return response.json()
+
+
+@observe_upstream('moltin')
 def create_entry_customer(
     lat_slug,
     lat_value,
     lon_slug,
     lon_value,
-    access_token
+    client
         ):
-    url = 'https://api.moltin.com/v2/flows/customer_address/entries'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-        }
+    url = '/v2/flows/customer_address/entries'
     payload = {
         'data': {
             'type': 'entry',
@@ -330,5 +406,5 @@ def create_entry_customer(
             f'{lon_slug}': f'{lon_value}'
         }
     }
-    response = requests.post(url, headers=headers, json=payload)
+    response = client.post(url, json=payload)
     response.raise_for_status()
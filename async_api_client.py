@@ -0,0 +1,141 @@
+import asyncio
+import threading
+
+import aiohttp
+
+from api_client import MOLTIN_API_URL, YANDEX_GEOCODER_URL
+from resilience import CircuitBreaker, RetryPolicy
+
+
+class AsyncApiClient:
+    '''aiohttp counterpart of :class:`api_client.ApiClient`.
+
+    The session lives on an event loop in a daemon thread, so the threaded
+    dispatcher handlers can run coroutines from :mod:`async_api_handler`
+    with :meth:`run` or several of them concurrently with :meth:`gather`.
+    ``limit`` caps open connections, ``timeout`` is the total time in
+    seconds allowed for one request. ``retry_policy`` and ``breaker`` work
+    as in :class:`api_client.ApiClient` and may be shared with it.
+    '''
+
+    def __init__(
+        self,
+        base_url: str = '',
+        headers: dict = None,
+        limit: int = 10,
+        timeout: float = 10,
+        retry_policy: RetryPolicy = None,
+        breaker: CircuitBreaker = None
+    ):
+        self.base_url = base_url.rstrip('/')
+        self.headers = dict(headers or {})
+        self.limit = limit
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retry_policy = retry_policy
+        self.breaker = breaker
+        self.token_expires = None
+        self.loop = None
+        self.session = None
+
+    def start(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.run(self._open_session())
+
+    async def _open_session(self) -> None:
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.limit),
+            timeout=self.timeout
+        )
+
+    def close(self) -> None:
+        self.run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def run(self, coroutine):
+        '''Runs a coroutine on the client loop and waits for its result.'''
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def gather(self, *coroutines):
+        '''Runs coroutines concurrently, results come back in the same order.'''
+        async def gather_all():
+            return await asyncio.gather(*coroutines)
+        return self.run(gather_all())
+
+    def set_access_token(self, access_token: str, expires: int = None) -> None:
+        self.headers['Authorization'] = f'Bearer {access_token}'
+        self.token_expires = expires
+
+    def build_url(self, path: str) -> str:
+        if path.startswith(('http://', 'https://')):
+            return path
+        return f'{self.base_url}/{path.lstrip("/")}'
+
+    async def request(self, method: str, path: str, headers: dict = None, **kwargs) -> aiohttp.ClientResponse:
+        '''Returns the response with its body already read, so it outlives the connection.'''
+        merged_headers = {
+            name: value for name, value in {**self.headers, **(headers or {})}.items()
+            if value is not None
+        }
+        url = self.build_url(path)
+        breaker = self.breaker if url.startswith(self.base_url) else None
+        attempts = self.retry_policy.attempts(method) if self.retry_policy else 1
+        for attempt in range(attempts):
+            if breaker:
+                breaker.before_call()
+            try:
+                async with self.session.request(method, url, headers=merged_headers, **kwargs) as response:
+                    await response.read()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if breaker:
+                    breaker.record_failure()
+                if attempt + 1 == attempts:
+                    raise
+            except Exception:
+                if breaker:
+                    breaker.record_failure()
+                raise
+            except BaseException:
+                # cancelled by the caller, the upstream may be fine
+                if breaker:
+                    breaker.release()
+                raise
+            else:
+                if breaker:
+                    if response.status >= 500:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                if attempt + 1 == attempts or response.status not in self.retry_policy.statuses:
+                    return response
+            await asyncio.sleep(self.retry_policy.delay(attempt))
+
+    async def get(self, path: str, **kwargs) -> aiohttp.ClientResponse:
+        return await self.request('GET', path, **kwargs)
+
+    async def post(self, path: str, **kwargs) -> aiohttp.ClientResponse:
+        return await self.request('POST', path, **kwargs)
+
+    async def put(self, path: str, **kwargs) -> aiohttp.ClientResponse:
+        return await self.request('PUT', path, **kwargs)
+
+    async def delete(self, path: str, **kwargs) -> aiohttp.ClientResponse:
+        return await self.request('DELETE', path, **kwargs)
+
+
+def create_async_moltin_client(
+    access_token: str,
+    expires: int = None,
+    base_url: str = MOLTIN_API_URL,
+    **kwargs
+) -> AsyncApiClient:
+    client = AsyncApiClient(base_url, **kwargs)
+    client.set_access_token(access_token, expires)
+    client.start()
+    return client
+
+
+def create_async_geocoder_client(base_url: str = YANDEX_GEOCODER_URL, **kwargs) -> AsyncApiClient:
+    client = AsyncApiClient(base_url, **kwargs)
+    client.start()
+    return client
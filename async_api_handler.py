@@ -0,0 +1,315 @@
+'''asyncio twin of :mod:`api_handler` with the same functions and arguments.
+
+Every function is a coroutine taking an :class:`AsyncApiClient`, so
+independent calls can run concurrently::
+
+    cart, cart_items = await asyncio.gather(
+        get_card(chat_id, client),
+        get_card_items(chat_id, client),
+    )
+'''
+import aiohttp
+
+from api_handler import make_product_description
+from async_api_client import AsyncApiClient
+from metrics import observe_upstream
+from slugs import make_slug
+
+
+@observe_upstream('moltin')
+async def get_all_products(client: AsyncApiClient):
+    url = '/v2/products'
+    response = await client.get(url)
+    response.raise_for_status()
+    return await response.json()
+
+
+@observe_upstream('moltin')
+async def get_product(product_id: str, client: AsyncApiClient):
+    url = f'/v2/products/{product_id}'
+    headers = {
+        'X-MOLTIN-CURRENCY': 'RUB'
+    }
+    response = await client.get(url, headers=headers)
+    response.raise_for_status()
+    return await response.json()
+
+
+@observe_upstream('moltin')
+async def add_product_to_card(
+    card_id: str,
+    product_id: str,
+    client: AsyncApiClient,
+    quantity: int
+):
+    url = f'/v2/carts/{card_id}/items'
+    payload = {
+        'data': {
+            'id': product_id,
+            'type': 'cart_item',
+            'quantity': quantity,
+        },
+    }
+    response = await client.post(url, json=payload)
+    response.raise_for_status()
+    return await response.json()
+
+
+@observe_upstream('moltin')
+async def update_cart_item(card_id: str, cart_item_id: str, quantity: int, client: AsyncApiClient):
+    url = f'/v2/carts/{card_id}/items/{cart_item_id}'
+    payload = {
+        'data': {
+            'type': 'cart_item',
+            'id': cart_item_id,
+            'quantity': quantity,
+        },
+    }
+    response = await client.put(url, json=payload)
+    response.raise_for_status()
+    return await response.json()
+
+
+@observe_upstream('moltin')
+async def get_card(card_id: str, client: AsyncApiClient):
+    url = f'/v2/carts/{card_id}'
+    response = await client.get(url)
+    response.raise_for_status()
+    return await response.json()
+
+
+@observe_upstream('moltin')
+async def get_card_items(card_id: str, client: AsyncApiClient):
+    url = f'/v2/carts/{card_id}/items'
+    response = await client.get(url)
+    response.raise_for_status()
+    return await response.json()
+
+
+@observe_upstream('moltin')
+async def get_file_url(file_id: str, client: AsyncApiClient) -> str:
+    url = f'/v2/files/{file_id}'
+    response = await client.get(url)
+    response.raise_for_status()
+    return (await response.json()).get('data').get('link').get('href')
+
+
+@observe_upstream('cdn')
+async def download_file(file_url: str, client: AsyncApiClient, headers: dict = None):
+    '''Response with the file, or a 304 one if it matches the conditional ``headers``.'''
+    # the file is served from a CDN, so the Moltin token must not be sent along
+    response = await client.get(file_url, headers={'Authorization': None, **(headers or {})})
+    if response.status != 304:
+        response.raise_for_status()
+    return response
+
+
+@observe_upstream('moltin')
+async def remove_cart_item(card_id: str, product_id: str, client: AsyncApiClient) -> None:
+    url = f'/v2/carts/{card_id}/items/{product_id}'
+    response = await client.delete(url)
+    response.raise_for_status()
+
+
+@observe_upstream('moltin')
+async def create_customer(
+    phone: str,
+    email: str,
+    password: str,
+    client: AsyncApiClient
+) -> None:
+    url = '/v2/customers'
+    payload = {
+        'data': {
+            'type': 'customer',
+            'name': phone,
+            'email': email,
+            'password': password,
+        },
+    }
+    response = await client.post(url, json=payload)
+    response.raise_for_status()
+
+
+@observe_upstream('moltin')
+async def create_product(product, client, slug=None):
+    url = '/v2/products'
+    product_id = product['id']
+    product_name = product['name']
+    product_description = make_product_description(product)
+    product_price = product['price']
+    payload = {
+        'data': {
+            'type': 'product',
+            'name': product_name,
+            'slug': slug or make_slug(product_name),
+            'sku': str(product_id),
+            'manage_stock': False,
+            'description': product_description,
+            'price': [
+                {
+                    'amount': product_price,
+                    'currency': 'RUB',
+                    'includes_tax': True,
+                    }
+                ],
+            'status': 'live',
+            'commodity_type': 'physical'
+            },
+        }
+    response = await client.post(url, json=payload)
+    response.raise_for_status()
+    return await response.json()
+
+
+@observe_upstream('moltin')
+async def create_file(product, client):
+    '''file creation'''
+    url = '/v2/files'
+
+    files = aiohttp.FormData()
+    files.add_field('file_location', product['product_image']['url'])
+    response = await client.post(url, data=files)
+    response.raise_for_status()
+    return await response.json()
+
+
+@observe_upstream('moltin')
+async def link_main_image(product_id, image_id, client):
+    url = f'/v2/products/{product_id}/relationships/main-image'
+    payload = {
+        'data': {
+            'type': 'main_image',
+            'id': image_id
+            },
+        }
+    response = await client.post(url, json=payload)
+    response.raise_for_status()
+
+
+@observe_upstream('moltin')
+async def create_flow(
+    name,
+    description,
+    client,
+    enabled=True
+        ):
+    url = '/v2/flows'
+    payload = {
+        'data': {
+            'type': 'flow',
+            'name': name,
+            'slug': name.lower(),
+            'description': description,
+            'enabled': enabled
+            }
+        }
+    response = await client.post(url, json=payload)
+    response.raise_for_status()
+    return await response.json()
+
+
+@observe_upstream('moltin')
+async def create_flows_field(
+    flow_id,
+    field_name,
+    field_type,
+    description,
+    client,
+    required=True,
+    enabled=True,
+        ):
+    url = '/v2/fields'
+    payload = {
+        'data': {
+            'type': 'field',
+            'name': field_name,
+            'slug': field_name.lower(),
+            'field_type': field_type,
+            'description': description,
+            'required': required,
+            'enabled': enabled,
+            'relationships': {
+                'flow': {
+                    'data': {
+                        'type': 'flow',
+                        'id': flow_id
+                    }
+                }
+            }
+        }
+    }
+    response = await client.post(url, json=payload)
+    response.raise_for_status()
+    return await response.json()
+
+
+@observe_upstream('moltin')
+async def create_entry(
+    flow_slug,
+    address_slug,
+    address_value,
+    alias_slug,
+    alias_value,
+    lat_slug,
+    lat_value,
+    lon_slug,
+    lon_value,
+    client
+        ):
+    url = f'/v2/flows/{flow_slug}/entries'
+    payload = {
+        'data': {
+            'type': 'entry',
+            f'{address_slug}': f'{address_value}',
+            f'{alias_slug}': f'{alias_value}',
+            f'{lat_slug}': f'{lat_value}',
+            f'{lon_slug}': f'{lon_value}'
+        }
+    }
+    response = await client.post(url, json=payload)
+    response.raise_for_status()
+
+
+@observe_upstream('geocoder')
+async def fetch_coordinates(apikey, address, client):
+    url = "/1.x"
+    response = await client.get(url, params={
+        "geocode": address,
+        "apikey": apikey,
+        "format": "json",
+    })
+    response.raise_for_status()
+    found_places = (await response.json())['response']['GeoObjectCollection']['featureMember']
+    if not found_places:
+        return None
+    most_relevant = found_places[0]
+    return most_relevant
+
+
+@observe_upstream('moltin')
+async def get_all_entries(client, flow_slug):
+    url = f'/v2/flows/{flow_slug}/entries'
+    response = await client.get(url)
+    response.raise_for_status()
+    return await response.json()
+
+
+@observe_upstream('moltin')
+async def create_entry_customer(
+    lat_slug,
+    lat_value,
+    lon_slug,
+    lon_value,
+    client
+        ):
+    url = '/v2/flows/customer_address/entries'
+    payload = {
+        'data': {
+            'type': 'entry',
+            f'{lat_slug}': f'{lat_value}',
+            f'{lon_slug}': f'{lon_value}'
+        }
+    }
+    response = await client.post(url, json=payload)
+    response.raise_for_status()
@@ -0,0 +1,46 @@
+'''One geopy call per pizzeria vs the vectorized get_distances, speed and accuracy.
+
+Run from the repository root, no network needed:
+
+    python -m benchmarks.bench_distances --locations 1000
+'''
+import argparse
+import random
+import time
+
+from api_handler import get_distance, get_distances, parse_coordinates
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--locations', type=int, default=1000)
+    args = parser.parse_args()
+    rng = random.Random(42)
+    restaurant_coordinates = [
+        (f'{rng.uniform(36.8, 38.4):.6f}', f'{rng.uniform(55.1, 56.3):.6f}')
+        for _ in range(args.locations)
+    ]
+    user_coordinates = ('37.617300', '55.755800')
+
+    started = time.perf_counter()
+    geodesic = [get_distance(user_coordinates, restaurant) for restaurant in restaurant_coordinates]
+    geopy_ms = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    points = parse_coordinates(restaurant_coordinates)
+    parse_ms = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    haversine = get_distances(user_coordinates, points)
+    vectorized_ms = (time.perf_counter() - started) * 1000
+
+    max_error = max(
+        abs(approximate - exact) / exact
+        for approximate, exact in zip(haversine, geodesic) if exact
+    )
+    print(f'geopy loop   {geopy_ms:9.3f} ms for {args.locations} points')
+    print(f'vectorized   {vectorized_ms:9.3f} ms (+{parse_ms:.3f} ms one-off parsing)')
+    print(f'max relative error vs geopy {max_error:.4%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+'''Throughput and per-state latency of the whole bot against local stand-ins.
+
+Synthetic users go through the full conversation, start → menu →
+description → add → cart → pay → geo → delivery → invoice, as Telegram
+updates fed to the bot's real dispatcher. Elastic Path, the geocoder and
+the Telegram Bot API are replaced by the servers of
+:mod:`benchmarks.standins`, with the given latency and error rate.
+Latency of a step is the time from putting its update into the update
+queue until all handlers finished with it.
+
+Run from the repository root with a Redis reachable through REDIS_HOST,
+REDIS_PORT and REDIS_PASS (defaults to localhost). The bot state goes to
+the Redis database --redis-db (default 15), which is emptied first:
+
+    python -m benchmarks.bench_end_to_end --users 50 --rounds 4 --latency-ms 40
+'''
+import argparse
+import logging
+import os
+import statistics
+import threading
+import time
+from collections import defaultdict
+from queue import Queue
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+import telegram_bot
+from benchmarks.standins import start_standins
+
+BENCHMARK_TOKEN = '123456:endtoend'
+STEPS = ['start', 'menu', 'description', 'add', 'cart', 'pay', 'geo', 'delivery', 'invoice']
+
+
+class UpdateTracker:
+    '''Lets a driver thread wait until the dispatcher is done with its update.'''
+
+    def __init__(self):
+        self.done = {}
+        self.failed = set()
+        self._lock = threading.Lock()
+
+    def expect(self, update_id):
+        event = threading.Event()
+        with self._lock:
+            self.done[update_id] = event
+        return event
+
+    def handle_done(self, update, context):
+        with self._lock:
+            event = self.done.pop(update.update_id, None)
+        if event is not None:
+            event.set()
+
+    def handle_error(self, update, context):
+        if isinstance(update, Update):
+            self.failed.add(update.update_id)
+
+
+class VirtualUser:
+    def __init__(self, chat_id, update_ids, bot):
+        self.chat_id = chat_id
+        self.update_ids = update_ids
+        self.bot = bot
+        self.message_ids = iter(range(1, 1000000))
+
+    def user(self):
+        return {'id': self.chat_id, 'is_bot': False, 'first_name': 'Load'}
+
+    def message(self, text):
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': self.chat_id, 'type': 'private'},
+            'from': self.user(),
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        return Update.de_json({'update_id': next(self.update_ids), 'message': message}, self.bot)
+
+    def callback(self, data):
+        return Update.de_json({
+            'update_id': next(self.update_ids),
+            'callback_query': {
+                'id': str(next(self.message_ids)),
+                'from': self.user(),
+                'chat_instance': str(self.chat_id),
+                'data': data,
+                'message': {
+                    'message_id': next(self.message_ids),
+                    'date': int(time.time()),
+                    'chat': {'id': self.chat_id, 'type': 'private'},
+                    'text': 'Пожалуйста выберите товар',
+                },
+            },
+        }, self.bot)
+
+    def updates(self, product_id, address):
+        yield 'start', self.message('/start')
+        yield 'menu', self.callback('pagenext#1')
+        yield 'description', self.callback(product_id)
+        yield 'add', self.callback(f'{product_id}|card:1')
+        yield 'cart', self.callback('productcard')
+        yield 'pay', self.callback('paybutton')
+        yield 'geo', self.message(address)
+        yield 'delivery', self.callback('delivery')
+        yield 'invoice', self.callback('payorder')
+
+
+def run_user(user, rounds, products, addresses, dispatcher, tracker, timings, errors, timeout):
+    for round_number in range(rounds):
+        product_id = products[(user.chat_id + round_number) % len(products)]
+        address = addresses[(user.chat_id * 7 + round_number) % len(addresses)]
+        for step, update in user.updates(product_id, address):
+            done = tracker.expect(update.update_id)
+            started = time.perf_counter()
+            dispatcher.update_queue.put(update)
+            if not done.wait(timeout):
+                errors[step].append(update.update_id)
+                continue
+            timings[step].append((time.perf_counter() - started) * 1000)
+            if update.update_id in tracker.failed:
+                errors[step].append(update.update_id)
+
+
+def percentile(timings, share):
+    return timings[min(len(timings) - 1, int(len(timings) * share))]
+
+
+def report(timings, errors, elapsed):
+    total = sum(len(step_timings) for step_timings in timings.values())
+    print(f'{total} updates in {elapsed:.1f}s, {total / elapsed:.1f} updates/s')
+    print(f'{"state":<12} {"count":>6} {"errors":>6} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9}')
+    for step in STEPS:
+        step_timings = sorted(timings[step])
+        if not step_timings:
+            print(f'{step:<12} {0:>6} {len(errors[step]):>6}')
+            continue
+        print(
+            f'{step:<12} {len(step_timings):>6} {len(errors[step]):>6} {statistics.median(step_timings):9.1f}'
+            f' {percentile(step_timings, 0.95):9.1f} {percentile(step_timings, 0.99):9.1f}'
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50, help='users going through the flow at the same time')
+    parser.add_argument('--rounds', type=int, default=4, help='orders per user')
+    parser.add_argument('--latency-ms', type=float, default=40, help='added to every upstream request')
+    parser.add_argument('--jitter-ms', type=float, default=20)
+    parser.add_argument('--telegram-latency-ms', type=float, default=None)
+    parser.add_argument('--error-rate', type=float, default=0, help='share of Moltin and geocoder requests failing')
+    parser.add_argument('--redis-db', type=int, default=15)
+    parser.add_argument('--timeout', type=float, default=60, help='seconds a step may take before it counts as lost')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    servers, environment = start_standins(
+        args.latency_ms,
+        args.jitter_ms,
+        args.error_rate,
+        telegram_latency_ms=args.telegram_latency_ms
+    )
+    os.environ.update(environment)
+    os.environ.update({
+        'REDIS_DB': str(args.redis_db),
+        'ELASTICPATH_CLIENT_ID': 'end-to-end',
+        'ELASTICPATH_CLIENT_SECRET': 'end-to-end',
+        'YANDEX_GEO': 'end-to-end',
+        'PAYMENT_PROVIDER_TOKEN': 'end-to-end',
+    })
+    redis_db = telegram_bot.create_redis()
+    redis_db.flushdb()
+    dispatcher = telegram_bot.create_dispatcher(BENCHMARK_TOKEN, redis_db, Queue())
+    tracker = UpdateTracker()
+    dispatcher.add_handler(TypeHandler(Update, tracker.handle_done), group=99)
+    dispatcher.add_error_handler(tracker.handle_error)
+    dispatcher.job_queue.start()
+    threading.Thread(target=dispatcher.start, daemon=True).start()
+
+    moltin = servers['moltin'].app
+    products = [product['id'] for product in moltin.products.values()]
+    addresses = [entry['address'] for entries in moltin.entries.values() for entry in entries]
+    update_ids = iter(range(1, 10 ** 9))
+    update_ids_lock = threading.Lock()
+
+    def next_update_id():
+        with update_ids_lock:
+            return next(update_ids)
+
+    shared_update_ids = iter(next_update_id, None)
+    timings = defaultdict(list)
+    errors = defaultdict(list)
+    users = [VirtualUser(10000 + number, shared_update_ids, dispatcher.bot) for number in range(args.users)]
+    threads = [
+        threading.Thread(
+            target=run_user,
+            args=(user, args.rounds, products, addresses, dispatcher, tracker, timings, errors, args.timeout)
+        )
+        for user in users
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    report(timings, errors, elapsed)
+    for name, server in servers.items():
+        calls = ', '.join(f'{call} {count}' for call, count in server.calls.most_common())
+        print(f'{name}: {calls}')
+    dispatcher.stop()
+    dispatcher.job_queue.stop()
+    redis_db.flushdb()
+    for server in servers.values():
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+'''Per-request latency of bare ``requests.get`` vs the pooled ApiClient.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_http_client --requests 500
+
+A local keep-alive HTTP server stands in for Moltin, so the numbers only
+show the TCP connect/teardown part of the saving; against the real API the
+TLS handshake that pooling skips is several times more expensive.
+'''
+import argparse
+import json
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from api_client import ApiClient
+
+
+class ProductsHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes, with Nagle on a kept-alive
+    # connection the body would wait ~40 ms for the client's delayed ACK
+    disable_nagle_algorithm = True
+    body = json.dumps({'data': [{'id': str(number), 'name': f'Pizza {number}'} for number in range(20)]}).encode()
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def measure(call, count):
+    timings = []
+    for _ in range(count):
+        started = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f'{name:<10} mean {statistics.mean(timings):7.3f} ms  p50 {statistics.median(timings):7.3f} ms  p95 {p95:7.3f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=500)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ProductsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    headers = {'Authorization': 'Bearer benchmark'}
+
+    def bare_call():
+        response = requests.get(f'{base_url}/v2/products', headers=headers)
+        response.raise_for_status()
+        response.json()
+
+    client = ApiClient(base_url, headers=headers)
+
+    def pooled_call():
+        response = client.get('/v2/products')
+        response.raise_for_status()
+        response.json()
+
+    bare_call()
+    pooled_call()
+    report('bare', measure(bare_call, args.requests))
+    report('pooled', measure(pooled_call, args.requests))
+    client.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
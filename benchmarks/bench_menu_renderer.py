@@ -0,0 +1,86 @@
+'''Menu page rendering: rebuilding with create_menu vs the precomputed MenuRenderer.
+
+Run from the repository root, no network needed:
+
+    python -m benchmarks.bench_menu_renderer --products 10 500
+'''
+import argparse
+import math
+import time
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from menu_renderer import MenuRenderer
+
+
+class StaticCatalog:
+    '''Stands in for CatalogCache with a fixed product list.'''
+
+    version = 1
+
+    def __init__(self, products):
+        self.products = products
+
+    def get_all_products(self):
+        return self.products
+
+
+# the function telegram_bot used before MenuRenderer, kept verbatim as the baseline
+def create_menu(products, page=0):
+    keyboard = []
+    product_on_page = 5
+    max_products = math.ceil(len(products.get('data'))/product_on_page)*product_on_page
+    for count, product in enumerate(products.get('data')):
+        if page+product_on_page > count and count >= page:
+            product_name = product.get('name')
+            product_id = product.get('id')
+            button = [InlineKeyboardButton(product_name, callback_data=product_id)]
+            keyboard.append(button)
+    card_keyboard = [InlineKeyboardButton('Корзина', callback_data='productcard')]
+    if page <= 0:
+        incr_page = page + product_on_page
+        navigation_keyboard = [
+            InlineKeyboardButton('След',  callback_data=f'pagenext#{incr_page}')
+        ]
+    elif page >= max_products:
+        decr_page = page - product_on_page
+        navigation_keyboard = [
+            InlineKeyboardButton('Пред',  callback_data=f'pageback#{decr_page}')
+        ]
+    else:
+        incr_page = page + product_on_page
+        decr_page = page - product_on_page
+        navigation_keyboard = [
+            InlineKeyboardButton('След',  callback_data=f'pagenext#{incr_page}'),
+            InlineKeyboardButton('Пред',  callback_data=f'pageback#{decr_page}')
+        ]
+    keyboard.append(navigation_keyboard)
+    keyboard.append(card_keyboard)
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    return reply_markup
+
+
+def measure(render, pages, rounds):
+    started = time.perf_counter()
+    for round_number in range(rounds):
+        render(round_number % pages)
+    return (time.perf_counter() - started) * 1000 / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, nargs='+', default=[10, 500])
+    parser.add_argument('--rounds', type=int, default=2000)
+    args = parser.parse_args()
+    for count in args.products:
+        products = {'data': [{'id': f'product-{number}', 'name': f'Пицца {number}'} for number in range(count)]}
+        pages = math.ceil(count / 5)
+        renderer = MenuRenderer(StaticCatalog(products))
+        renderer.render()
+        legacy_ms = measure(lambda page: create_menu(products, page * 5), pages, args.rounds)
+        renderer_ms = measure(renderer.render, pages, args.rounds)
+        print(f'{count:>5} products  create_menu {legacy_ms:8.4f} ms/page  MenuRenderer {renderer_ms:8.4f} ms/page')
+
+
+if __name__ == '__main__':
+    main()
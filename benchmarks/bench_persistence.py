@@ -0,0 +1,93 @@
+'''Latency of a single user_data update, blob vs incremental persistence.
+
+Run from the repository root with a Redis reachable through REDIS_HOST,
+REDIS_PORT and REDIS_PASS (defaults to localhost):
+
+    python -m benchmarks.bench_persistence --users 1000 10000 100000
+'''
+import argparse
+import os
+import statistics
+import time
+from collections import defaultdict
+
+import redis
+
+from storing_data import PizzaShopPersistence
+
+BENCHMARK_KEY = 'PersistenceBenchmark'
+
+
+def make_user_data(user_id):
+    return {
+        'restuarant': f'Москва, ул. Тестовая, {user_id % 500}',
+        'distance': 1.5,
+        'coordinates': ('37.6173', '55.7558'),
+        'user_coordinates': ['37.6000', '55.7500'],
+    }
+
+
+def prepare(redis_db, users, incremental):
+    persistence = PizzaShopPersistence(
+        redis_db,
+        store_user_data=True,
+        incremental=incremental,
+        key=BENCHMARK_KEY
+    )
+    persistence.user_data = defaultdict(dict)
+    persistence.chat_data = defaultdict(dict)
+    persistence.bot_data = {}
+    persistence.conversations = {}
+    persistence.on_flush = True
+    for user_id in range(users):
+        persistence.user_data[user_id] = make_user_data(user_id)
+    if incremental:
+        persistence.dump_entries(
+            (f'{BENCHMARK_KEY}:user_data', user_id, data)
+            for user_id, data in persistence.user_data.items()
+        )
+    else:
+        persistence.dump_redis()
+    persistence.on_flush = False
+    return persistence
+
+
+def measure(persistence, users, samples):
+    timings = []
+    for sample in range(samples):
+        user_id = (sample * 7919) % users
+        data = dict(make_user_data(user_id), distance=float(sample))
+        started = time.perf_counter()
+        persistence.update_user_data(user_id, data)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def cleanup(redis_db):
+    keys = redis_db.keys(f'{BENCHMARK_KEY}*')
+    if keys:
+        redis_db.delete(*keys)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--samples', type=int, default=50)
+    args = parser.parse_args()
+    redis_db = redis.Redis(
+        host=os.getenv('REDIS_HOST', 'localhost'),
+        port=os.getenv('REDIS_PORT', 6379),
+        password=os.getenv('REDIS_PASS')
+    )
+    for users in args.users:
+        for incremental in (False, True):
+            cleanup(redis_db)
+            persistence = prepare(redis_db, users, incremental)
+            timings = measure(persistence, users, args.samples)
+            mode = 'incremental' if incremental else 'blob'
+            print(f'{users:>7} users  {mode:<11} mean {statistics.mean(timings):9.3f} ms  p50 {statistics.median(timings):9.3f} ms')
+    cleanup(redis_db)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+'''Nearest pizzeria lookup: linear geodesic scan vs RestaurantIndex.
+
+Run from the repository root, no network needed:
+
+    python -m benchmarks.bench_restaurant_index --locations 10 1000 100000
+'''
+import argparse
+import random
+import time
+
+from api_handler import get_distance
+from restaurant_index import RestaurantIndex
+
+
+def make_entries(count, rng):
+    return [
+        {
+            'id': str(number),
+            'address': f'Пиццерия {number}',
+            'longitude': f'{rng.uniform(36.8, 38.4):.6f}',
+            'latitude': f'{rng.uniform(55.1, 56.3):.6f}',
+        }
+        for number in range(count)
+    ]
+
+
+def linear_nearest(entries, coordinates):
+    '''The pre-index find_nearest_restaurant loop.'''
+    return min(
+        entries,
+        key=lambda entry: get_distance(coordinates, (entry['longitude'], entry['latitude']))
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--locations', type=int, nargs='+', default=[10, 1000, 100000])
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+    rng = random.Random(42)
+    for count in args.locations:
+        entries = make_entries(count, rng)
+        queries = [
+            (f'{rng.uniform(36.9, 38.3):.6f}', f'{rng.uniform(55.2, 56.2):.6f}')
+            for _ in range(args.queries)
+        ]
+        index = RestaurantIndex(moltin_client=None)
+        started = time.perf_counter()
+        index.load(entries)
+        build_ms = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        indexed = [index.nearest(query)[0] for query in queries]
+        index_ms = (time.perf_counter() - started) * 1000 / len(queries)
+
+        # the linear scan over 100k points takes seconds per query, sample it
+        linear_queries = queries[:max(1, min(len(queries), 2_000_000 // count // 10))]
+        started = time.perf_counter()
+        linear = [linear_nearest(entries, query) for query in linear_queries]
+        linear_ms = (time.perf_counter() - started) * 1000 / len(linear_queries)
+
+        mismatches = sum(
+            found['restuarant'] != expected['address']
+            for found, expected in zip(indexed, linear)
+        )
+        print(
+            f'{count:>7} locations  build {build_ms:9.1f} ms  '
+            f'index {index_ms:8.3f} ms/query  linear {linear_ms:10.3f} ms/query  '
+            f'mismatches {mismatches}/{len(linear)}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+'''Size and speed of the persisted state in pickle vs the versioned JSON format.
+
+Run from the repository root, no Redis needed:
+
+    python -m benchmarks.bench_serialization --users 10000
+'''
+import argparse
+import time
+from collections import defaultdict
+
+from serializers import JsonSerializer, PickleSerializer
+
+
+def make_state(users):
+    '''Conversation states plus user_data as left by handle_pay_request_geo.'''
+    user_data = defaultdict(dict)
+    conversations = {}
+    for user_id in range(users):
+        user_data[user_id] = {
+            'restuarant': f'Москва, ул. Тестовая, д. {user_id % 500}',
+            'distance': 1.0 + user_id % 20 / 3,
+            'coordinates': ('37.61730', f'55.{7558 + user_id % 100}'),
+            'user_coordinates': ['37.600000', f'55.{7500 + user_id % 300}'],
+        }
+        conversations[(user_id, user_id)] = user_id % 6
+    return {
+        'conversations': {'pizza_conversation': conversations},
+        'user_data': user_data,
+        'chat_data': defaultdict(dict),
+        'bot_data': {},
+    }
+
+
+def measure(serializer, value, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        data = serializer.dumps(value)
+    dumps_ms = (time.perf_counter() - started) * 1000 / rounds
+    started = time.perf_counter()
+    for _ in range(rounds):
+        serializer.loads(data)
+    loads_ms = (time.perf_counter() - started) * 1000 / rounds
+    return len(data), dumps_ms, loads_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+    state = make_state(args.users)
+    single_user = state['user_data'][0]
+    serializers = {
+        'pickle': PickleSerializer(),
+        'json': JsonSerializer(compress_threshold=None),
+        'json+zlib': JsonSerializer(),
+    }
+    for label, value, rounds in (
+        (f'full state, {args.users} users', state, args.rounds),
+        ('one user_data entry', single_user, 10000),
+    ):
+        print(label)
+        for name, serializer in serializers.items():
+            size, dumps_ms, loads_ms = measure(serializer, value, rounds)
+            print(f'  {name:<10} {size:>10} bytes  dumps {dumps_ms:9.4f} ms  loads {loads_ms:9.4f} ms')
+        restored = serializers['json+zlib'].loads(serializers['json+zlib'].dumps(value))
+        assert restored == value
+
+
+if __name__ == '__main__':
+    main()
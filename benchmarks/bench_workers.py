@@ -0,0 +1,129 @@
+'''Update throughput of sharded bot workers by worker count.
+
+Synthetic message updates are routed through Redis exactly like in
+BOT_SHARDS mode, each worker process handles its shard with a real
+Dispatcher whose handler burns ``--handler-ms`` of CPU, as rendering and
+serialization do in the bot. Updates of one chat must arrive in order,
+the out-of-order column counts violations.
+
+Run from the repository root with a Redis reachable through REDIS_HOST,
+REDIS_PORT and REDIS_PASS (defaults to localhost):
+
+    python -m benchmarks.bench_workers --workers 1 2 4 --updates 4000
+'''
+import argparse
+import os
+import signal
+import time
+from functools import partial
+from queue import Queue
+
+import redis
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, Filters, MessageHandler
+
+from sharding import ShardConsumer, UpdateRouter, WorkerPool
+
+BENCHMARK_KEY = 'WorkersBenchmark'
+BENCHMARK_TOKEN = '123456:benchmark'
+
+
+def connect():
+    return redis.Redis(
+        host=os.getenv('REDIS_HOST', 'localhost'),
+        port=os.getenv('REDIS_PORT', 6379),
+        password=os.getenv('REDIS_PASS')
+    )
+
+
+def burn_cpu(milliseconds):
+    deadline = time.perf_counter() + milliseconds / 1000
+    while time.perf_counter() < deadline:
+        pass
+
+
+def handle_message(redis_db, handler_ms, last_seen, update, context):
+    chat_id = update.effective_chat.id
+    sequence = int(update.message.text)
+    if sequence < last_seen.get(chat_id, -1):
+        redis_db.incr(f'{BENCHMARK_KEY}:out_of_order')
+    last_seen[chat_id] = sequence
+    burn_cpu(handler_ms)
+    redis_db.incr(f'{BENCHMARK_KEY}:done')
+
+
+def run_worker(handler_ms, shard, shards):
+    redis_db = connect()
+    dispatcher = Dispatcher(Bot(BENCHMARK_TOKEN), Queue())
+    dispatcher.add_handler(MessageHandler(Filters.text, partial(handle_message, redis_db, handler_ms, {})))
+    consumer = ShardConsumer(redis_db, dispatcher, shard, key=f'{BENCHMARK_KEY}:Updates')
+    signal.signal(signal.SIGTERM, lambda signum, frame: consumer.stop())
+    redis_db.incr(f'{BENCHMARK_KEY}:ready')
+    consumer.run()
+
+
+def make_updates(bot, updates, chats):
+    for update_id in range(updates):
+        chat_id = 1000 + update_id % chats
+        yield Update.de_json({
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Load'},
+                'text': str(update_id // chats),
+            },
+        }, bot)
+
+
+def wait_for(redis_db, key, value, timeout=120):
+    deadline = time.monotonic() + timeout
+    while int(redis_db.get(key) or 0) < value:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f'{key} stuck at {int(redis_db.get(key) or 0)} of {value}')
+        time.sleep(0.01)
+
+
+def measure(redis_db, workers, updates, chats, handler_ms):
+    cleanup(redis_db)
+    pool = WorkerPool(partial(run_worker, handler_ms), workers)
+    pool.start()
+    try:
+        wait_for(redis_db, f'{BENCHMARK_KEY}:ready', workers)
+        router = UpdateRouter(redis_db, workers, key=f'{BENCHMARK_KEY}:Updates')
+        started = time.perf_counter()
+        for update in make_updates(Bot(BENCHMARK_TOKEN), updates, chats):
+            router.route(update)
+        wait_for(redis_db, f'{BENCHMARK_KEY}:done', updates)
+        elapsed = time.perf_counter() - started
+    finally:
+        pool.stop()
+    return elapsed, int(redis_db.get(f'{BENCHMARK_KEY}:out_of_order') or 0)
+
+
+def cleanup(redis_db):
+    keys = redis_db.keys(f'{BENCHMARK_KEY}*')
+    if keys:
+        redis_db.delete(*keys)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--updates', type=int, default=4000)
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--handler-ms', type=float, default=5)
+    args = parser.parse_args()
+    redis_db = connect()
+    baseline = None
+    for workers in args.workers:
+        elapsed, out_of_order = measure(redis_db, workers, args.updates, args.chats, args.handler_ms)
+        throughput = args.updates / elapsed
+        baseline = baseline or throughput
+        print(f'{workers:>3} workers  {throughput:9.1f} updates/s  x{throughput / baseline:5.2f}  out of order {out_of_order}')
+    cleanup(redis_db)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,503 @@
+'''Local stand-ins for Elastic Path, the Yandex geocoder and the Telegram Bot API.
+
+They answer the endpoints api_handler, async_api_handler, get_access_token
+and python-telegram-bot use, from in-memory state seeded with
+data/menu.json and data/addresses.json, and can add latency and fail a
+share of the requests. Run from the repository root to get servers for a
+manually started bot:
+
+    python -m benchmarks.standins --latency-ms 50 --error-rate 0.01
+
+The printed variables point the bot at them.
+'''
+import argparse
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+# what a CDN answers for a product photo, small but not trivial to upload
+IMAGE_BYTES = bytes(random.Random(0).getrandbits(8) for _ in range(20000))
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send_body flushes the headers before the body, keep-alive clients
+    # would otherwise see a delayed-ACK stall on every call
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.handle_method('GET')
+
+    def do_POST(self):
+        self.handle_method('POST')
+
+    def do_PUT(self):
+        self.handle_method('PUT')
+
+    def do_DELETE(self):
+        self.handle_method('DELETE')
+
+    def handle_method(self, method):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        server.wait()
+        if server.error_rate and random.random() < server.error_rate:
+            server.calls['injected errors'] += 1
+            self.send_body(server.error_status, {'errors': [{'title': 'Injected error'}]}, {'Retry-After': '1'})
+            return
+        url = urlsplit(self.path)
+        request = {
+            'query': {name: values[-1] for name, values in parse_qs(url.query).items()},
+            'body': body,
+            'content_type': self.headers.get('Content-Type', ''),
+        }
+        status, payload = server.app.handle(method, url.path, request)
+        self.send_body(status, payload)
+
+    def send_body(self, status, payload, headers=None):
+        if isinstance(payload, bytes):
+            body, content_type = payload, 'image/jpeg'
+        else:
+            body, content_type = json.dumps(payload, ensure_ascii=False).encode(), 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingHTTPServer):
+    '''Serves ``app`` on a local port in a daemon thread.
+
+    Every request waits ``latency_ms`` plus a uniform ``jitter_ms``, and
+    a share ``error_rate`` of them is answered with ``error_status``.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, app, latency_ms=0, jitter_ms=0, error_rate=0, error_status=500, port=0):
+        super().__init__(('127.0.0.1', port), StandInRequestHandler)
+        self.app = app
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.calls = app.calls
+        app.base_url = self.url
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def wait(self):
+        delay = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if delay:
+            time.sleep(delay / 1000)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StandInApp:
+    '''Dispatches requests to methods by ``(method, path regex)`` routes.'''
+
+    routes = []
+
+    def __init__(self):
+        self.base_url = ''
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self._compiled = [
+            (method, re.compile(f'^{pattern}/?$'), getattr(self, name))
+            for method, pattern, name in self.routes
+        ]
+
+    def handle(self, method, path, request):
+        for route_method, pattern, handler in self._compiled:
+            match = pattern.match(path)
+            if match and method in route_method.split('|'):
+                self.calls[self.call_name(handler, match)] += 1
+                with self.lock:
+                    return handler(request, **match.groupdict())
+        self.calls['not found'] += 1
+        return 404, {'errors': [{'title': f'No stand-in for {method} {path}'}]}
+
+    def call_name(self, handler, match):
+        return handler.__name__
+
+
+def parse_json(request):
+    if 'json' not in request['content_type'] or not request['body']:
+        return {}
+    return json.loads(request['body'])
+
+
+def make_price(amount):
+    return {'amount': amount, 'currency': 'RUB', 'formatted': f'{amount}RUB'}
+
+
+class MoltinStandIn(StandInApp):
+    routes = [
+        ('PUT|POST', r'/oauth/access_token', 'access_token'),
+        ('GET', r'/v2/products', 'list_products'),
+        ('POST', r'/v2/products', 'create_product'),
+        ('GET', r'/v2/products/(?P<product_id>[^/]+)', 'get_product'),
+        ('PUT', r'/v2/products/(?P<product_id>[^/]+)', 'update_product'),
+        ('DELETE', r'/v2/products/(?P<product_id>[^/]+)', 'delete_product'),
+        ('POST', r'/v2/products/(?P<product_id>[^/]+)/relationships/main-image', 'link_main_image'),
+        ('POST', r'/v2/files', 'create_file'),
+        ('GET', r'/v2/files/(?P<file_id>[^/]+)', 'get_file'),
+        ('DELETE', r'/v2/files/(?P<file_id>[^/]+)', 'delete_file'),
+        ('GET', r'/cdn/(?P<name>[^/]+)', 'download'),
+        ('GET', r'/v2/carts/(?P<cart_id>[^/]+)', 'get_cart'),
+        ('GET', r'/v2/carts/(?P<cart_id>[^/]+)/items', 'get_cart_items'),
+        ('POST', r'/v2/carts/(?P<cart_id>[^/]+)/items', 'add_cart_item'),
+        ('PUT', r'/v2/carts/(?P<cart_id>[^/]+)/items/(?P<item_id>[^/]+)', 'update_cart_item'),
+        ('DELETE', r'/v2/carts/(?P<cart_id>[^/]+)/items/(?P<item_id>[^/]+)', 'remove_cart_item'),
+        ('POST', r'/v2/customers', 'create_customer'),
+        ('GET', r'/v2/flows', 'list_flows'),
+        ('POST', r'/v2/flows', 'create_flow'),
+        ('GET', r'/v2/flows/(?P<flow_id>[^/]+)/fields', 'list_fields'),
+        ('POST', r'/v2/fields', 'create_field'),
+        ('GET', r'/v2/flows/(?P<flow_slug>[^/]+)/entries', 'list_entries'),
+        ('POST', r'/v2/flows/(?P<flow_slug>[^/]+)/entries', 'create_entry'),
+    ]
+
+    def __init__(self, menu=(), addresses=()):
+        super().__init__()
+        self.products = {}
+        self.files = {}
+        self.carts = {}
+        self.flows = {}
+        self.fields = {}
+        self.entries = {}
+        for item in menu:
+            product = self._make_product({
+                'name': item['name'],
+                'slug': f'product-{item["id"]}',
+                'sku': str(item['id']),
+                'description': item['description'],
+                'price': [{'amount': item['price'], 'currency': 'RUB', 'includes_tax': True}],
+            })
+            file_id = self._make_file()
+            product['relationships'] = {'main_image': {'data': {'type': 'main_image', 'id': file_id}}}
+        if addresses:
+            flow = self._make_flow({'name': 'Pizzeria', 'slug': 'pizzeria'})
+            for field in ('address', 'alias', 'longitude', 'latitude'):
+                self.fields.setdefault(flow['id'], []).append({'id': str(uuid.uuid4()), 'slug': field})
+            for address in addresses:
+                self.entries[flow['slug']].append({
+                    'id': str(uuid.uuid4()),
+                    'type': 'entry',
+                    'address': address['address']['full'],
+                    'alias': address['alias'],
+                    'longitude': address['coordinates']['lon'],
+                    'latitude': address['coordinates']['lat'],
+                })
+
+    def page(self, items, request, path):
+        # Moltin's default page length, clients that do not page see only the first 25
+        limit = int(request['query'].get('page[limit]', 25))
+        offset = int(request['query'].get('page[offset]', 0))
+        links = {}
+        if offset + limit < len(items):
+            query = urlencode({'page[limit]': limit, 'page[offset]': offset + limit})
+            links['next'] = f'{self.base_url}{path}?{query}'
+        return 200, {
+            'data': items[offset:offset + limit],
+            'links': links,
+            'meta': {'page': {'limit': limit, 'offset': offset}, 'results': {'total': len(items)}},
+        }
+
+    def access_token(self, request):
+        expires_in = 3600
+        return 200, {
+            'access_token': uuid.uuid4().hex,
+            'token_type': 'Bearer',
+            'expires_in': expires_in,
+            'expires': int(time.time()) + expires_in,
+        }
+
+    def _make_product(self, data, product_id=None):
+        product_id = product_id or str(uuid.uuid4())
+        amount = data['price'][0]['amount']
+        product = dict(
+            data,
+            id=product_id,
+            type='product',
+            meta={'display_price': {'with_tax': make_price(amount)}},
+            relationships=self.products.get(product_id, {}).get('relationships', {}),
+        )
+        self.products[product_id] = product
+        return product
+
+    def _make_file(self):
+        file_id = str(uuid.uuid4())
+        self.files[file_id] = {'id': file_id, 'type': 'file'}
+        return file_id
+
+    def _file_payload(self, file_id):
+        # the link is built per request, seeded files exist before the port is known
+        return {'id': file_id, 'type': 'file', 'link': {'href': f'{self.base_url}/cdn/{file_id}.jpg'}}
+
+    def list_products(self, request):
+        return self.page(list(self.products.values()), request, '/v2/products')
+
+    def create_product(self, request):
+        return 201, {'data': self._make_product(parse_json(request)['data'])}
+
+    def get_product(self, request, product_id):
+        if product_id not in self.products:
+            return 404, {'errors': [{'title': 'Product not found'}]}
+        return 200, {'data': self.products[product_id]}
+
+    def update_product(self, request, product_id):
+        if product_id not in self.products:
+            return 404, {'errors': [{'title': 'Product not found'}]}
+        data = dict(self.products[product_id], **parse_json(request)['data'])
+        return 200, {'data': self._make_product(data, product_id)}
+
+    def delete_product(self, request, product_id):
+        self.products.pop(product_id, None)
+        return 204, {}
+
+    def link_main_image(self, request, product_id):
+        image = parse_json(request)['data']
+        self.products[product_id]['relationships'] = {'main_image': {'data': image}}
+        return 200, {'data': image}
+
+    def create_file(self, request):
+        return 201, {'data': self._file_payload(self._make_file())}
+
+    def get_file(self, request, file_id):
+        if file_id not in self.files:
+            return 404, {'errors': [{'title': 'File not found'}]}
+        return 200, {'data': self._file_payload(file_id)}
+
+    def delete_file(self, request, file_id):
+        self.files.pop(file_id, None)
+        return 204, {}
+
+    def download(self, request, name):
+        return 200, IMAGE_BYTES
+
+    def _cart_items(self, cart_id):
+        return self.carts.setdefault(cart_id, [])
+
+    def _cart_response(self, cart_id):
+        return 200, {'data': self._cart_items(cart_id)}
+
+    def get_cart(self, request, cart_id):
+        total = sum(item['value']['amount'] for item in self._cart_items(cart_id))
+        return 200, {
+            'data': {
+                'id': cart_id,
+                'type': 'cart',
+                'meta': {'display_price': {'with_tax': make_price(total)}},
+            },
+        }
+
+    def get_cart_items(self, request, cart_id):
+        return self._cart_response(cart_id)
+
+    def add_cart_item(self, request, cart_id):
+        data = parse_json(request)['data']
+        product = self.products.get(data['id'])
+        if product is None:
+            return 404, {'errors': [{'title': 'Product not found'}]}
+        items = self._cart_items(cart_id)
+        item = next((item for item in items if item['product_id'] == product['id']), None)
+        if item is None:
+            item = {
+                'id': str(uuid.uuid4()),
+                'type': 'cart_item',
+                'product_id': product['id'],
+                'name': product['name'],
+                'quantity': 0,
+            }
+            items.append(item)
+        self._set_quantity(item, product, item['quantity'] + int(data['quantity']))
+        return self._cart_response(cart_id)
+
+    def _set_quantity(self, item, product, quantity):
+        unit_price = product['price'][0]['amount']
+        item['quantity'] = quantity
+        item['unit_price'] = make_price(unit_price)
+        item['value'] = make_price(unit_price * quantity)
+        item['meta'] = {'display_price': {'with_tax': {'unit': make_price(unit_price), 'value': make_price(unit_price * quantity)}}}
+
+    def update_cart_item(self, request, cart_id, item_id):
+        quantity = int(parse_json(request)['data']['quantity'])
+        for item in self._cart_items(cart_id):
+            if item['id'] == item_id:
+                self._set_quantity(item, self.products[item['product_id']], quantity)
+        return self._cart_response(cart_id)
+
+    def remove_cart_item(self, request, cart_id, item_id):
+        self.carts[cart_id] = [item for item in self._cart_items(cart_id) if item['id'] != item_id]
+        return self._cart_response(cart_id)
+
+    def create_customer(self, request):
+        return 201, {'data': dict(parse_json(request)['data'], id=str(uuid.uuid4()))}
+
+    def list_flows(self, request):
+        return 200, {'data': list(self.flows.values())}
+
+    def _make_flow(self, data):
+        flow = dict(data, id=str(uuid.uuid4()), type='flow')
+        self.flows[flow['id']] = flow
+        self.entries.setdefault(flow['slug'], [])
+        return flow
+
+    def create_flow(self, request):
+        return 201, {'data': self._make_flow(parse_json(request)['data'])}
+
+    def list_fields(self, request, flow_id):
+        return 200, {'data': self.fields.get(flow_id, [])}
+
+    def create_field(self, request):
+        data = parse_json(request)['data']
+        field = dict(data, id=str(uuid.uuid4()))
+        self.fields.setdefault(data['relationships']['flow']['data']['id'], []).append(field)
+        return 201, {'data': field}
+
+    def list_entries(self, request, flow_slug):
+        return self.page(self.entries.get(flow_slug, []), request, f'/v2/flows/{flow_slug}/entries')
+
+    def create_entry(self, request, flow_slug):
+        entry = dict(parse_json(request)['data'], id=str(uuid.uuid4()))
+        self.entries.setdefault(flow_slug, []).append(entry)
+        return 201, {'data': entry}
+
+
+class GeocoderStandIn(StandInApp):
+    '''Places every address at a fixed point within ~15 km of the centre of Moscow.'''
+
+    routes = [('GET', r'/1\.x', 'geocode')]
+
+    def geocode(self, request):
+        address = request['query'].get('geocode', '')
+        if not address.strip():
+            return 200, {'response': {'GeoObjectCollection': {'featureMember': []}}}
+        digest = hashlib.sha256(address.encode()).digest()
+        lon = 37.6173 + (digest[0] - 128) / 128 * 0.25
+        lat = 55.7558 + (digest[1] - 128) / 128 * 0.12
+        return 200, {
+            'response': {
+                'GeoObjectCollection': {
+                    'featureMember': [
+                        {'GeoObject': {'name': address, 'Point': {'pos': f'{lon:.6f} {lat:.6f}'}}},
+                    ],
+                },
+            },
+        }
+
+
+class TelegramStandIn(StandInApp):
+    '''Bot API methods the bot calls, every message is accepted.'''
+
+    routes = [('GET|POST', r'/bot(?P<token>[^/]+)/(?P<method>[A-Za-z]+)', 'call_method')]
+
+    def __init__(self):
+        super().__init__()
+        self.message_ids = itertools.count(1)
+
+    def call_name(self, handler, match):
+        return match['method']
+
+    def call_method(self, request, token, method):
+        if 'json' in request['content_type']:
+            params = parse_json(request)
+        else:
+            # multipart uploads: only the plain fields are needed
+            params = dict(re.findall(rb'name="(\w+)"\r\n\r\n([^\r]*)\r\n', request['body']))
+            params = {name.decode(): value.decode() for name, value in params.items()}
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Stand-in', 'username': 'standin_bot'}
+        elif method.startswith('send'):
+            result = {
+                'message_id': next(self.message_ids),
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id') or 0), 'type': 'private'},
+            }
+            if method == 'sendPhoto':
+                photo = params.get('photo')
+                file_id = photo if isinstance(photo, str) and photo and not photo.startswith('attach://') else uuid.uuid4().hex
+                result['photo'] = [{'file_id': file_id, 'file_unique_id': file_id[:16], 'width': 800, 'height': 800}]
+            elif method == 'sendLocation':
+                result['location'] = {'latitude': float(params['latitude']), 'longitude': float(params['longitude'])}
+            else:
+                result['text'] = params.get('text', '')
+        else:
+            result = True
+        return 200, {'ok': True, 'result': result}
+
+
+def load_seed_data(menu_path='./data/menu.json', addresses_path='./data/addresses.json'):
+    with open(menu_path, 'r') as file:
+        menu = json.load(file)
+    with open(addresses_path, 'r') as file:
+        addresses = json.load(file)
+    return menu, addresses
+
+
+def start_standins(latency_ms=0, jitter_ms=0, error_rate=0, error_status=500, telegram_latency_ms=None):
+    '''Starts the three stand-ins, returns them with the environment pointing the bot at them.'''
+    menu, addresses = load_seed_data()
+    servers = {
+        'moltin': StandInServer(MoltinStandIn(menu, addresses), latency_ms, jitter_ms, error_rate, error_status),
+        'geocoder': StandInServer(GeocoderStandIn(), latency_ms, jitter_ms, error_rate, error_status),
+        'telegram': StandInServer(
+            TelegramStandIn(),
+            latency_ms if telegram_latency_ms is None else telegram_latency_ms,
+            jitter_ms
+        ),
+    }
+    for server in servers.values():
+        server.start()
+    environment = {
+        'MOLTIN_API_URL': servers['moltin'].url,
+        'YANDEX_GEOCODER_URL': servers['geocoder'].url,
+        'TELEGRAM_API_URL': servers['telegram'].url,
+    }
+    return servers, environment
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0, help='share of Moltin and geocoder requests failing')
+    parser.add_argument('--error-status', type=int, default=500)
+    args = parser.parse_args()
+    servers, environment = start_standins(args.latency_ms, args.jitter_ms, args.error_rate, args.error_status)
+    for name, value in environment.items():
+        print(f'{name}={value}')
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        for server in servers.values():
+            server.stop()
+
+
+if __name__ == '__main__':
+    main()
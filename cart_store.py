@@ -0,0 +1,159 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from redis import Redis
+from requests import HTTPError
+
+import async_api_handler
+from api_handler import (add_product_to_card, get_card_items,
+                         remove_cart_item)
+
+logger = logging.getLogger(__name__)
+
+
+class CartStore:
+    '''Carts kept in Redis by chat_id and written through to Moltin in the background.
+
+    Only this bot writes the Moltin carts, so the local copy is the source of
+    truth while browsing: showing a cart costs Redis reads and cached
+    product payloads, no Moltin calls. Every change is replayed against
+    Moltin by a single-threaded executor per chat shard, so a chat's
+    changes reach Moltin in order. :meth:`reconcile` makes the Moltin cart
+    match the local one before money is involved.
+    '''
+
+    def __init__(
+        self,
+        reddisdb: Redis,
+        catalog,
+        moltin_client,
+        moltin_async_client,
+        workers: int = 4,
+        key: str = 'Cart'
+    ):
+        self.reddisdb = reddisdb
+        self.catalog = catalog
+        self.moltin_client = moltin_client
+        self.moltin_async_client = moltin_async_client
+        self.key = key
+        self._executors = [ThreadPoolExecutor(max_workers=1) for _ in range(workers)]
+
+    def quantities_key(self, chat_id) -> str:
+        return f'{self.key}:{chat_id}'
+
+    def item_ids_key(self, chat_id) -> str:
+        return f'{self.key}:{chat_id}:item_ids'
+
+    def add(self, chat_id, product_id: str, quantity: int) -> None:
+        self.reddisdb.hincrby(self.quantities_key(chat_id), product_id, quantity)
+        self._write_through(chat_id, self._add_remote, chat_id, product_id, quantity)
+
+    def remove(self, chat_id, product_id: str) -> None:
+        pipeline = self.reddisdb.pipeline()
+        pipeline.hdel(self.quantities_key(chat_id), product_id)
+        pipeline.hget(self.item_ids_key(chat_id), product_id)
+        pipeline.hdel(self.item_ids_key(chat_id), product_id)
+        _, cart_item_id, _ = pipeline.execute()
+        self._write_through(
+            chat_id,
+            self._remove_remote,
+            chat_id,
+            product_id,
+            cart_item_id.decode() if cart_item_id else None
+        )
+
+    def get_quantities(self, chat_id) -> dict:
+        return {
+            product_id.decode(): int(quantity)
+            for product_id, quantity in self.reddisdb.hgetall(self.quantities_key(chat_id)).items()
+        }
+
+    def get_items(self, chat_id) -> list:
+        '''Cart lines priced from the cached catalog.
+
+        Prices are ``display_price.with_tax.amount`` of the product, in the
+        same units as the formatted prices shown by Moltin. Products deleted
+        from the catalog are dropped from the cart.
+        '''
+        items = []
+        for product_id, quantity in self.get_quantities(chat_id).items():
+            try:
+                product = self.catalog.get_product(product_id).get('data')
+            except HTTPError as err:
+                if err.response is None or err.response.status_code != 404:
+                    raise
+                logger.info(f'Product {product_id} is no longer in the catalog, removed from cart {chat_id}')
+                self.remove(chat_id, product_id)
+                continue
+            unit_price = product.get('meta').get('display_price').get('with_tax').get('amount')
+            items.append({
+                'product_id': product_id,
+                'name': product.get('name'),
+                'quantity': quantity,
+                'unit_price': unit_price,
+                'total_price': unit_price * quantity,
+            })
+        return items
+
+    def get_total(self, chat_id, items=None) -> int:
+        if items is None:
+            items = self.get_items(chat_id)
+        return sum(item['total_price'] for item in items)
+
+    def reconcile(self, chat_id) -> dict:
+        '''Waits for pending writes, fixes any drift in the Moltin cart and returns it.'''
+        # products deleted upstream are dropped first, their removal is queued like any change
+        quantities = {item['product_id']: item['quantity'] for item in self.get_items(chat_id)}
+        self._executor(chat_id).submit(lambda: None).result()
+        remote_items = get_card_items(chat_id, self.moltin_client).get('data')
+        remote_by_product = {item.get('product_id'): item for item in remote_items}
+        fixes = []
+        for product_id, item in remote_by_product.items():
+            if product_id not in quantities:
+                fixes.append(async_api_handler.remove_cart_item(chat_id, item.get('id'), self.moltin_async_client))
+            elif item.get('quantity') != quantities[product_id]:
+                fixes.append(async_api_handler.update_cart_item(
+                    chat_id, item.get('id'), quantities[product_id], self.moltin_async_client
+                ))
+        for product_id, quantity in quantities.items():
+            if product_id not in remote_by_product:
+                fixes.append(async_api_handler.add_product_to_card(
+                    chat_id, product_id, self.moltin_async_client, quantity
+                ))
+        if fixes:
+            logger.info(f'Cart {chat_id} drifted from Moltin, applying {len(fixes)} fixes')
+            self.moltin_async_client.gather(*fixes)
+            self._store_item_ids(chat_id, get_card_items(chat_id, self.moltin_client).get('data'))
+        return self.moltin_async_client.run(async_api_handler.get_card(chat_id, self.moltin_async_client))
+
+    def _executor(self, chat_id) -> ThreadPoolExecutor:
+        return self._executors[hash(chat_id) % len(self._executors)]
+
+    def _write_through(self, chat_id, function, *args) -> None:
+        self._executor(chat_id).submit(self._run_logged, function, *args)
+
+    def _run_logged(self, function, *args) -> None:
+        try:
+            function(*args)
+        except Exception as err:
+            # the cart is reconciled at checkout, a lost write is fixed there
+            logger.warning(f'Cart write-through {function.__name__}{args} failed: {err}')
+
+    def _add_remote(self, chat_id, product_id: str, quantity: int) -> None:
+        cart_items = add_product_to_card(chat_id, product_id, self.moltin_client, quantity)
+        self._store_item_ids(chat_id, cart_items.get('data'))
+
+    def _remove_remote(self, chat_id, product_id: str, cart_item_id) -> None:
+        if cart_item_id is None:
+            remote_items = get_card_items(chat_id, self.moltin_client).get('data')
+            cart_item_id = next(
+                (item.get('id') for item in remote_items if item.get('product_id') == product_id),
+                None
+            )
+        if cart_item_id is not None:
+            remove_cart_item(chat_id, cart_item_id, self.moltin_client)
+
+    def _store_item_ids(self, chat_id, cart_items) -> None:
+        item_ids = {item.get('product_id'): item.get('id') for item in cart_items if item.get('product_id')}
+        if item_ids:
+            self.reddisdb.hset(self.item_ids_key(chat_id), mapping=item_ids)
@@ -0,0 +1,165 @@
+import json
+import logging
+import threading
+import time
+
+from requests import HTTPError
+
+from api_handler import get_all_pages, get_product
+from single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = 'catalog_invalidate'
+
+
+class CatalogCache:
+    '''In-process cache of the Moltin catalog with stale-while-revalidate.
+
+    Only the very first read of an entry waits for Moltin. Once an entry is
+    older than ``ttl`` seconds it is still returned immediately and a
+    background thread fetches a fresh copy. ``version`` is bumped every time
+    the product list changes, so derived data (menu keyboards) can tell
+    when to rebuild. Reads of the same entry missing at the same time go
+    to Moltin once, through ``single_flight``.
+    '''
+
+    def __init__(self, moltin_client, ttl: float = 300, single_flight: SingleFlight = None):
+        self.moltin_client = moltin_client
+        self.ttl = ttl
+        self.single_flight = single_flight or SingleFlight()
+        self.version = 0
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'stale_hits': 0,
+            'misses': 0,
+            'refreshes': 0,
+            'refresh_errors': 0,
+            'invalidations': 0,
+        }
+
+    def get_all_products(self):
+        return self._get('products', self._load_products)
+
+    def get_product(self, product_id: str):
+        return self._get(
+            ('product', product_id),
+            lambda: get_product(product_id, self.moltin_client)
+        )
+
+    def warm(self) -> None:
+        '''Loads the product list so the first /start does not wait for Moltin.'''
+        self.get_all_products()
+
+    def invalidate(self, product_ids=None) -> None:
+        '''Marks cached entries stale and refreshes the product list in the background.
+
+        Without ``product_ids`` the whole catalog is marked stale; stale
+        products are re-fetched on their next read, still without blocking.
+        '''
+        with self._lock:
+            self._stats['invalidations'] += 1
+            if product_ids is None:
+                keys = list(self._entries)
+            else:
+                keys = ['products'] + [('product', product_id) for product_id in product_ids]
+            for key in keys:
+                if key in self._entries:
+                    value, _ = self._entries[key]
+                    self._entries[key] = (value, float('-inf'))
+        # a result shared by another worker may predate the change
+        self.single_flight.forget(*(self._flight_key(key) for key in keys))
+        if 'products' in self._entries:
+            self._schedule_refresh('products', self._load_products)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), version=self.version)
+
+    def listen(self, redis_db, channel: str = INVALIDATION_CHANNEL):
+        '''Subscribes to invalidations published by :func:`publish_invalidation`.'''
+        pubsub = redis_db.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{channel: self._handle_invalidation_message})
+        return pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def _handle_invalidation_message(self, message) -> None:
+        product_ids = json.loads(message['data'])
+        self.invalidate(product_ids)
+
+    def _get(self, key, loader):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+            elif time.monotonic() - entry[1] > self.ttl:
+                self._stats['stale_hits'] += 1
+            else:
+                self._stats['hits'] += 1
+                return entry[0]
+        if entry is None:
+            value = self._load(key, loader)
+            self._store(key, value)
+            return value
+        self._schedule_refresh(key, loader)
+        return entry[0]
+
+    def _load_products(self):
+        # every page, in the shape of a single /v2/products answer
+        return {'data': get_all_pages('/v2/products', self.moltin_client)}
+
+    def _flight_key(self, key) -> str:
+        return 'catalog:' + (key if isinstance(key, str) else ':'.join(key))
+
+    def _load(self, key, loader):
+        return self.single_flight.do(self._flight_key(key), loader)
+
+    def _store(self, key, value) -> None:
+        with self._lock:
+            previous = self._entries.get(key)
+            self._entries[key] = (value, time.monotonic())
+            if key != 'products':
+                return
+            # products gone from the list are dropped, a read of one goes to Moltin again
+            product_ids = {product.get('id') for product in value.get('data') or []}
+            for entry_key in list(self._entries):
+                if isinstance(entry_key, tuple) and entry_key[1] not in product_ids:
+                    del self._entries[entry_key]
+            if previous is None or previous[0] != value:
+                self.version += 1
+
+    def _schedule_refresh(self, key, loader) -> None:
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        threading.Thread(target=self._refresh, args=(key, loader), daemon=True).start()
+
+    def _refresh(self, key, loader) -> None:
+        try:
+            value = self._load(key, loader)
+        except HTTPError as err:
+            with self._lock:
+                self._stats['refresh_errors'] += 1
+                if err.response is not None and err.response.status_code == 404:
+                    # deleted upstream, the next read fails instead of serving the old product
+                    self._entries.pop(key, None)
+            logger.warning(f'Catalog refresh of {key} failed: {err}')
+        except Exception as err:
+            with self._lock:
+                self._stats['refresh_errors'] += 1
+            logger.warning(f'Catalog refresh of {key} failed, serving stale data: {err}')
+        else:
+            self._store(key, value)
+            with self._lock:
+                self._stats['refreshes'] += 1
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+
+def publish_invalidation(redis_db, product_ids=None, channel: str = INVALIDATION_CHANNEL) -> None:
+    '''Tells every running bot process to invalidate its catalog cache.'''
+    redis_db.publish(channel, json.dumps(product_ids))
@@ -0,0 +1,33 @@
+from typing import Optional
+
+from redis import Redis
+
+
+class FileIdCache:
+    '''Telegram ``file_id`` of every product image that was already uploaded.
+
+    Stored in one Redis hash keyed by the Moltin image id, so all bot
+    workers reuse each other's uploads.
+    '''
+
+    def __init__(self, reddisdb: Redis, key: str = 'TelegramFileIds'):
+        self.reddisdb = reddisdb
+        self.key = key
+        self._stats = {'hits': 0, 'misses': 0}
+
+    def get(self, image_id: str) -> Optional[str]:
+        file_id = self.reddisdb.hget(self.key, image_id)
+        if file_id is None:
+            self._stats['misses'] += 1
+            return None
+        self._stats['hits'] += 1
+        return file_id.decode()
+
+    def set(self, image_id: str, file_id: str) -> None:
+        self.reddisdb.hset(self.key, image_id, file_id)
+
+    def delete(self, image_id: str) -> None:
+        self.reddisdb.hdel(self.key, image_id)
+
+    def get_stats(self) -> dict:
+        return dict(self._stats)
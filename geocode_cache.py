@@ -0,0 +1,90 @@
+import hashlib
+import json
+import re
+import threading
+
+from redis import Redis
+
+from api_handler import fetch_coordinates
+
+# spelled-out and short forms collapse into one spelling, filler words are dropped
+ADDRESS_ABBREVIATIONS = {
+    'ул': 'улица',
+    'пр': 'проспект',
+    'пр-т': 'проспект',
+    'просп': 'проспект',
+    'пер': 'переулок',
+    'пл': 'площадь',
+    'ш': 'шоссе',
+    'наб': 'набережная',
+    'б-р': 'бульвар',
+    'бул': 'бульвар',
+    'г': 'город',
+    'к': 'корпус',
+    'корп': 'корпус',
+    'стр': 'строение',
+    'д': '',
+    'дом': '',
+}
+
+
+def normalize_address(address: str) -> str:
+    '''Lower-cases the address, strips punctuation and unifies common abbreviations.
+
+    "ул. Ленина, д. 1" and "улица  ленина 1" give the same string.
+    '''
+    words = re.findall(r'[\w-]+', address.lower().replace('ё', 'е'))
+    normalized = (ADDRESS_ABBREVIATIONS.get(word, word) for word in words)
+    return ' '.join(word for word in normalized if word)
+
+
+class GeocodeCache:
+    '''Yandex geocoder answers cached in Redis by normalized address.
+
+    Found places are kept for ``ttl`` seconds, addresses the geocoder could
+    not resolve for ``negative_ttl`` seconds, so a typo does not hit the
+    metered API on every retry.
+    '''
+
+    def __init__(
+        self,
+        reddisdb: Redis,
+        geocoder_client,
+        apikey: str,
+        ttl: int = 30 * 24 * 60 * 60,
+        negative_ttl: int = 60 * 60,
+        key: str = 'Geocode'
+    ):
+        self.reddisdb = reddisdb
+        self.geocoder_client = geocoder_client
+        self.apikey = apikey
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.key = key
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'negative_hits': 0, 'misses': 0}
+
+    def cache_key(self, address: str) -> str:
+        digest = hashlib.sha1(normalize_address(address).encode()).hexdigest()
+        return f'{self.key}:{digest}'
+
+    def fetch_coordinates(self, address: str):
+        '''Same result as :func:`api_handler.fetch_coordinates`, served from Redis when possible.'''
+        cache_key = self.cache_key(address)
+        cached = self.reddisdb.get(cache_key)
+        if cached is not None:
+            place = json.loads(cached)
+            self._count('hits' if place else 'negative_hits')
+            return place
+        self._count('misses')
+        place = fetch_coordinates(self.apikey, address, self.geocoder_client)
+        self.reddisdb.set(cache_key, json.dumps(place), ex=self.ttl if place else self.negative_ttl)
+        return place
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            self._stats[counter] += 1
@@ -2,9 +2,11 @@ import requests
 from dotenv import load_dotenv
 import os
 
+from api_client import MOLTIN_API_URL
 
-def get_access_token(client_id: str, client_secret: str):
-    url = 'https://api.moltin.com/oauth/access_token'
+
+def get_access_token(client_id: str, client_secret: str, base_url: str = MOLTIN_API_URL):
+    url = f'{base_url}/oauth/access_token'
     data = {
         'client_id': client_id,
         'client_secret': client_secret,
@@ -20,4 +22,8 @@ if __name__ == '__main__':
     load_dotenv()
     el_path_client_id = os.getenv('ELASTICPATH_CLIENT_ID')
     el_path_client_secret = os.getenv('ELASTICPATH_CLIENT_SECRET')
-    print(get_access_token(el_path_client_id, el_path_client_secret))
+    print(get_access_token(
+        el_path_client_id,
+        el_path_client_secret,
+        os.getenv('MOLTIN_API_URL', MOLTIN_API_URL)
+        ))
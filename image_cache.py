@@ -0,0 +1,190 @@
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from api_handler import download_file, get_file_url
+from single_flight import SingleFlight
+
+# a temporary file older than this was left behind by a crashed worker
+TEMPORARY_FILE_GRACE = 600
+
+
+def write_atomically(path: str, data: bytes) -> None:
+    '''Readers in any process see either no file or the whole of it.'''
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    descriptor, temporary_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            file.write(data)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+def resize_image(content: bytes, max_side: int) -> bytes:
+    '''Shrinks the image to fit ``max_side``, Pillow is only imported when resizing is on.'''
+    from PIL import Image
+
+    with Image.open(io.BytesIO(content)) as image:
+        if max(image.size) <= max_side:
+            return content
+        image.thumbnail((max_side, max_side))
+        output = io.BytesIO()
+        image.convert('RGB').save(output, format='JPEG', quality=85, optimize=True)
+        return output.getvalue()
+
+
+class ImageCache:
+    '''Product images kept on disk, bounded to ``max_bytes``.
+
+    Files are stored once per content under ``objects/`` by their sha256,
+    ``index/<image id>.json`` remembers which object an image id points
+    to, its CDN url and the ETag and Last-Modified it came with. An image
+    checked less than ``max_age`` seconds ago is served without any
+    request, an older one is revalidated with a conditional GET. Every
+    file is written to a temporary name and renamed, so bot workers can
+    share the directory. The least recently used objects are deleted
+    once the directory outgrows ``max_bytes``.
+
+    With ``max_side`` images are shrunk to fit it before they are stored,
+    which needs Pillow.
+    '''
+
+    def __init__(
+        self,
+        path: str = './image_cache',
+        max_bytes: int = 200 * 1024 * 1024,
+        max_age: float = 3600,
+        max_side: int = None,
+        single_flight: SingleFlight = None
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_side = max_side
+        self.single_flight = single_flight or SingleFlight()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'revalidated': 0, 'downloads': 0, 'evictions': 0}
+
+    def get_path(self, image_id: str, client) -> str:
+        '''Path of the image file, downloaded only when missing or changed.'''
+        entry = self._read_entry(image_id)
+        object_path = self._object_path(entry) if entry else None
+        if object_path and time.time() - entry['checked_at'] < self.max_age and self._touch(object_path):
+            self._count('hits')
+            return object_path
+        return self.single_flight.do(f'image:{image_id}', lambda: self._fetch(image_id, client))
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def _fetch(self, image_id: str, client) -> str:
+        entry = self._read_entry(image_id)
+        headers = {}
+        if entry and self._touch(self._object_path(entry)):
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        file_url = entry['url'] if entry else get_file_url(image_id, client)
+        response = download_file(file_url, client, headers)
+        if response.status_code == 304:
+            self._count('revalidated')
+            entry['checked_at'] = time.time()
+            self._write_entry(image_id, entry)
+            return self._object_path(entry)
+        self._count('downloads')
+        content = response.content
+        _, extension = os.path.splitext(file_url.split('?')[0])
+        if self.max_side:
+            resized_content = resize_image(content, self.max_side)
+            if resized_content is not content:
+                content, extension = resized_content, '.jpg'
+        entry = {
+            'digest': hashlib.sha256(content).hexdigest(),
+            'extension': extension.lower(),
+            'url': file_url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'checked_at': time.time(),
+        }
+        object_path = self._object_path(entry)
+        if not os.path.exists(object_path):
+            write_atomically(object_path, content)
+            self._evict(keep=object_path)
+        else:
+            self._touch(object_path)
+        self._write_entry(image_id, entry)
+        return object_path
+
+    def _evict(self, keep: str) -> None:
+        objects = []
+        now = time.time()
+        for directory, _, names in os.walk(os.path.join(self.path, 'objects')):
+            for name in names:
+                object_path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(object_path)
+                except FileNotFoundError:
+                    continue
+                if name.endswith('.tmp'):
+                    # another worker may still be writing it
+                    if now - stat.st_mtime > TEMPORARY_FILE_GRACE:
+                        self._remove(object_path)
+                    continue
+                objects.append((stat.st_mtime, stat.st_size, object_path))
+        total = sum(size for _, size, _ in objects)
+        for _, size, object_path in sorted(objects):
+            if total <= self.max_bytes:
+                break
+            if object_path == keep:
+                continue
+            self._remove(object_path)
+            total -= size
+            self._count('evictions')
+        # index entries of evicted objects are found missing and re-downloaded
+
+    def _remove(self, path: str) -> None:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            # another worker removed it first
+            pass
+
+    def _object_path(self, entry: dict) -> str:
+        digest = entry['digest']
+        return os.path.join(self.path, 'objects', digest[:2], f'{digest}{entry["extension"]}')
+
+    def _entry_path(self, image_id: str) -> str:
+        name = re.sub(r'[^\w-]', '_', image_id)
+        return os.path.join(self.path, 'index', f'{name}.json')
+
+    def _read_entry(self, image_id: str):
+        try:
+            with open(self._entry_path(image_id), 'r') as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_entry(self, image_id: str, entry: dict) -> None:
+        write_atomically(self._entry_path(image_id), json.dumps(entry).encode())
+
+    def _touch(self, object_path: str) -> bool:
+        '''Marks the object as recently used, False if it was evicted.'''
+        try:
+            os.utime(object_path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            self._stats[counter] += 1
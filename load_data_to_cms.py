@@ -1,76 +1,427 @@
+'''Imports the menu and the pizzeria addresses into Elastic Path.
+
+Products are matched by SKU and pizzerias by address, so the import can
+be re-run at any time: it only creates what is missing and links images
+to products that have none.
+
+With ``--sync`` only the menu is brought in line with the file: changed
+products are updated, removed ones deleted, and a manifest of content
+hashes lets unchanged products be skipped without asking Elastic Path.
+'''
+import argparse
+import hashlib
 import json
+import logging
 import os
-from time import sleep
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
 
+import redis
+import requests
 from dotenv import load_dotenv
 
+from api_client import MOLTIN_API_URL, create_moltin_client
 from api_handler import (create_entry, create_file, create_flow,
-                         create_flows_field, create_product, link_main_image)
+                         create_flows_field, create_product, delete_file,
+                         delete_product, get_all_pages, get_flow_fields,
+                         get_flows, link_main_image, make_product_description,
+                         update_product)
+from catalog_cache import publish_invalidation
 from get_access_token import get_access_token
+from slugs import (SlugRegistry, TranslatedSlugs, dump_json, load_json,
+                   make_slug)
 
-if __name__ == '__main__':
-    load_dotenv()
+logger = logging.getLogger(__name__)
+
+# a 429 is refused before anything is done, so even a create is safe to repeat
+CREATE_RETRY_STATUSES = {429}
+# a gateway may answer 503 after the request went through, fine for reads, updates and deletes
+RETRY_STATUSES = {429, 503}
+PIZZERIA_FLOW = ('Pizzeria', 'Flow for pizzeria')
+PIZZERIA_FIELDS = [
+    ('Address', 'Pizzeria addres'),
+    ('Alias', 'Alias in Russian'),
+    ('Longitude', 'Longitude coordinates'),
+    ('Latitude', 'Latitude coordinates'),
+]
+
+
+def parse_retry_after(value):
+    '''Seconds to wait from a Retry-After header, given in seconds or as a date.'''
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    '''Retries calls Moltin refused with 429 or 503, honouring Retry-After.
+
+    A 429 pauses every worker sharing the limiter until the requested time,
+    instead of each of them running into the limit again on its own.
+    Without Retry-After the delay grows exponentially with jitter. Creates
+    go through :meth:`create`, which retries only a 429, so a 503 that
+    came after the object was made does not make a duplicate.
+    '''
+
+    def __init__(self, max_retries: int = 5, backoff: float = 1):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.retries = 0
+        self._resume_at = 0
+        self._lock = threading.Lock()
+
+    def pause(self, delay: float) -> None:
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + delay)
+
+    def wait(self) -> None:
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def call(self, function, *args, **kwargs):
+        return self._call(RETRY_STATUSES, function, args, kwargs)
+
+    def create(self, function, *args, **kwargs):
+        return self._call(CREATE_RETRY_STATUSES, function, args, kwargs)
+
+    def _call(self, retry_statuses, function, args, kwargs):
+        for attempt in range(self.max_retries + 1):
+            self.wait()
+            try:
+                return function(*args, **kwargs)
+            except requests.HTTPError as err:
+                response = err.response
+                if response is None or response.status_code not in retry_statuses or attempt == self.max_retries:
+                    raise
+                delay = parse_retry_after(response.headers.get('Retry-After'))
+                if delay is None:
+                    delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                logger.info(f'{function.__name__} got {response.status_code}, retrying in {delay:.1f}s')
+                with self._lock:
+                    self.retries += 1
+                if response.status_code == 429:
+                    self.pause(delay)
+                else:
+                    time.sleep(delay)
+
+
+class StageReport:
+    '''Counts outcomes of one import stage and logs its progress and timing.'''
+
+    def __init__(self, name: str, total: int):
+        self.name = name
+        self.total = total
+        self.outcomes = {'created': 0, 'updated': 0, 'deleted': 0, 'skipped': 0, 'failed': 0}
+        self.done = 0
+        self.elapsed = None
+        self.started = time.perf_counter()
+        self._progress_step = max(1, total // 10)
+
+    def record(self, outcome: str) -> None:
+        self.outcomes[outcome] += 1
+        self.done += 1
+        if self.done % self._progress_step == 0 and self.done < self.total:
+            logger.info(f'{self.name}: {self.done}/{self.total}')
+
+    def finish(self) -> None:
+        self.elapsed = time.perf_counter() - self.started
+        outcomes = ', '.join(f'{count} {outcome}' for outcome, count in self.outcomes.items())
+        logger.info(f'{self.name}: {self.total} in {self.elapsed:.1f}s ({outcomes})')
+
+
+def run_stage(name, items, task, workers, describe=str) -> StageReport:
+    report = StageReport(name, len(items))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(task, item): item for item in items}
+        for future in as_completed(futures):
+            try:
+                outcome = future.result()
+            except Exception as err:
+                logger.warning(f'{name}: {describe(futures[future])} failed: {err}')
+                outcome = 'failed'
+            report.record(outcome)
+    report.finish()
+    return report
+
+
+def ensure_pizzeria_flow(client, limiter) -> str:
+    '''Creates the pizzeria flow and its fields unless they exist, returns the flow slug.'''
+    name, description = PIZZERIA_FLOW
+    flows = limiter.call(get_flows, client)['data']
+    flow = next((flow for flow in flows if flow['slug'] == name.lower()), None)
+    if flow is None:
+        flow = limiter.create(create_flow, name=name, description=description, client=client)['data']
+    existing_fields = {field['slug'] for field in limiter.call(get_flow_fields, flow['id'], client)['data']}
+    for field_name, field_description in PIZZERIA_FIELDS:
+        if field_name.lower() not in existing_fields:
+            limiter.create(
+                create_flows_field,
+                flow_id=flow['id'],
+                field_name=field_name,
+                field_type='string',
+                description=field_description,
+                client=client
+            )
+    return flow['slug']
+
+
+def import_product(product, existing_products, slug_registry, client, limiter) -> str:
+    existing_product = existing_products.get(str(product['id']))
+    if existing_product is None:
+        slug = slug_registry.get(product['name'])
+        product_id = limiter.create(create_product, product, client, slug=slug)['data']['id']
+    elif (existing_product.get('relationships') or {}).get('main_image'):
+        return 'skipped'
+    else:
+        product_id = existing_product['id']
+    image_id = limiter.create(create_file, product, client)['data']['id']
+    limiter.call(link_main_image, product_id, image_id, client)
+    return 'created' if existing_product is None else 'updated'
+
+
+def import_address(address, flow_slug, existing_addresses, client, limiter) -> str:
+    if address['address']['full'] in existing_addresses:
+        return 'skipped'
+    limiter.create(
+        create_entry,
+        flow_slug,
+        'address',
+        address['address']['full'],
+        'alias',
+        address['alias'],
+        'latitude',
+        address['coordinates']['lat'],
+        'longitude',
+        address['coordinates']['lon'],
+        client
+    )
+    return 'created'
+
+
+def get_product_fields(product) -> dict:
+    '''The product fields as they end up in Elastic Path, the ones a sync compares.'''
+    return {
+        'name': product['name'],
+        'description': make_product_description(product),
+        'price': product['price'],
+        'image_url': product['product_image']['url'],
+    }
+
+
+def hash_product(product) -> str:
+    fields = json.dumps(get_product_fields(product), ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(fields.encode()).hexdigest()
+
+
+def sync_product(product, catalog_product, manifest_products, slug_registry, changed_ids, client, limiter) -> str:
+    sku = str(product['id'])
+    fields = get_product_fields(product)
+    manifest_entry = manifest_products.get(sku)
+    outcome = 'skipped'
+    if catalog_product is None:
+        slug = slug_registry.get(product['name'])
+        product_id = limiter.create(create_product, product, client, slug=slug)['data']['id']
+        main_image = None
+        outcome = 'created'
+    else:
+        product_id = catalog_product['id']
+        catalog_price = (catalog_product.get('price') or [{}])[0].get('amount')
+        catalog_fields = (catalog_product.get('name'), catalog_product.get('description'), catalog_price)
+        if catalog_fields != (fields['name'], fields['description'], fields['price']):
+            limiter.call(update_product, product_id, product, client)
+            outcome = 'updated'
+        main_image = ((catalog_product.get('relationships') or {}).get('main_image') or {}).get('data')
+    # without a manifest entry the source of the linked image is unknown, it is kept
+    image_changed = manifest_entry is not None and manifest_entry.get('image_url') != fields['image_url']
+    if main_image is None or image_changed:
+        image_id = limiter.create(create_file, product, client)['data']['id']
+        limiter.call(link_main_image, product_id, image_id, client)
+        if main_image is not None:
+            limiter.call(delete_file, main_image['id'], client)
+        if outcome == 'skipped':
+            outcome = 'updated'
+    manifest_products[sku] = {
+        'hash': hash_product(product),
+        'product_id': product_id,
+        'image_url': fields['image_url'],
+    }
+    if outcome != 'skipped':
+        changed_ids.append(product_id)
+    return outcome
+
+
+def remove_product(catalog_product, manifest_products, changed_ids, client, limiter) -> str:
+    limiter.call(delete_product, catalog_product['id'], client)
+    manifest_products.pop(catalog_product.get('sku'), None)
+    changed_ids.append(catalog_product['id'])
+    return 'deleted'
+
+
+def create_redis():
+    return redis.Redis(
+        host=os.getenv('REDIS_HOST'),
+        port=os.getenv('REDIS_PORT'),
+        password=os.getenv('REDIS_PASS'),
+        db=int(os.getenv('REDIS_DB', 0))
+        )
+
+
+def connect_moltin(args):
     el_path_client_id = os.getenv('ELASTICPATH_CLIENT_ID')
     el_path_client_secret = os.getenv('ELASTICPATH_CLIENT_SECRET')
-    access_token = get_access_token(el_path_client_id, el_path_client_secret).get('access_token')
-    with open('./data/menu.json', 'r') as file:
-        products = json.load(file)
-    with open('./data/addresses.json', 'r') as file:
-        addresses = json.load(file)
-    flow_resp = create_flow(
-        name='Pizzeria',
-        description='Flow for pizzeria',
-        access_token=access_token,
-        )
-    flow_id = flow_resp['data']['id']
-    flow_slug = flow_resp['data']['slug']
-    address_slug = create_flows_field(
-        flow_id=flow_id,
-        field_name='Address',
-        field_type='string',
-        description='Pizzeria addres',
-        access_token=access_token
-    )['data']['slug']
-    alias_slug = create_flows_field(
-        flow_id=flow_id,
-        field_name='Alias',
-        field_type='string',
-        description='Alias in Russian',
-        access_token=access_token
-    )['data']['slug']
-    long_slug = create_flows_field(
-        flow_id=flow_id,
-        field_name='Longitude',
-        field_type='string',
-        description='Longitude coordinates',
-        access_token=access_token
-    )['data']['slug']
-    lat_slug = create_flows_field(
-        flow_id=flow_id,
-        field_name='Latitude',
-        field_type='string',
-        description='Latitude coordinates',
-        access_token=access_token
-    )['data']['slug']
+    moltin_api_url = os.getenv('MOLTIN_API_URL', MOLTIN_API_URL)
+    access_token = get_access_token(el_path_client_id, el_path_client_secret, moltin_api_url).get('access_token')
+    moltin_client = create_moltin_client(access_token, base_url=moltin_api_url, pool_size=args.workers)
+    return moltin_client, RateLimiter(max_retries=args.max_retries)
+
+
+def prepare_slugs(args, products, catalog_products) -> SlugRegistry:
+    slug_registry = SlugRegistry(
+        args.slug_cache,
+        make_base_slug=TranslatedSlugs() if args.slugs == 'translate' else make_slug
+    )
+    for product in catalog_products.values():
+        if product.get('slug'):
+            slug_registry.reserve(product['slug'], product.get('name'))
+    # assigned in file order, so suffixes of colliding names do not depend on thread timing
     for product in products:
-        try:
-            product_id = create_product(product, access_token)['data']['id']
-            image_id = create_file(product, access_token)['data']['id']
-            link_main_image(product_id, image_id, access_token)
-        except Exception as err:
-            # fix, make logging
-            print(err)
-    for address in addresses:
-        create_entry(
-            flow_slug,
-            address_slug,
-            address['address']['full'],
-            alias_slug,
-            address['alias'],
-            lat_slug,
-            address['coordinates']['lat'],
-            long_slug,
-            address['coordinates']['lon'],
-            access_token
-        )
-        sleep(2)
+        if str(product['id']) not in catalog_products:
+            slug_registry.get(product['name'])
+    return slug_registry
+
+
+def sync_menu(args, products) -> None:
+    started = time.perf_counter()
+    manifest = load_json(args.manifest)
+    manifest_products = manifest.get('products', {})
+    file_skus = {str(product['id']) for product in products}
+    changed_products = [
+        product for product in products
+        if (manifest_products.get(str(product['id'])) or {}).get('hash') != hash_product(product)
+    ]
+    if not changed_products and not set(manifest_products) - file_skus:
+        logger.info(f'menu unchanged since the last sync, {len(products)} products skipped')
+        return
+    moltin_client, limiter = connect_moltin(args)
+    catalog_products = {
+        product.get('sku'): product
+        for product in limiter.call(get_all_pages, '/v2/products', moltin_client)
+    }
+    slug_registry = prepare_slugs(args, changed_products, catalog_products)
+    logger.info(
+        f'{len(changed_products)} of {len(products)} products changed since the last sync, '
+        f'{len(catalog_products)} in the catalog, read in {time.perf_counter() - started:.1f}s'
+    )
+    changed_ids = []
+    run_stage(
+        'changed products',
+        changed_products,
+        lambda product: sync_product(
+            product,
+            catalog_products.get(str(product['id'])),
+            manifest_products,
+            slug_registry,
+            changed_ids,
+            moltin_client,
+            limiter
+        ),
+        args.workers,
+        describe=lambda product: f'product {product["id"]} {product["name"]}'
+    )
+    run_stage(
+        'removed products',
+        [product for sku, product in catalog_products.items() if sku not in file_skus],
+        lambda product: remove_product(product, manifest_products, changed_ids, moltin_client, limiter),
+        args.workers,
+        describe=lambda product: f'product {product.get("sku")} {product.get("name")}'
+    )
+    for sku in set(manifest_products) - file_skus:
+        # removed from the file and already gone from the catalog
+        manifest_products.pop(sku)
+    slug_registry.save()
+    dump_json(args.manifest, {'products': manifest_products})
+    if changed_ids:
+        publish_invalidation(create_redis(), product_ids=changed_ids)
+    logger.info(f'sync finished in {time.perf_counter() - started:.1f}s, {limiter.retries} retries')
+
+
+def import_all(args, products, addresses) -> None:
+    moltin_client, limiter = connect_moltin(args)
+    started = time.perf_counter()
+
+    flow_slug = ensure_pizzeria_flow(moltin_client, limiter)
+    existing_products = {
+        product.get('sku'): product
+        for product in limiter.call(get_all_pages, '/v2/products', moltin_client)
+    }
+    existing_addresses = {
+        entry.get('address')
+        for entry in limiter.call(get_all_pages, f'/v2/flows/{flow_slug}/entries', moltin_client)
+    }
+    slug_registry = prepare_slugs(args, products, existing_products)
+    logger.info(
+        f'flow and existing catalog: {len(existing_products)} products, '
+        f'{len(existing_addresses)} pizzerias in {time.perf_counter() - started:.1f}s'
+    )
+
+    products_report = run_stage(
+        'products',
+        products,
+        lambda product: import_product(product, existing_products, slug_registry, moltin_client, limiter),
+        args.workers,
+        describe=lambda product: f'product {product["id"]} {product["name"]}'
+    )
+    slug_registry.save()
+    if products_report.outcomes['created'] or products_report.outcomes['updated']:
+        publish_invalidation(create_redis())
+    run_stage(
+        'pizzerias',
+        addresses,
+        lambda address: import_address(address, flow_slug, existing_addresses, moltin_client, limiter),
+        args.workers,
+        describe=lambda address: f'pizzeria {address["address"]["full"]}'
+    )
+    logger.info(f'import finished in {time.perf_counter() - started:.1f}s, {limiter.retries} retries')
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--menu', default='./data/menu.json')
+    parser.add_argument('--addresses', default='./data/addresses.json')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent requests to Elastic Path')
+    parser.add_argument('--max-retries', type=int, default=5)
+    parser.add_argument(
+        '--slugs',
+        choices=['translit', 'translate'],
+        default='translit',
+        help='transliterate names offline, or translate them with Google Translate (cached on disk)'
+    )
+    parser.add_argument('--slug-cache', default='./data/slugs.json')
+    parser.add_argument('--sync', action='store_true', help='only bring the menu in line with the file')
+    parser.add_argument('--manifest', default='./data/menu_manifest.json')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    with open(args.menu, 'r') as file:
+        products = list({str(product['id']): product for product in json.load(file)}.values())
+    if args.sync:
+        sync_menu(args, products)
+        return
+    with open(args.addresses, 'r') as file:
+        addresses = list({address['address']['full']: address for address in json.load(file)}.values())
+    import_all(args, products, addresses)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,155 @@
 import logging
+import threading
+import time
+from queue import Empty, Full, Queue
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+MAX_MESSAGE_LENGTH = 4096
+
+
+def pack_messages(entries, max_length: int = MAX_MESSAGE_LENGTH):
+    '''Joins log entries into as few messages of at most ``max_length`` characters as possible.'''
+    messages = []
+    current = ''
+    for entry in entries:
+        while len(entry) > max_length:
+            if current:
+                messages.append(current)
+                current = ''
+            messages.append(entry[:max_length])
+            entry = entry[max_length:]
+        if current and len(current) + 1 + len(entry) > max_length:
+            messages.append(current)
+            current = ''
+        current = f'{current}\n{entry}' if current else entry
+    if current:
+        messages.append(current)
+    return messages
 
 
 class TelegramLogsHandler(logging.Handler):
+    '''Sends log records to a Telegram chat from a background thread.
+
+    :meth:`emit` only puts the formatted record into a queue of at most
+    ``max_queue`` records, records that do not fit are counted and
+    reported in the next message instead. The sender thread joins records
+    into messages of up to 4096 characters, a record waits at most
+    ``flush_interval`` seconds, and keeps ``min_send_interval`` between
+    messages. On a rate limit it waits as long as Telegram asks, on
+    network errors it backs off exponentially, up to ``max_retries`` times.
+    A message Telegram rejects as a bad request is dropped at once.
+    '''
+
+    _STOP = object()
 
-    def __init__(self, tg_bot, chat_id):
+    def __init__(
+        self,
+        tg_bot,
+        chat_id,
+        flush_interval: float = 2,
+        max_queue: int = 1000,
+        min_send_interval: float = 1,
+        max_retries: int = 5,
+        backoff: float = 1
+    ):
         super().__init__()
         self.chat_id = chat_id
         self.tg_bot = tg_bot
+        self.flush_interval = flush_interval
+        self.min_send_interval = min_send_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.queue = Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.sent_messages = 0
+        self.failed_messages = 0
+        self._reported_dropped = 0
+        self._last_sent = 0
+        self._stats_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='TelegramLogsHandler', daemon=True)
+        self._thread.start()
 
     def emit(self, record):
-        log_entry = self.format(record)
-        self.tg_bot.send_message(chat_id=self.chat_id, text=log_entry)
+        try:
+            log_entry = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self.queue.put_nowait(log_entry)
+        except Full:
+            with self._stats_lock:
+                self.dropped += 1
+
+    def close(self, timeout: float = 10):
+        '''Sends what is still queued and stops the sender thread.'''
+        if self._thread.is_alive():
+            try:
+                self.queue.put(self._STOP, timeout=timeout)
+            except Full:
+                pass
+            self._thread.join(timeout)
+        super().close()
+
+    def get_stats(self) -> dict:
+        return {
+            'queued': self.queue.qsize(),
+            'dropped': self.dropped,
+            'sent_messages': self.sent_messages,
+            'failed_messages': self.failed_messages,
+        }
+
+    def _run(self):
+        batch = []
+        batch_length = 0
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                log_entry = self.queue.get(timeout=timeout)
+            except Empty:
+                log_entry = None
+            if log_entry is self._STOP:
+                self._send_batch(batch)
+                return
+            if log_entry is not None:
+                batch.append(log_entry)
+                batch_length += len(log_entry) + 1
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if log_entry is None or batch_length >= MAX_MESSAGE_LENGTH:
+                self._send_batch(batch)
+                batch, batch_length, deadline = [], 0, None
+
+    def _send_batch(self, batch):
+        dropped = self.dropped - self._reported_dropped
+        if dropped:
+            self._reported_dropped += dropped
+            batch = [f'{dropped} log records dropped, the log queue was full'] + batch
+        for message in pack_messages(batch):
+            self._send(message)
+
+    def _send(self, text):
+        wait = self._last_sent + self.min_send_interval - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.tg_bot.send_message(chat_id=self.chat_id, text=text)
+                self.sent_messages += 1
+                self._last_sent = time.monotonic()
+                return
+            except RetryAfter as err:
+                time.sleep(err.retry_after)
+            except BadRequest:
+                # a NetworkError subclass, but sending it again gets the same answer
+                break
+            except NetworkError:
+                time.sleep(delay)
+                delay *= 2
+            except TelegramError:
+                break
+        self.failed_messages += 1
+        self._last_sent = time.monotonic()
@@ -0,0 +1,79 @@
+import threading
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+
+class MenuRenderer:
+    '''Menu keyboards built once per catalog version, returned by page number.
+
+    All pages are rebuilt when :attr:`CatalogCache.version` changes, so a
+    page flip is a list lookup however large the menu is. With ``group_by``
+    (a function of the product payload returning its group title) products
+    are ordered by group, a page never mixes groups and starts with the
+    group title.
+    '''
+
+    def __init__(self, catalog, page_size: int = 5, group_by=None):
+        self.catalog = catalog
+        self.page_size = page_size
+        self.group_by = group_by
+        self._version = None
+        self._pages = []
+        self._lock = threading.Lock()
+
+    def render(self, page: int = 0) -> InlineKeyboardMarkup:
+        # a read past the catalog TTL schedules the refresh that bumps the version
+        self.catalog.get_all_products()
+        pages = self._pages
+        if self._version is None or self._version != self.catalog.version:
+            pages = self.rebuild()
+        return pages[max(0, min(page, len(pages) - 1))]
+
+    def invalidate(self) -> None:
+        self._version = None
+
+    def rebuild(self):
+        with self._lock:
+            # read the version first: a refresh landing in between only causes one extra rebuild
+            version = self.catalog.version
+            products = self.catalog.get_all_products()
+            if self._version == version and self._pages:
+                return self._pages
+            pages = self.build_pages(products.get('data'))
+            self._pages, self._version = pages, version
+            return pages
+
+    def build_pages(self, products):
+        chunks = []
+        if self.group_by is None:
+            groups = [(None, products)]
+        else:
+            grouped = {}
+            for product in products:
+                grouped.setdefault(self.group_by(product), []).append(product)
+            groups = list(grouped.items())
+        for title, group_products in groups:
+            for start in range(0, len(group_products), self.page_size):
+                chunks.append((title, group_products[start:start + self.page_size]))
+        if not chunks:
+            chunks.append((None, []))
+        return [
+            self.build_page(number, len(chunks), title, page_products)
+            for number, (title, page_products) in enumerate(chunks)
+        ]
+
+    def build_page(self, number, pages_count, title, products) -> InlineKeyboardMarkup:
+        keyboard = []
+        if title is not None:
+            keyboard.append([InlineKeyboardButton(title, callback_data=f'pagenext#{number}')])
+        for product in products:
+            keyboard.append([InlineKeyboardButton(product.get('name'), callback_data=product.get('id'))])
+        navigation_keyboard = []
+        if number + 1 < pages_count:
+            navigation_keyboard.append(InlineKeyboardButton('След', callback_data=f'pagenext#{number + 1}'))
+        if number > 0:
+            navigation_keyboard.append(InlineKeyboardButton('Пред', callback_data=f'pageback#{number - 1}'))
+        if navigation_keyboard:
+            keyboard.append(navigation_keyboard)
+        keyboard.append([InlineKeyboardButton('Корзина', callback_data='productcard')])
+        return InlineKeyboardMarkup(keyboard)
@@ -0,0 +1,133 @@
+'''Prometheus metrics of the bot, served as text over HTTP by :func:`start_metrics_server`.
+
+Latencies are histograms whose label values are bound once, when a
+handler or an upstream call is wrapped, so an observation costs a couple
+of microseconds. Cache and write-behind counters the components already
+keep are read only when Prometheus scrapes, through :func:`register_stats`.
+'''
+import asyncio
+import functools
+import time
+
+from prometheus_client import Counter, Histogram, start_http_server
+from prometheus_client.core import REGISTRY, GaugeMetricFamily
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+HANDLER_SECONDS = Histogram(
+    'pizza_bot_handler_seconds',
+    'Time spent in a conversation handler',
+    ['handler'],
+    buckets=LATENCY_BUCKETS
+)
+HANDLER_ERRORS = Counter(
+    'pizza_bot_handler_errors_total',
+    'Exceptions raised by a conversation handler',
+    ['handler']
+)
+UPSTREAM_SECONDS = Histogram(
+    'pizza_bot_upstream_seconds',
+    'Duration of an api_handler call to an upstream API',
+    ['upstream', 'call'],
+    buckets=LATENCY_BUCKETS
+)
+UPSTREAM_ERRORS = Counter(
+    'pizza_bot_upstream_errors_total',
+    'api_handler calls that raised',
+    ['upstream', 'call']
+)
+PERSISTENCE_SECONDS = Histogram(
+    'pizza_bot_persistence_seconds',
+    'Duration of a Redis round-trip of the persistence',
+    ['operation'],
+    buckets=LATENCY_BUCKETS
+)
+UPDATE_DELIVERY_SECONDS = Histogram(
+    'pizza_bot_update_delivery_seconds',
+    'Time from Telegram receiving a message until the dispatcher takes it',
+    buckets=LATENCY_BUCKETS
+)
+
+
+def observe_handler(callback):
+    '''Wraps a handler callback, the label is the name of the (partial's) function.'''
+    name = getattr(callback, 'func', callback).__name__
+    seconds = HANDLER_SECONDS.labels(name)
+    errors = HANDLER_ERRORS.labels(name)
+
+    def observed_callback(update, context):
+        started = time.perf_counter()
+        try:
+            return callback(update, context)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            seconds.observe(time.perf_counter() - started)
+    return observed_callback
+
+
+def observe_upstream(upstream: str):
+    '''Decorator timing an api_handler function, plain or coroutine.'''
+    def decorator(function):
+        seconds = UPSTREAM_SECONDS.labels(upstream, function.__name__)
+        errors = UPSTREAM_ERRORS.labels(upstream, function.__name__)
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def observed_coroutine(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                except Exception:
+                    errors.inc()
+                    raise
+                finally:
+                    seconds.observe(time.perf_counter() - started)
+            return observed_coroutine
+
+        @functools.wraps(function)
+        def observed_function(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                seconds.observe(time.perf_counter() - started)
+        return observed_function
+    return decorator
+
+
+class StatsCollector:
+    '''Exposes the numbers of a component's ``get_stats()`` at scrape time.'''
+
+    def __init__(self, name: str, get_stats):
+        self.name = name
+        self.get_stats = get_stats
+
+    def collect(self):
+        family = GaugeMetricFamily(
+            f'pizza_bot_{self.name}',
+            f'Counters and gauges of the {self.name} get_stats()',
+            labels=['stat']
+        )
+        for stat, value in self.get_stats().items():
+            if isinstance(value, (int, float)):
+                family.add_metric([stat], value)
+        yield family
+
+
+_stats_collectors = {}
+
+
+def register_stats(name: str, get_stats) -> None:
+    '''Exports ``get_stats()`` as ``pizza_bot_<name>{stat="..."}``, replacing an earlier one.'''
+    if name in _stats_collectors:
+        REGISTRY.unregister(_stats_collectors[name])
+    _stats_collectors[name] = StatsCollector(name, get_stats)
+    REGISTRY.register(_stats_collectors[name])
+
+
+def start_metrics_server(port: int, addr: str = '127.0.0.1') -> None:
+    start_http_server(port, addr=addr)
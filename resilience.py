@@ -0,0 +1,113 @@
+'''Circuit breaker and retry policy shared by :mod:`api_client` and :mod:`async_api_client`.'''
+import logging
+import random
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+class CircuitOpenError(requests.ConnectionError):
+    '''Raised instead of calling an upstream whose breaker is open.'''
+
+
+class CircuitBreaker:
+    '''Stops calling an upstream after ``failure_threshold`` failures in a row.
+
+    While the breaker is open every call fails at once with
+    :class:`CircuitOpenError` instead of holding a dispatcher thread for
+    the whole timeout. ``reset_timeout`` seconds later a single trial call
+    is let through: its success closes the breaker, its failure opens it
+    for another ``reset_timeout``. Connection errors, timeouts and 5xx
+    answers are failures, any other answer proves the upstream is alive.
+    '''
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'failures': 0, 'rejected': 0, 'opened': 0}
+
+    def before_call(self) -> None:
+        '''Raises :class:`CircuitOpenError` when the call must not go out.'''
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    self._stats['rejected'] += 1
+                    raise CircuitOpenError(f'{self.name} is unavailable, circuit is open')
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN:
+                if self._trial_running:
+                    self._stats['rejected'] += 1
+                    raise CircuitOpenError(f'{self.name} is unavailable, waiting for the trial call')
+                self._trial_running = True
+            self._stats['calls'] += 1
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.warning(f'Circuit of {self.name} closed')
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial_running = False
+
+    def release(self) -> None:
+        '''Lets another call be the trial, this one ended without telling anything about the upstream.'''
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._stats['failures'] += 1
+            self.failures += 1
+            self._trial_running = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self._stats['opened'] += 1
+                    logger.warning(f'Circuit of {self.name} opened after {self.failures} failures')
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, open=int(self.state != self.CLOSED))
+
+
+class RetryPolicy:
+    '''Bounded retries of idempotent requests with "full jitter" backoff.
+
+    Attempt ``n`` (from 0) waits a random time up to
+    ``min(max_backoff, backoff * 2 ** n)`` seconds, so callers that failed
+    together do not come back together.
+    '''
+
+    def __init__(
+        self,
+        retries: int = 2,
+        backoff: float = 0.2,
+        max_backoff: float = 2,
+        statuses=RETRY_STATUSES,
+        methods=('GET',)
+    ):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = set(statuses)
+        self.methods = set(methods)
+
+    def attempts(self, method: str) -> int:
+        return self.retries + 1 if method in self.methods else 1
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
@@ -0,0 +1,228 @@
+import heapq
+import logging
+import math
+import threading
+import time
+
+from geopy import distance
+
+from api_handler import (EARTH_RADIUS_KM, get_all_pages, get_distances,
+                         parse_coordinates)
+from single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# the ellipsoid and the sphere disagree by less than 0.6%, candidates are
+# taken with this margin so the geodesic refinement never misses a closer one
+SPHERE_ERROR_MARGIN = 1.006
+
+
+def to_unit_vector(lon: float, lat: float):
+    lon, lat = math.radians(lon), math.radians(lat)
+    return (
+        math.cos(lat) * math.cos(lon),
+        math.cos(lat) * math.sin(lon),
+        math.sin(lat),
+    )
+
+
+def chord_to_km(chord: float) -> float:
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+def km_to_chord(km: float) -> float:
+    return 2 * math.sin(min(math.pi / 2, km / (2 * EARTH_RADIUS_KM)))
+
+
+class KDTree:
+    '''3-d tree over points on the unit sphere, queried by chord length.
+
+    The chord between two unit vectors grows monotonically with the
+    great-circle distance, so plain euclidean search gives the nearest
+    points on the sphere without any trigonometry per node.
+    '''
+
+    def __init__(self, points):
+        self.root = self._build(list(enumerate(points)), 0)
+
+    def _build(self, items, depth):
+        if not items:
+            return None
+        axis = depth % 3
+        items.sort(key=lambda item: item[1][axis])
+        middle = len(items) // 2
+        index, point = items[middle]
+        return (
+            point,
+            index,
+            axis,
+            self._build(items[:middle], depth + 1),
+            self._build(items[middle + 1:], depth + 1),
+        )
+
+    def nearest(self, target, k: int):
+        '''Returns up to ``k`` ``(squared chord, index)`` pairs, closest first.'''
+        heap = []
+
+        def visit(node):
+            if node is None:
+                return
+            point, index, axis, left, right = node
+            squared = sum((a - b) ** 2 for a, b in zip(point, target))
+            if len(heap) < k:
+                heapq.heappush(heap, (-squared, index))
+            elif squared < -heap[0][0]:
+                heapq.heapreplace(heap, (-squared, index))
+            offset = target[axis] - point[axis]
+            near, far = (left, right) if offset < 0 else (right, left)
+            visit(near)
+            if len(heap) < k or offset ** 2 < -heap[0][0]:
+                visit(far)
+
+        visit(self.root)
+        return sorted((-squared, index) for squared, index in heap)
+
+    def within(self, target, radius: float):
+        '''Returns indexes of all points closer than ``radius`` chord length.'''
+        found = []
+        squared_radius = radius ** 2
+
+        def visit(node):
+            if node is None:
+                return
+            point, index, axis, left, right = node
+            if sum((a - b) ** 2 for a, b in zip(point, target)) <= squared_radius:
+                found.append(index)
+            offset = target[axis] - point[axis]
+            near, far = (left, right) if offset < 0 else (right, left)
+            visit(near)
+            if offset ** 2 <= squared_radius:
+                visit(far)
+
+        visit(self.root)
+        return found
+
+
+class RestaurantIndex:
+    '''Pizzerias from the Moltin flow, indexed for nearest and radius queries.
+
+    Entries are loaded once and re-read in the background when older than
+    ``ttl`` seconds. Candidates are picked on the sphere through the
+    :class:`KDTree` and only those get an exact geodesic distance, or with
+    ``exact=False`` a vectorized haversine one (see :func:`get_distances`).
+    Workers loading the entries at the same time share one Moltin read
+    through ``single_flight``.
+    '''
+
+    def __init__(
+        self,
+        moltin_client,
+        ttl: float = 600,
+        flow_slug: str = 'pizzeria',
+        single_flight: SingleFlight = None
+    ):
+        self.moltin_client = moltin_client
+        self.ttl = ttl
+        self.flow_slug = flow_slug
+        self.single_flight = single_flight or SingleFlight()
+        self.restaurants = []
+        self.points = parse_coordinates([])
+        self.tree = None
+        self._loaded_at = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def load(self, entries=None) -> None:
+        if entries is None:
+            # Moltin returns 25 entries a page unless told otherwise
+            entries = self.single_flight.do(
+                f'entries:{self.flow_slug}',
+                lambda: get_all_pages(f'/v2/flows/{self.flow_slug}/entries', self.moltin_client)
+            )
+        restaurants = []
+        for entry in entries:
+            try:
+                lon, lat = float(entry['longitude']), float(entry['latitude'])
+            except (KeyError, TypeError, ValueError):
+                logger.warning(f'Pizzeria entry {entry.get("id")} has no valid coordinates, skipped')
+                continue
+            restaurants.append({
+                'address': entry['address'],
+                'coordinates': (entry['longitude'], entry['latitude']),
+                'point': (lon, lat),
+            })
+        points = parse_coordinates([restaurant['point'] for restaurant in restaurants])
+        tree = KDTree([to_unit_vector(*restaurant['point']) for restaurant in restaurants])
+        with self._lock:
+            self.restaurants, self.points, self.tree = restaurants, points, tree
+            self._loaded_at = time.monotonic()
+
+    def nearest(self, coordinates, k: int = 1, exact: bool = True):
+        '''Returns the ``k`` restaurants closest to ``(lon, lat)``, closest first.'''
+        restaurants, points, tree = self._current()
+        if not restaurants:
+            return []
+        lon, lat = map(float, coordinates)
+        target = to_unit_vector(lon, lat)
+        candidates = tree.nearest(target, k)
+        # anything within the margin of the k-th candidate may still win on the ellipsoid
+        horizon = chord_to_km(math.sqrt(candidates[-1][0])) * SPHERE_ERROR_MARGIN
+        indexes = tree.within(target, km_to_chord(horizon))
+        return self._refine(restaurants, points, indexes, coordinates, exact)[:k]
+
+    def within(self, coordinates, radius_km: float, exact: bool = True):
+        '''Returns restaurants closer than ``radius_km`` to ``(lon, lat)``, closest first.'''
+        restaurants, points, tree = self._current()
+        if not restaurants:
+            return []
+        lon, lat = map(float, coordinates)
+        indexes = tree.within(to_unit_vector(lon, lat), km_to_chord(radius_km * SPHERE_ERROR_MARGIN))
+        return [
+            restaurant for restaurant in self._refine(restaurants, points, indexes, coordinates, exact)
+            if restaurant['distance'] <= radius_km
+        ]
+
+    def _refine(self, restaurants, points, indexes, coordinates, exact):
+        lon, lat = map(float, coordinates)
+        if exact:
+            distances = [
+                distance.distance((lat, lon), tuple(reversed(restaurants[index]['point']))).km
+                for index in indexes
+            ]
+        else:
+            distances = get_distances((lon, lat), points[indexes]).tolist()
+        refined = []
+        for index, restaurant_distance in zip(indexes, distances):
+            restaurant = restaurants[index]
+            refined.append({
+                'restuarant': restaurant['address'],
+                'distance': restaurant_distance,
+                'coordinates': restaurant['coordinates'],
+                'user_coordinates': coordinates,
+            })
+        refined.sort(key=lambda restaurant: restaurant['distance'])
+        return refined
+
+    def _current(self):
+        if self._loaded_at is None:
+            self.load()
+        elif time.monotonic() - self._loaded_at > self.ttl:
+            self._schedule_refresh()
+        with self._lock:
+            return self.restaurants, self.points, self.tree
+
+    def _schedule_refresh(self) -> None:
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh, daemon=True).start()
+
+    def _refresh(self) -> None:
+        try:
+            self.load()
+        except Exception as err:
+            logger.warning(f'Pizzeria index refresh failed, serving stale data: {err}')
+        finally:
+            with self._lock:
+                self._refreshing = False
@@ -0,0 +1,119 @@
+import json
+import pickle
+import zlib
+
+FORMAT_MAGIC = b'PZ'
+FORMAT_VERSION = 1
+FLAG_ZLIB = 1
+
+
+def loads(data: bytes, allow_pickle: bool = True):
+    '''Decodes a value written by any serializer of this module.
+
+    Data without the format header is pickle, either legacy state written
+    before the serializers existed or :class:`PickleSerializer` output.
+    It is only unpickled with ``allow_pickle``, as unpickling can run code.
+    '''
+    if not data.startswith(FORMAT_MAGIC):
+        if not allow_pickle:
+            raise ValueError(
+                'Persisted state is pickle, which this serializer does not read, '
+                'set PERSISTENCE_ALLOW_PICKLE=1 while switching from pickle to json'
+            )
+        return pickle.loads(data)
+    version, flags = data[2], data[3]
+    if version > FORMAT_VERSION:
+        raise ValueError(f'Persisted state has format version {version}, this code reads up to {FORMAT_VERSION}')
+    payload = data[4:]
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+    return json.loads(payload, object_hook=decode_json_object)
+
+
+PLAIN_TYPES = (str, int, float, bool, type(None))
+
+
+class SerializationError(TypeError):
+    '''A value the configured format cannot store.'''
+
+
+def encode_json(value, path: str = 'value'):
+    '''Turns tuples, sets and dicts with non-string keys into tagged JSON values.
+
+    Anything else raises :class:`SerializationError` naming where in the
+    value it was found.
+    '''
+    if isinstance(value, PLAIN_TYPES):
+        return value
+    if isinstance(value, dict):
+        if all(type(key) is str for key in value):
+            return {key: encode_json(item, f'{path}[{key!r}]') for key, item in value.items()}
+        return {'__dict__': [
+            [encode_json(key, f'{path} key {key!r}'), encode_json(item, f'{path}[{key!r}]')]
+            for key, item in value.items()
+        ]}
+    if isinstance(value, list):
+        return [encode_json(item, f'{path}[{index}]') for index, item in enumerate(value)]
+    if isinstance(value, tuple):
+        return {'__tuple__': [encode_json(item, f'{path}[{index}]') for index, item in enumerate(value)]}
+    if isinstance(value, (set, frozenset)):
+        return {'__set__': [encode_json(item, f'{path} item') for item in value]}
+    raise SerializationError(
+        f'{path} is a {type(value).__name__}, which PERSISTENCE_FORMAT=json cannot store, '
+        'convert it to plain types or use PERSISTENCE_FORMAT=pickle'
+    )
+
+
+def decode_json_object(value: dict):
+    '''``object_hook`` restoring the values tagged by :func:`encode_json`.'''
+    if len(value) == 1:
+        if '__tuple__' in value:
+            return tuple(value['__tuple__'])
+        if '__dict__' in value:
+            return {key: item for key, item in value['__dict__']}
+        if '__set__' in value:
+            return set(value['__set__'])
+    return value
+
+
+class PickleSerializer:
+    '''The original format: plain pickle, no header.'''
+
+    def dumps(self, value) -> bytes:
+        return pickle.dumps(value)
+
+    def loads(self, data: bytes):
+        return loads(data)
+
+
+class JsonSerializer:
+    '''Compact JSON behind a ``PZ<version><flags>`` header.
+
+    Payloads longer than ``compress_threshold`` bytes are zlib-compressed.
+    Unlike pickle, the stored state does not depend on class paths of the
+    running code and cannot execute anything when read. Pickled state is
+    refused unless ``allow_pickle`` is set, which lets a bot switching
+    from pickle read its old state until everything is rewritten as JSON.
+    '''
+
+    def __init__(self, compress_threshold: int = 512, compress_level: int = 6, allow_pickle: bool = False):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.allow_pickle = allow_pickle
+
+    def dumps(self, value) -> bytes:
+        payload = json.dumps(encode_json(value), ensure_ascii=False, separators=(',', ':')).encode()
+        flags = 0
+        if self.compress_threshold is not None and len(payload) > self.compress_threshold:
+            payload = zlib.compress(payload, self.compress_level)
+            flags |= FLAG_ZLIB
+        return FORMAT_MAGIC + bytes((FORMAT_VERSION, flags)) + payload
+
+    def loads(self, data: bytes):
+        return loads(data, self.allow_pickle)
+
+
+SERIALIZERS = {
+    'pickle': PickleSerializer,
+    'json': JsonSerializer,
+}
@@ -0,0 +1,174 @@
+import json
+import logging
+import multiprocessing
+import threading
+import time
+import zlib
+
+from redis import Redis
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+
+def get_shard(chat_id, shards: int) -> int:
+    '''Shard of a chat, the same in every process and after restarts.'''
+    return zlib.crc32(str(chat_id).encode()) % shards
+
+
+def get_update_chat_id(update: Update):
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        # pre-checkout queries carry no chat, in a private chat its id is the user's
+        return update.effective_user.id
+    return 0
+
+
+class UpdateRouter:
+    '''Hands updates over to worker shards through one Redis list per shard.
+
+    A chat always lands on the same shard, so its updates are handled in
+    the order Telegram sent them. When a shard has more than
+    ``max_pending`` updates waiting, :meth:`route` blocks until its worker
+    catches up, which stalls the router's own bounded update queue and in
+    turn the webhook.
+    '''
+
+    def __init__(
+        self,
+        reddisdb: Redis,
+        shards: int,
+        max_pending: int = 1000,
+        backoff: float = 0.05,
+        key: str = 'Updates'
+    ):
+        self.reddisdb = reddisdb
+        self.shards = shards
+        self.max_pending = max_pending
+        self.backoff = backoff
+        self.key = key
+
+    def queue_key(self, shard: int) -> str:
+        return f'{self.key}:{shard}'
+
+    def route(self, update: Update) -> int:
+        shard = get_shard(get_update_chat_id(update), self.shards)
+        queue_key = self.queue_key(shard)
+        pending = self.reddisdb.lpush(queue_key, update.to_json())
+        while pending > self.max_pending:
+            time.sleep(self.backoff)
+            pending = self.reddisdb.llen(queue_key)
+        return shard
+
+    def route_update(self, update: Update, context) -> None:
+        '''Handler callback routing every update the router process receives.'''
+        self.route(update)
+
+
+class ShardConsumer:
+    '''Feeds one shard's updates to a dispatcher, one at a time and in order.
+
+    An update is moved to ``<queue>:processing`` while it is handled and
+    removed after, so updates a crashed worker took but did not finish are
+    handled again by the next worker of the shard (at-least-once).
+    '''
+
+    def __init__(
+        self,
+        reddisdb: Redis,
+        dispatcher,
+        shard: int,
+        poll_timeout: int = 1,
+        key: str = 'Updates'
+    ):
+        self.reddisdb = reddisdb
+        self.dispatcher = dispatcher
+        self.shard = shard
+        self.poll_timeout = poll_timeout
+        self.queue_key = f'{key}:{shard}'
+        self.processing_key = f'{key}:{shard}:processing'
+        self.processed = 0
+        self._stopped = threading.Event()
+
+    def requeue_unfinished(self) -> int:
+        requeued = 0
+        # newest first to the consuming end, so the oldest is handled first again
+        while self.reddisdb.lmove(self.processing_key, self.queue_key, 'LEFT', 'RIGHT'):
+            requeued += 1
+        if requeued:
+            logger.warning(f'Shard {self.shard}: {requeued} unfinished updates requeued')
+        return requeued
+
+    def run(self) -> None:
+        self._stopped.clear()
+        self.requeue_unfinished()
+        while not self._stopped.is_set():
+            data = self.reddisdb.blmove(
+                self.queue_key,
+                self.processing_key,
+                self.poll_timeout,
+                src='RIGHT',
+                dest='LEFT'
+            )
+            if data is None:
+                continue
+            update = Update.de_json(json.loads(data), self.dispatcher.bot)
+            self.dispatcher.process_update(update)
+            self.reddisdb.lrem(self.processing_key, 1, data)
+            self.processed += 1
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+class WorkerPool:
+    '''Runs ``target(shard, shards)`` in its own process per shard.
+
+    A process that dies is started again after ``restart_delay`` seconds;
+    the new one reloads the conversations from Redis persistence and
+    continues with the updates queued for its shard meanwhile.
+    '''
+
+    def __init__(self, target, shards: int, restart_delay: float = 1):
+        self.target = target
+        self.shards = shards
+        self.restart_delay = restart_delay
+        self.processes = {}
+        # spawn: the parent holds sockets and threads a forked child must not share
+        self._context = multiprocessing.get_context('spawn')
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        for shard in range(self.shards):
+            self._spawn(shard)
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def _spawn(self, shard: int) -> None:
+        with self._lock:
+            if self._stopped.is_set():
+                return
+            process = self._context.Process(
+                target=self.target,
+                args=(shard, self.shards),
+                name=f'bot-shard-{shard}'
+            )
+            process.start()
+            self.processes[shard] = process
+
+    def _watch(self) -> None:
+        while not self._stopped.wait(self.restart_delay):
+            for shard, process in list(self.processes.items()):
+                if not process.is_alive():
+                    logger.warning(f'Worker of shard {shard} exited with code {process.exitcode}, restarting')
+                    self._spawn(shard)
+
+    def stop(self, timeout: float = 30) -> None:
+        '''Sends SIGTERM to all workers, they finish the current update and flush.'''
+        with self._lock:
+            self._stopped.set()
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join(timeout)
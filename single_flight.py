@@ -0,0 +1,110 @@
+import json
+import threading
+import time
+
+from redis import Redis
+from redis.exceptions import LockError
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    '''Lets concurrent callers asking for the same key share one upstream call.
+
+    The first caller of a key runs the function. Callers that arrive while
+    it runs wait for it and get its result, or its exception. With
+    ``reddisdb`` the workers of other processes are coalesced too: the
+    caller holding the short Redis lock ``<key_prefix>:<key>:lock`` stores
+    the JSON result under ``<key_prefix>:<key>`` for ``result_ttl``
+    seconds and the others read it from there. A worker that waited
+    ``lock_timeout`` seconds without getting a result makes the call itself.
+    '''
+
+    def __init__(
+        self,
+        reddisdb: Redis = None,
+        lock_timeout: float = 10,
+        result_ttl: float = 1,
+        poll_interval: float = 0.05,
+        key_prefix: str = 'SingleFlight'
+    ):
+        self.reddisdb = reddisdb
+        self.lock_timeout = lock_timeout
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self.key_prefix = key_prefix
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'shared': 0, 'shared_between_workers': 0}
+
+    def do(self, key: str, function):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self._stats['shared'] += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = self._call(key, function)
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def forget(self, *keys: str) -> None:
+        '''Drops results shared between workers, so the next call reads upstream.'''
+        if self.reddisdb is not None and keys:
+            self.reddisdb.delete(*(f'{self.key_prefix}:{key}' for key in keys))
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, in_flight=len(self._calls))
+
+    def _call(self, key: str, function):
+        if self.reddisdb is None:
+            self._count('calls')
+            return function()
+        result_key = f'{self.key_prefix}:{key}'
+        lock = self.reddisdb.lock(f'{result_key}:lock', timeout=self.lock_timeout)
+        deadline = time.monotonic() + self.lock_timeout
+        acquired = False
+        while True:
+            shared_result = self.reddisdb.get(result_key)
+            if shared_result is not None:
+                self._count('shared_between_workers')
+                return json.loads(shared_result)
+            acquired = lock.acquire(blocking=False)
+            if acquired or time.monotonic() > deadline:
+                break
+            time.sleep(self.poll_interval)
+        try:
+            self._count('calls')
+            result = function()
+            self.reddisdb.set(result_key, json.dumps(result), px=int(self.result_ttl * 1000))
+            return result
+        finally:
+            if acquired:
+                try:
+                    lock.release()
+                except LockError:
+                    # the call outlived the lock, another worker may own it now
+                    pass
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            self._stats[counter] += 1
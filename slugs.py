@@ -0,0 +1,108 @@
+import json
+import os
+import re
+import threading
+
+CYRILLIC_TO_LATIN = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e',
+    'ж': 'zh', 'з': 'z', 'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm',
+    'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u',
+    'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'shch',
+    'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+}
+
+
+def transliterate(text: str) -> str:
+    return ''.join(CYRILLIC_TO_LATIN.get(char, char) for char in text.lower())
+
+
+def slugify(text: str) -> str:
+    return re.sub(r'[^a-z0-9]+', '-', text.lower()).strip('-')
+
+
+def make_slug(product_name: str) -> str:
+    '''Latin slug of a product name, the same on every run and without network.'''
+    return slugify(transliterate(product_name)) or 'product'
+
+
+def load_json(path: str) -> dict:
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def dump_json(path: str, data: dict) -> None:
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, 'w') as file:
+        json.dump(data, file, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(temporary_path, path)
+
+
+class TranslatedSlugs:
+    '''Slugs from the English translation of the name, the former make_slug.
+
+    Translations are kept in ``cache_path``, so each name goes to Google
+    Translate once. googletrans is only imported when this is used.
+    '''
+
+    def __init__(self, cache_path: str = './data/translations.json', src: str = 'ru'):
+        self.cache_path = cache_path
+        self.src = src
+        self.translations = load_json(cache_path)
+        self._translator = None
+        self._lock = threading.Lock()
+
+    def __call__(self, product_name: str) -> str:
+        with self._lock:
+            if product_name not in self.translations:
+                if self._translator is None:
+                    from googletrans import Translator
+                    self._translator = Translator()
+                self.translations[product_name] = self._translator.translate(product_name, src=self.src).text
+                dump_json(self.cache_path, self.translations)
+            return slugify(self.translations[product_name]) or 'product'
+
+
+class SlugRegistry:
+    '''Slug of every product name, kept in ``path`` between imports.
+
+    A name keeps the slug it got first, even if the slug function changes.
+    Two names with the same slug are told apart by a ``-2``, ``-3``
+    suffix. Slugs already used in the catalog are passed to
+    :meth:`reserve`, so new products never collide with them.
+    '''
+
+    def __init__(self, path: str = './data/slugs.json', make_base_slug=make_slug):
+        self.path = path
+        self.make_base_slug = make_base_slug
+        self.slugs = load_json(path)
+        self.owners = {slug: name for name, slug in self.slugs.items()}
+        self._lock = threading.Lock()
+
+    def reserve(self, slug: str, product_name: str) -> None:
+        with self._lock:
+            previous_owner = self.owners.get(slug)
+            if previous_owner is not None and previous_owner != product_name:
+                # the catalog wins over a slug remembered for another name
+                self.slugs.pop(previous_owner, None)
+            self.owners[slug] = product_name
+            self.slugs.setdefault(product_name, slug)
+
+    def get(self, product_name: str) -> str:
+        with self._lock:
+            if product_name in self.slugs:
+                return self.slugs[product_name]
+            base_slug = self.make_base_slug(product_name)
+            slug, number = base_slug, 1
+            while slug in self.owners:
+                number += 1
+                slug = f'{base_slug}-{number}'
+            self.slugs[product_name] = slug
+            self.owners[slug] = product_name
+            return slug
+
+    def save(self) -> None:
+        with self._lock:
+            dump_json(self.path, self.slugs)
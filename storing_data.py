@@ -1,4 +1,7 @@
-import pickle
+import json
+import logging
+import threading
+import time
 from collections import defaultdict
 from redis import Redis
 from telegram.ext import BasePersistence
@@ -6,8 +9,107 @@ from telegram.ext.utils.types import ConversationDict, BD, CD, UD
 from typing import DefaultDict, Dict, Optional, Tuple, Any
 from copy import deepcopy
 
+from metrics import PERSISTENCE_SECONDS
+from serializers import PickleSerializer
+
+logger = logging.getLogger(__name__)
+
+
+class LazyRedisDict(defaultdict):
+    '''user_data/chat_data mapping that reads an id from a Redis hash on first access.
+
+    At most ``maxsize`` ids are kept in memory, the least recently used one
+    is dropped first. Dropped entries are already in Redis and are read
+    again on their next access. An id is pinned from its access until
+    :meth:`release` says its changes were saved, so the dict a handler is
+    still changing is never dropped; while many ids are pinned the mapping
+    may hold more than ``maxsize``.
+    '''
+
+    def __init__(
+        self,
+        reddisdb: Redis,
+        hash_key: str,
+        maxsize: Optional[int] = None,
+        pending_lookup=None,
+        serializer=None
+    ):
+        super().__init__(dict)
+        self.reddisdb = reddisdb
+        self.hash_key = hash_key
+        self.maxsize = maxsize
+        self.pending_lookup = pending_lookup
+        self.serializer = serializer or PickleSerializer()
+        self._pinned = set()
+
+    def __missing__(self, key):
+        # an evicted entry may still wait in the write-behind queue
+        value = self.pending_lookup(self.hash_key, key) if self.pending_lookup else None
+        if value is None:
+            with PERSISTENCE_SECONDS.labels('lazy_load').time():
+                data_bytes = self.reddisdb.hget(self.hash_key, key)
+            value = self.serializer.loads(data_bytes) if data_bytes else {}
+        self[key] = value
+        return value
+
+    def __getitem__(self, key):
+        if self.maxsize is not None:
+            # pinned before loading, so loading it cannot evict the id itself
+            self._pinned.add(key)
+        value = super().__getitem__(key)
+        if self.maxsize is not None:
+            # re-insert to mark the id as the most recently used one
+            super().__delitem__(key)
+            super().__setitem__(key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._evict()
+
+    def release(self, key) -> None:
+        '''Unpins ``key`` once its changes are written or queued for writing.'''
+        self._pinned.discard(key)
+        self._evict()
+
+    def _evict(self) -> None:
+        if self.maxsize is None or len(self) <= self.maxsize:
+            return
+        unpinned = [key for key in self if key not in self._pinned]
+        for key in unpinned[:len(self) - self.maxsize]:
+            super().__delitem__(key)
+
+    def __copy__(self):
+        # defaultdict's copy would pass the default factory as ``reddisdb``
+        copied = type(self)(self.reddisdb, self.hash_key, self.maxsize, self.pending_lookup, self.serializer)
+        dict.update(copied, self)
+        return copied
+
 
 class PizzaShopPersistence(BasePersistence):
+    '''Redis persistence for the bot.
+
+    Values are encoded with ``serializer`` (pickle unless told otherwise, see
+    :mod:`serializers`); data in any supported format is read back
+    regardless of the configured one, except that the JSON serializer
+    reads pickle only when allowed to.
+
+    By default everything is stored in the single ``key`` blob. With
+    ``incremental=True`` every conversation key, user and chat is stored
+    as its own field of a Redis hash, so a state change writes only the
+    changed entry and workers sharing the Redis do not overwrite each other.
+    ``lazy=True`` additionally skips loading user and chat data at startup:
+    they are read per id on first access and at most ``max_cached`` of each
+    are kept in memory.
+
+    With ``write_behind_interval`` (milliseconds) changes are not written
+    when they happen but collected and written in one pipelined round-trip
+    every interval, or as soon as ``write_behind_max_pending`` entries are
+    waiting. Whatever is pending at that moment is lost on a crash;
+    :meth:`flush`, which the Updater calls on stop and on SIGTERM, writes it
+    out.
+    '''
+
     def __init__(
         self,
         reddisdb: Redis,
@@ -15,18 +117,45 @@ class PizzaShopPersistence(BasePersistence):
         store_user_data: bool = False,
         store_chat_data: bool = False,
         store_bot_data: bool = False,
-        store_callback_data: bool = False
+        store_callback_data: bool = False,
+        incremental: bool = False,
+        lazy: bool = False,
+        max_cached: Optional[int] = None,
+        write_behind_interval: Optional[float] = None,
+        write_behind_max_pending: int = 100,
+        serializer=None,
+        key: str = 'TelegramBotPersistence'
     ):
         super().__init__(store_user_data, store_chat_data, store_bot_data, store_callback_data)
         self.reddisdb = reddisdb
         self.on_flush = on_flush
+        self.incremental = incremental or lazy
+        self.lazy = lazy
+        self.max_cached = max_cached
+        self.key = key
+        self.serializer = serializer or PickleSerializer()
         self.conversations = None
+        self.user_data = None
+        self.chat_data = None
+        self.bot_data = None
+        self.write_behind_interval = write_behind_interval
+        self.write_behind_max_pending = write_behind_max_pending
+        self._pending = {}
+        self._in_flight = {}
+        self._blob_dirty = False
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake_up = threading.Event()
+        self._flush_stats = {'flushes': 0, 'flushed_entries': 0, 'last_flush_ms': 0.0, 'max_flush_ms': 0.0}
+        if write_behind_interval:
+            threading.Thread(target=self._write_behind_loop, daemon=True).start()
 
     def load_redis(self) -> None:
         try:
-            data_bytes = self.reddisdb.get('TelegramBotPersistence')
+            with PERSISTENCE_SECONDS.labels('load_blob').time():
+                data_bytes = self.reddisdb.get(self.key)
             if data_bytes:
-                data = pickle.loads(data_bytes)
+                data = self.serializer.loads(data_bytes)
                 self.user_data = defaultdict(dict, data['user_data'])
                 self.chat_data = defaultdict(dict, data['chat_data'])
                 # For backwards compatibility with files not containing bot data
@@ -44,18 +173,189 @@ class PizzaShopPersistence(BasePersistence):
             return
 
     def dump_redis(self) -> None:
-        data = {
-            'conversations': self.conversations,
-            'user_data': self.user_data,
-            'chat_data': self.chat_data,
-            'bot_data': self.bot_data,
+        with self._pending_lock:
+            # the write-behind thread runs this while update_* change the mappings
+            data = {
+                'conversations': {
+                    name: dict(conversation) for name, conversation in (self.conversations or {}).items()
+                },
+                'user_data': dict(self.user_data or {}),
+                'chat_data': dict(self.chat_data or {}),
+                'bot_data': self.bot_data,
+            }
+        data_bytes = self.serializer.dumps(data)
+        with PERSISTENCE_SECONDS.labels('dump_blob').time():
+            self.reddisdb.set(self.key, data_bytes)
+
+    def conversation_key(self, name: str) -> str:
+        return f'{self.key}:conversations:{name}'
+
+    def load_hash(self, hash_key: str, decode_field) -> Dict[Any, Any]:
+        with PERSISTENCE_SECONDS.labels('load_hash').time():
+            fields = self.reddisdb.hgetall(hash_key)
+        return {
+            decode_field(field): self.serializer.loads(value)
+            for field, value in fields.items()
         }
-        data_bytes = pickle.dumps(data)
-        self.reddisdb.set('TelegramBotPersistence', data_bytes)
+
+    def dump_entries(self, entries) -> None:
+        '''Writes ``(hash_key, field, value)`` entries in one pipelined round-trip.
+
+        ``None`` values are deleted, a ``None`` field stores the value as a plain key.
+        '''
+        self.write_entries(
+            (hash_key, field, self.encode_value(field, value)) for hash_key, field, value in entries
+        )
+
+    def encode_value(self, field, value) -> Optional[bytes]:
+        if field is not None and value is None:
+            return None
+        return self.serializer.dumps(value)
+
+    def write_entries(self, encoded_entries) -> None:
+        '''Writes entries whose values are already serialized, see :meth:`dump_entries`.'''
+        pipeline = self.reddisdb.pipeline(transaction=False)
+        for hash_key, field, data_bytes in encoded_entries:
+            if field is None:
+                pipeline.set(hash_key, data_bytes)
+            elif data_bytes is None:
+                pipeline.hdel(hash_key, field)
+            else:
+                pipeline.hset(hash_key, field, data_bytes)
+        with PERSISTENCE_SECONDS.labels('dump_entries').time():
+            pipeline.execute()
+
+    def dump_changes(self, entries) -> None:
+        if self.write_behind_interval:
+            # serialized here, on the dispatcher thread, handlers may change the values later
+            encoded_entries = [
+                (hash_key, field, self.encode_value(field, value)) for hash_key, field, value in entries
+            ] if self.incremental else []
+            with self._pending_lock:
+                if self.incremental:
+                    for hash_key, field, data_bytes in encoded_entries:
+                        self._pending[(hash_key, field)] = data_bytes
+                else:
+                    self._blob_dirty = True
+                queue_depth = len(self._pending)
+            if queue_depth >= self.write_behind_max_pending:
+                self._wake_up.set()
+        elif self.incremental:
+            self.dump_entries(entries)
+        else:
+            self.dump_redis()
+
+    def pending_value(self, hash_key: str, field) -> Optional[Any]:
+        with self._pending_lock:
+            key = (hash_key, field)
+            data_bytes = self._pending.get(key, self._in_flight.get(key))
+        return self.serializer.loads(data_bytes) if data_bytes else None
+
+    def flush_pending(self) -> None:
+        '''Writes everything collected by write-behind in one round-trip.'''
+        with self._flush_lock:
+            with self._pending_lock:
+                batch, self._pending = self._pending, {}
+                self._in_flight = batch
+                blob_dirty, self._blob_dirty = self._blob_dirty, False
+            if not batch and not blob_dirty:
+                return
+            started = time.perf_counter()
+            try:
+                if blob_dirty:
+                    self.dump_redis()
+                self.write_entries(
+                    (hash_key, field, data_bytes) for (hash_key, field), data_bytes in batch.items()
+                )
+            except Exception:
+                with self._pending_lock:
+                    # put the batch back without overwriting newer changes
+                    self._pending = {**batch, **self._pending}
+                    self._blob_dirty = self._blob_dirty or blob_dirty
+                raise
+            finally:
+                with self._pending_lock:
+                    self._in_flight = {}
+            flush_ms = (time.perf_counter() - started) * 1000
+            self._flush_stats['flushes'] += 1
+            self._flush_stats['flushed_entries'] += len(batch)
+            self._flush_stats['last_flush_ms'] = flush_ms
+            self._flush_stats['max_flush_ms'] = max(self._flush_stats['max_flush_ms'], flush_ms)
+
+    def get_stats(self) -> dict:
+        '''Write-behind flush latency and the number of entries waiting to be written.'''
+        with self._pending_lock:
+            return dict(self._flush_stats, queue_depth=len(self._pending) + int(self._blob_dirty))
+
+    def _write_behind_loop(self) -> None:
+        while True:
+            self._wake_up.wait(self.write_behind_interval / 1000)
+            self._wake_up.clear()
+            try:
+                self.flush_pending()
+            except Exception as exc:
+                logger.warning(f'Write-behind flush to Redis failed, will retry: {exc}')
+
+    def flush(self) -> None:
+        '''Writes pending changes, with :attr:`on_flush` the whole in-memory state.'''
+        if self.on_flush:
+            if not self.incremental:
+                self.dump_redis()
+            else:
+                entries = []
+                for name, conversation in (self.conversations or {}).items():
+                    for key, state in conversation.items():
+                        entries.append((self.conversation_key(name), json.dumps(key), state))
+                for user_id, user_data in (self.user_data or {}).items():
+                    entries.append((f'{self.key}:user_data', user_id, user_data))
+                for chat_id, chat_data in (self.chat_data or {}).items():
+                    entries.append((f'{self.key}:chat_data', chat_id, chat_data))
+                if self.bot_data is not None:
+                    entries.append((f'{self.key}:bot_data', None, self.bot_data))
+                self.dump_entries(entries)
+        self.flush_pending()
+
+    def migrate_from_blob(self) -> bool:
+        '''Copies the legacy single-key pickle into per-key hashes.
+
+        The blob is renamed to ``<key>:blob_backup`` afterwards, so the
+        migration runs only once. Returns whether anything was migrated.
+        '''
+        data_bytes = self.reddisdb.get(self.key)
+        if not data_bytes:
+            return False
+        data = self.serializer.loads(data_bytes)
+        entries = []
+        for name, conversation in data['conversations'].items():
+            for key, state in conversation.items():
+                entries.append((self.conversation_key(name), json.dumps(key), state))
+        for user_id, user_data in data['user_data'].items():
+            entries.append((f'{self.key}:user_data', user_id, user_data))
+        for chat_id, chat_data in data['chat_data'].items():
+            entries.append((f'{self.key}:chat_data', chat_id, chat_data))
+        if data.get('bot_data'):
+            entries.append((f'{self.key}:bot_data', None, data['bot_data']))
+        self.dump_entries(entries)
+        self.reddisdb.rename(self.key, f'{self.key}:blob_backup')
+        return True
+
+    def insert_bot(self, obj: object) -> object:
+        '''Returns lazy user/chat mappings as they are, so the dispatcher shares them with us.'''
+        if isinstance(obj, LazyRedisDict):
+            return obj
+        return super().insert_bot(obj)
 
     def get_conversations(self, name: str) -> ConversationDict:
         '''Returns the conversations from the pickle on Redis if it exsists or an empty dict.'''
-        if self.conversations:
+        if self.incremental:
+            if self.conversations is None:
+                self.conversations = dict()
+            if name not in self.conversations:
+                self.conversations[name] = self.load_hash(
+                    self.conversation_key(name),
+                    lambda field: tuple(json.loads(field))
+                )
+        elif self.conversations:
             pass
         else:
             self.load_redis()
@@ -65,15 +365,29 @@ class PizzaShopPersistence(BasePersistence):
         '''Will update the conversations for the given handler and depending on :attr:`on_flush` save the pickle on Redis.'''
         if not self.conversations:
             self.conversations = dict()
-        if self.conversations.setdefault(name, {}).get(key) == new_state:
-            return
-        self.conversations[name][key] = new_state
+        with self._pending_lock:
+            conversation = self.conversations.setdefault(name, {})
+            if conversation.get(key) == new_state:
+                return
+            conversation[key] = new_state
         if not self.on_flush:
-            self.dump_redis()
+            self.dump_changes([(self.conversation_key(name), json.dumps(key), new_state)])
 
     def get_user_data(self) -> DefaultDict[int, Dict[Any, Any]]:
         '''Returns the user_data from the pickle on Redis if it exists or an empty :obj:`defaultdict`.'''
-        if self.user_data:
+        if self.lazy:
+            if self.user_data is None:
+                self.user_data = LazyRedisDict(
+                    self.reddisdb,
+                    f'{self.key}:user_data',
+                    self.max_cached,
+                    self.pending_value,
+                    self.serializer
+                )
+            return self.user_data
+        if self.incremental and self.user_data is None:
+            self.user_data = defaultdict(dict, self.load_hash(f'{self.key}:user_data', int))
+        elif self.user_data:
             pass
         else:
             self.load_redis()
@@ -81,7 +395,19 @@ class PizzaShopPersistence(BasePersistence):
 
     def get_chat_data(self) -> DefaultDict[int, Dict[Any, Any]]:
         '''Returns the chat_data from the pickle on Redis if it exists or an empty :obj:`defaultdict`.'''
-        if self.chat_data:
+        if self.lazy:
+            if self.chat_data is None:
+                self.chat_data = LazyRedisDict(
+                    self.reddisdb,
+                    f'{self.key}:chat_data',
+                    self.max_cached,
+                    self.pending_value,
+                    self.serializer
+                )
+            return self.chat_data
+        if self.incremental and self.chat_data is None:
+            self.chat_data = defaultdict(dict, self.load_hash(f'{self.key}:chat_data', int))
+        elif self.chat_data:
             pass
         else:
             self.load_redis()
@@ -89,7 +415,10 @@ class PizzaShopPersistence(BasePersistence):
 
     def get_bot_data(self) -> Dict[Any, Any]:
         '''Returns the bot_data from the pickle on Redis if it exists or an empty :obj:`dict`.'''
-        if self.bot_data:
+        if self.incremental and self.bot_data is None:
+            data_bytes = self.reddisdb.get(f'{self.key}:bot_data')
+            self.bot_data = self.serializer.loads(data_bytes) if data_bytes else {}
+        elif self.bot_data:
             pass
         else:
             self.load_redis()
@@ -99,21 +428,31 @@ class PizzaShopPersistence(BasePersistence):
         '''Will update the user_data and depending on :attr:`on_flush` save the pickle on Redis.'''
         if self.user_data is None:
             self.user_data = defaultdict(dict)
-        if self.user_data.get(user_id) == data:
-            return
-        self.user_data[user_id] = data
+        # in lazy mode the dispatcher shares our mapping: nothing to compare with, and
+        # ``data`` is a copy that must not replace the dict the handlers keep using
+        if not self.lazy:
+            if self.user_data.get(user_id) == data:
+                return
+            with self._pending_lock:
+                self.user_data[user_id] = data
         if not self.on_flush:
-            self.dump_redis()
+            self.dump_changes([(f'{self.key}:user_data', user_id, data)])
+            if isinstance(self.user_data, LazyRedisDict):
+                self.user_data.release(user_id)
 
     def update_chat_data(self, chat_id: int, data: Dict) -> None:
         '''Will update the chat_data and depending on :attr:`on_flush` save the pickle on Redis.'''
         if self.chat_data is None:
             self.chat_data = defaultdict(dict)
-        if self.chat_data.get(chat_id) == data:
-            return
-        self.chat_data[chat_id] = data
+        if not self.lazy:
+            if self.chat_data.get(chat_id) == data:
+                return
+            with self._pending_lock:
+                self.chat_data[chat_id] = data
         if not self.on_flush:
-            self.dump_redis()
+            self.dump_changes([(f'{self.key}:chat_data', chat_id, data)])
+            if isinstance(self.chat_data, LazyRedisDict):
+                self.chat_data.release(chat_id)
 
     def update_bot_data(self, data: Dict) -> None:
         '''Will update the bot_data and depending on :attr:`on_flush` save the pickle on Redis.'''
@@ -121,4 +460,4 @@ class PizzaShopPersistence(BasePersistence):
             return
         self.bot_data = data.copy()
         if not self.on_flush:
-            self.dump_redis()
+            self.dump_changes([(f'{self.key}:bot_data', None, self.bot_data)])
@@ -1,113 +1,88 @@
 import logging
-import math
 import os
+import signal
 import time
 from decimal import Decimal
 from functools import partial
+from queue import Queue
 from re import sub
 
 import redis
+import requests
 from dotenv import load_dotenv
 from telegram import (Bot, InlineKeyboardButton, InlineKeyboardMarkup,
                       LabeledPrice, Update)
+from telegram.error import BadRequest
 from telegram.ext import (CallbackContext, CallbackQueryHandler,
-                          CommandHandler, ConversationHandler, Filters,
-                          MessageHandler, PreCheckoutQueryHandler, Updater)
-
-from api_handler import (add_product_to_card, fetch_coordinates,
-                         get_all_entries, get_all_products, get_card,
-                         get_card_items, get_distance, get_image, get_product,
-                         remove_cart_item)
-from get_access_token import get_access_token
+                          CommandHandler, ConversationHandler, Dispatcher,
+                          Filters, JobQueue, MessageHandler,
+                          PreCheckoutQueryHandler, TypeHandler, Updater)
+from telegram.utils.request import Request
+
+from api_client import (MOLTIN_API_URL, YANDEX_GEOCODER_URL,
+                        create_geocoder_client, create_moltin_client)
+from async_api_client import create_async_moltin_client
+from cart_store import CartStore
+from catalog_cache import CatalogCache
+from file_id_cache import FileIdCache
+from geocode_cache import GeocodeCache
+from image_cache import ImageCache
 from logging_handler import TelegramLogsHandler
+from menu_renderer import MenuRenderer
+from metrics import (UPDATE_DELIVERY_SECONDS, observe_handler, register_stats,
+                     start_metrics_server)
+from resilience import CircuitBreaker, RetryPolicy
+from restaurant_index import RestaurantIndex
+from serializers import SERIALIZERS, JsonSerializer
+from sharding import ShardConsumer, UpdateRouter, WorkerPool
+from single_flight import SingleFlight
 from storing_data import PizzaShopPersistence
+from token_manager import TokenManager
 
 logger = logging.getLogger(__name__)
+# not a child of ``logger``, whose records all go to the admin's Telegram chat
+latency_logger = logging.getLogger('pizza_bot.update_latency')
+
+TELEGRAM_API_URL = 'https://api.telegram.org'
 
 START, HANDLE_MENU, HANDLE_DESCRIPTION,\
     HANDLE_CART, WAITING_GEO, CLOSE_ORDER = range(6)
 
 
-def update_token(func):
-    def inner(elastickpath_access_token, client_id_secret, update: Update, context: CallbackContext):
-        epoch_time = elastickpath_access_token.get('expires')
-        el_path_client_id, el_path_client_secret = client_id_secret
-        if time.time() > epoch_time:
-            elastickpath_access_token = get_access_token(el_path_client_id, el_path_client_secret)
-        return func(elastickpath_access_token, client_id_secret, update, context)
-    return inner
-
-
-def get_restaurant_distance(restaurant):
-    return restaurant['distance']
-
-
-def find_nearest_restaurant(coordinates, access_token):
-    pizza_slug = 'pizzeria'
-    all_restaurants_with_distance = []
-    restaurants = get_all_entries(access_token, pizza_slug)
-    for restuarant in restaurants['data']:
-        restaurants_with_distance = {}
-        restuarant_lon = restuarant['longitude']
-        restuarant_lat = restuarant['latitude']
-        restaurants_with_distance['restuarant'] = restuarant['address']
-        restaurants_with_distance['distance'] = get_distance(coordinates, (restuarant_lon, restuarant_lat))
-        restaurants_with_distance['coordinates'] = (restuarant_lon, restuarant_lat)
-        restaurants_with_distance['user_coordinates'] = coordinates
-        all_restaurants_with_distance.append(restaurants_with_distance)
-    nearest_restaurant = min(all_restaurants_with_distance, key=get_restaurant_distance)
-    return nearest_restaurant
+def find_nearest_restaurant(coordinates, restaurant_index):
+    # haversine is within a few metres of geodesic here, far below the delivery tiers' resolution
+    return restaurant_index.nearest(coordinates, k=1, exact=False)[0]
 
 
-
-def create_menu(products, page=0):
-    keyboard = []
-    product_on_page = 5
-    max_products = math.ceil(len(products.get('data'))/product_on_page)*product_on_page
-    for count, product in enumerate(products.get('data')):
-        if page+product_on_page > count and count >= page:
-            product_name = product.get('name')
-            product_id = product.get('id')
-            button = [InlineKeyboardButton(product_name, callback_data=product_id)]
-            keyboard.append(button)
-    card_keyboard = [InlineKeyboardButton('Корзина', callback_data='productcard')]
-    if page <= 0:
-        incr_page = page + product_on_page
-        navigation_keyboard = [
-            InlineKeyboardButton('След',  callback_data=f'pagenext#{incr_page}')
-        ]
-    elif page >= max_products:
-        decr_page = page - product_on_page
-        navigation_keyboard = [
-            InlineKeyboardButton('Пред',  callback_data=f'pageback#{decr_page}')
-        ]
-    else:
-        incr_page = page + product_on_page
-        decr_page = page - product_on_page
-        navigation_keyboard = [
-            InlineKeyboardButton('След',  callback_data=f'pagenext#{incr_page}'),
-            InlineKeyboardButton('Пред',  callback_data=f'pageback#{decr_page}')
-        ]
-    keyboard.append(navigation_keyboard)
-    keyboard.append(card_keyboard)
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    return reply_markup
+def send_product_photo(bot, moltin_client, file_id_cache, image_cache, image_id, **kwargs):
+    '''Sends the product image by its cached Telegram file_id, uploading it only once.'''
+    file_id = file_id_cache.get(image_id)
+    if file_id:
+        try:
+            return bot.send_photo(photo=file_id, **kwargs)
+        except BadRequest as err:
+            logger.info(f'Cached file_id of image {image_id} is no longer valid: {err}')
+            file_id_cache.delete(image_id)
+    path = image_cache.get_path(image_id, moltin_client)
+    with open(path, 'rb') as file:
+        message = bot.send_photo(photo=file, **kwargs)
+    file_id_cache.set(image_id, message.photo[-1].file_id)
+    return message
 
 
-@update_token
-def start(elastickpath_access_token, client_id_secret, update: Update, context: CallbackContext) -> None:
-    products = get_all_products(elastickpath_access_token.get('access_token'))
+def start(menu_renderer, update: Update, context: CallbackContext) -> None:
     update.message.reply_text(
         'Пожалуйста выберите товар',
-        reply_markup=create_menu(products)
+        reply_markup=menu_renderer.render()
         )
     return HANDLE_DESCRIPTION
 
 
-@update_token
 def handle_description(
-    elastickpath_access_token,
-    client_id_secret,
+    moltin_client,
+    catalog,
+    file_id_cache,
+    image_cache,
     update: Update,
     context: CallbackContext
 ):
@@ -116,14 +91,12 @@ def handle_description(
     query = update.callback_query
     context.bot.delete_message(chat_id=chat_id, message_id=message_id)
     product_id = query.data
-    access_token = elastickpath_access_token.get('access_token')
-    product_payload = get_product(product_id, access_token)
+    product_payload = catalog.get_product(product_id)
     product_name = product_payload.get('data').get('name')
     product_price = product_payload.get('data').get('meta').get('display_price').get('with_tax').get('formatted')
     product_price_formatted = product_price.strip('RUB')
     product_text = product_payload.get('data').get('description')
     product_image_id = product_payload.get('data').get('relationships').get('main_image').get('data').get('id')
-    path = get_image(product_image_id, access_token)
     product_describtion = f'{product_name}\n{product_price_formatted} рублей\n\n{product_text}'
     keyboard = [
         [
@@ -134,37 +107,34 @@ def handle_description(
         [InlineKeyboardButton('Назад', callback_data='back')]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    with open(path, 'rb') as file:
-        context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=file,
-            caption=product_describtion,
-            reply_markup=reply_markup
-            )
+    send_product_photo(
+        context.bot,
+        moltin_client,
+        file_id_cache,
+        image_cache,
+        product_image_id,
+        chat_id=update.effective_chat.id,
+        caption=product_describtion,
+        reply_markup=reply_markup
+        )
     return HANDLE_MENU
 
 
-@update_token
 def handle_product_button(
-    elastickpath_access_token,
-    client_id_secret,
+    cart_store,
     update: Update,
     context: CallbackContext
 ):
     chat_id = update.effective_message.chat_id
     query = update.callback_query
-    access_token = elastickpath_access_token.get('access_token')
     product_id, card = query.data.split('|')
     _, quantity = card.split(':')
-    add_product_to_card(chat_id, product_id, access_token, int(quantity))
+    cart_store.add(chat_id, product_id, int(quantity))
     update.callback_query.answer(text='Товар добавлен в корзину')
     return HANDLE_MENU
 
 
-@update_token
-def handle_menu(elastickpath_access_token, client_id_secret, update: Update, context: CallbackContext) -> None:
-    access_token = elastickpath_access_token.get('access_token')
-    products = get_all_products(access_token)
+def handle_menu(menu_renderer, update: Update, context: CallbackContext) -> None:
     message_id = update.effective_message.message_id
     chat_id = update.effective_message.chat_id
     query = update.callback_query
@@ -175,29 +145,26 @@ def handle_menu(elastickpath_access_token, client_id_secret, update: Update, con
     context.bot.send_message(
         chat_id=chat_id,
         text='Пожалуйста выберите товар',
-        reply_markup=create_menu(products, int(page))
+        reply_markup=menu_renderer.render(int(page))
         )
     return HANDLE_DESCRIPTION
 
 
-@update_token
-def handle_cart(elastickpath_access_token, client_id_secret, update: Update, context: CallbackContext):
+def handle_cart(cart_store, update: Update, context: CallbackContext):
     chat_id = update.effective_message.chat_id
-    access_token = elastickpath_access_token.get('access_token')
-    cards = get_card(chat_id, access_token)
-    card_items = get_card_items(chat_id, access_token)
-    card_total_price = cards.get('data').get('meta').get('display_price').get('with_tax').get('formatted').strip('RUB')
+    card_items = cart_store.get_items(chat_id)
+    card_total_price = cart_store.get_total(chat_id, card_items)
     message_id = update.effective_message.message_id
     chat_id = update.effective_message.chat_id
     context.bot.delete_message(chat_id=chat_id, message_id=message_id)
     products_list = []
     keyboard = []
-    for item in card_items.get('data'):
-        card_item_id = item.get('id')
-        item_name = item.get('name')
-        item_quantity = item.get('quantity')
-        item_price_per_item = item.get('meta').get('display_price').get('with_tax').get('unit').get('formatted').strip('RUB')
-        item_total_price = item.get('meta').get('display_price').get('with_tax').get('value').get('formatted').strip('RUB')
+    for item in card_items:
+        card_item_id = item['product_id']
+        item_name = item['name']
+        item_quantity = item['quantity']
+        item_price_per_item = item['unit_price']
+        item_total_price = item['total_price']
         products_describtion = f'{item_name}\n{item_price_per_item}руб за шт\n{item_quantity}шт в корзине за {item_total_price}руб\n\n'
         products_list.append(products_describtion)
         button = [InlineKeyboardButton(f'Убрать из корзины {item_name}', callback_data=card_item_id)]
@@ -217,15 +184,13 @@ def handle_cart(elastickpath_access_token, client_id_secret, update: Update, con
     return HANDLE_CART
 
 
-@update_token
-def remove_card_item(elastickpath_access_token, client_id_secret, update: Update, context: CallbackContext):
+def remove_card_item(cart_store, update: Update, context: CallbackContext):
     chat_id = update.effective_message.chat_id
     query = update.callback_query
     product_id = query.data
-    access_token = elastickpath_access_token.get('access_token')
     update.callback_query.answer(text='Товар удален из корзины')
-    remove_cart_item(card_id=chat_id, product_id=product_id, access_token=access_token)
-    handle_cart(elastickpath_access_token, client_id_secret, update, context)
+    cart_store.remove(chat_id, product_id)
+    handle_cart(cart_store, update, context)
     return HANDLE_CART
 
 
@@ -241,15 +206,19 @@ def handle_pay_request(redis_db, update: Update, context: CallbackContext):
     return WAITING_GEO
 
 
-def handle_pay_request_geo(elastickpath_access_token, yandex_geo_api, update: Update, context: CallbackContext):
+def handle_pay_request_geo(
+    restaurant_index,
+    geocode_cache,
+    update: Update,
+    context: CallbackContext
+):
     chat_id = update.effective_message.chat_id
     user_geo = update.message.text
-    user_geo_verified = fetch_coordinates(yandex_geo_api, user_geo)
-    access_token = elastickpath_access_token.get('access_token')
+    user_geo_verified = geocode_cache.fetch_coordinates(user_geo)
     message = 'Извините, мы не смогли определить ваше местоположение, попробуйте ввести еще раз'
     if user_geo_verified:
         user_coordinates = user_geo_verified['GeoObject']['Point']['pos'].split(' ')
-        nearest_restaurant = find_nearest_restaurant(user_coordinates, access_token)
+        nearest_restaurant = find_nearest_restaurant(user_coordinates, restaurant_index)
         nearest_restaurant_distance = nearest_restaurant['distance']
         nearest_restaurant_address = nearest_restaurant['restuarant']
         if 0.5 >= nearest_restaurant_distance:
@@ -287,19 +256,17 @@ def handle_pay_request_geo(elastickpath_access_token, yandex_geo_api, update: Up
     return CLOSE_ORDER
 
 
-def send_notification_to_courier(elastickpath_access_token, update: Update, context: CallbackContext):
+def send_notification_to_courier(cart_store, update: Update, context: CallbackContext):
     chat_id = update.effective_message.chat_id
     user_data = context.user_data
     user_coordinates = user_data['user_coordinates']
-    access_token = elastickpath_access_token.get('access_token')
-    cards = get_card(chat_id, access_token)
-    card_items = get_card_items(chat_id, access_token)
+    card_items = cart_store.get_items(chat_id)
     products_list = []
     total_quantity = 0
-    card_total_price = cards.get('data').get('meta').get('display_price').get('with_tax').get('formatted').strip('RUB')
-    for item in card_items.get('data'):
-        item_name = item.get('name')
-        item_quantity = item.get('quantity')
+    card_total_price = cart_store.get_total(chat_id, card_items)
+    for item in card_items:
+        item_name = item['name']
+        item_quantity = item['quantity']
         total_quantity += int(item_quantity)
         products_list.append(item_name)
     all_products = ', '.join(product for product in products_list)
@@ -325,9 +292,8 @@ def notify_of_delay(context):
     )
 
 
-def handle_deliviry(elastickpath_access_token, job_queue, update: Update, context: CallbackContext):
+def handle_deliviry(cart_store, job_queue, update: Update, context: CallbackContext):
     chat_id = update.effective_message.chat_id
-    access_token = elastickpath_access_token.get('access_token')
     message = 'Наш курьер уже в пути. Далее необходимо оплатить покупку'
     keyboard = [
         [
@@ -335,7 +301,7 @@ def handle_deliviry(elastickpath_access_token, job_queue, update: Update, contex
         ]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    send_notification_to_courier(elastickpath_access_token, update, context)
+    send_notification_to_courier(cart_store, update, context)
     context.bot.send_message(
         chat_id=chat_id,
         text=message,
@@ -347,7 +313,7 @@ def handle_deliviry(elastickpath_access_token, job_queue, update: Update, contex
 
 
 def handle_selfdeliviry(
-    elastickpath_access_token,
+    cart_store,
     update: Update,
     context: CallbackContext
 ):
@@ -355,9 +321,7 @@ def handle_selfdeliviry(
     user_data = context.user_data
     nearest_restaurant_coordinates = user_data['coordinates']
     lon, lat = nearest_restaurant_coordinates
-    access_token = elastickpath_access_token.get('access_token')
-    cards = get_card(chat_id, access_token)
-    card_total_price = cards.get('data').get('meta').get('display_price').get('with_tax').get('formatted').strip('RUB')
+    card_total_price = cart_store.get_total(chat_id)
     message = f'Супер! Мы прислали вам карту до ближайшей пиццерии. Осталось оплатить покупку, к оплате {card_total_price}руб'
     keyboard = [
         [
@@ -379,15 +343,15 @@ def handle_selfdeliviry(
 
 
 def start_without_shipping_callback(
-    elastickpath_access_token,
+    cart_store,
     payment_token,
     update: Update,
     context: CallbackContext
 ) -> None:
     """Sends an invoice without shipping-payment."""
     chat_id = update.effective_message.chat_id
-    access_token = elastickpath_access_token.get('access_token')
-    cards = get_card(chat_id, access_token)
+    # the invoice is charged from the Moltin cart, so bring it in line with the local one first
+    cards = cart_store.reconcile(chat_id)
     card_total_price = cards.get('data').get('meta').get('display_price').get('with_tax').get('formatted').strip('RUB')
     title = "Оплата"
     description = "Прошу вас введите данные нажмите на кнопку с суммой оплаты и оплатите товар"
@@ -421,6 +385,21 @@ def handle_error(update: Update, context: CallbackContext):
         f'Update {update} caused error {context.error},\
         traceback {context.error.__traceback__}'
         )
+    if isinstance(context.error, requests.RequestException) and isinstance(update, Update) \
+            and update.effective_chat:
+        # Elastic Path or the geocoder is down or its breaker is open, answer instead of going silent
+        context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text='Сервис временно недоступен, попробуйте еще раз через минуту'
+            )
+
+
+def record_update_latency(update: Update, context: CallbackContext):
+    """Logs how long ago Telegram received the message this update carries."""
+    if update.message and update.message.date:
+        latency = time.time() - update.message.date.timestamp()
+        UPDATE_DELIVERY_SECONDS.observe(max(latency, 0))
+        latency_logger.debug(f'Update {update.update_id} reached the dispatcher after {latency:.3f}s')
 
 
 def end_conversation(update: Update, context: CallbackContext):
@@ -430,53 +409,149 @@ def end_conversation(update: Update, context: CallbackContext):
     return ConversationHandler.END
 
 
-def main():
-    load_dotenv()
-    token = os.getenv('TOKEN_TELEGRAM')
-    user_id = os.getenv('TG_USER_ID')
-    redis_host = os.getenv('REDIS_HOST')
-    redis_port = os.getenv('REDIS_PORT')
-    redis_pass = os.getenv('REDIS_PASS')
+def create_serializer():
+    """Builds the serializer PERSISTENCE_FORMAT asks for."""
+    persistence_format = os.getenv('PERSISTENCE_FORMAT', 'pickle')
+    if persistence_format == 'json':
+        # pickled state is only read while switching from the pickle format
+        return JsonSerializer(allow_pickle=os.getenv('PERSISTENCE_ALLOW_PICKLE') == '1')
+    return SERIALIZERS[persistence_format]()
+
+
+def create_persistence(redis_base, sharded=False):
+    """Builds the persistence PERSISTENCE_MODE asks for."""
+    persistence_mode = os.getenv('PERSISTENCE_MODE', 'incremental' if sharded else 'blob')
+    if sharded and persistence_mode == 'blob':
+        raise ValueError('PERSISTENCE_MODE=blob cannot be shared by several workers, use incremental or lazy')
+    persistence_max_cached = os.getenv('PERSISTENCE_MAX_CACHED')
+    persistence_flush_interval = os.getenv('PERSISTENCE_FLUSH_INTERVAL_MS')
+    # the blob keeps only conversations, as it always did, the per-key modes user and chat data too
+    store_data = persistence_mode in ('incremental', 'lazy')
+    return PizzaShopPersistence(
+        redis_base,
+        store_user_data=store_data,
+        store_chat_data=store_data,
+        incremental=persistence_mode == 'incremental',
+        lazy=persistence_mode == 'lazy',
+        max_cached=int(persistence_max_cached) if persistence_max_cached else None,
+        write_behind_interval=float(persistence_flush_interval) if persistence_flush_interval else None,
+        write_behind_max_pending=int(os.getenv('PERSISTENCE_FLUSH_MAX_PENDING', 100)),
+        serializer=create_serializer()
+        )
+
+
+def create_dispatcher(token, redis_base, update_queue, sharded=False):
+    """Builds the dispatcher with all handlers and the services they use."""
     el_path_client_id = os.getenv('ELASTICPATH_CLIENT_ID')
     el_path_client_secret = os.getenv('ELASTICPATH_CLIENT_SECRET')
     yandex_geo_api = os.getenv('YANDEX_GEO')
     payment_token = os.getenv('PAYMENT_PROVIDER_TOKEN')
-    elastickpath_access_token = get_access_token(el_path_client_id, el_path_client_secret)
-    client_id_secret = (el_path_client_id, el_path_client_secret)
-    redis_base = redis.Redis(
-        host=redis_host,
-        port=redis_port,
-        password=redis_pass
+    moltin_pool_size = int(os.getenv('MOLTIN_POOL_SIZE', 10))
+    moltin_timeout = float(os.getenv('MOLTIN_TIMEOUT', 10))
+    moltin_api_url = os.getenv('MOLTIN_API_URL', MOLTIN_API_URL)
+    retry_policy = RetryPolicy(retries=int(os.getenv('UPSTREAM_RETRIES', 2)))
+    breaker_failures = int(os.getenv('BREAKER_FAILURES', 5))
+    breaker_reset_timeout = float(os.getenv('BREAKER_RESET_TIMEOUT', 30))
+    moltin_breaker = CircuitBreaker('moltin', breaker_failures, breaker_reset_timeout)
+    geocoder_breaker = CircuitBreaker('geocoder', breaker_failures, breaker_reset_timeout)
+    geocoder_client = create_geocoder_client(
+        os.getenv('YANDEX_GEOCODER_URL', YANDEX_GEOCODER_URL),
+        timeout=moltin_timeout,
+        retry_policy=retry_policy,
+        breaker=geocoder_breaker
         )
-    persistence = PizzaShopPersistence(redis_base)
-    logging_token = os.getenv('TG_TOKEN_LOGGING')
-    logging_bot = Bot(token=logging_token)
-    logging.basicConfig(
-                format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-            )
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(TelegramLogsHandler(tg_bot=logging_bot, chat_id=user_id))
-    logger.info('Pizza store bot запущен')
-    """Start the bot."""
-    updater = Updater(token, persistence=persistence)
-    job_queue = updater.job_queue
-    dispatcher = updater.dispatcher
+    catalog_ttl = float(os.getenv('CATALOG_TTL', 300))
+    token_manager = TokenManager(
+        el_path_client_id,
+        el_path_client_secret,
+        redis_base,
+        refresh_margin=float(os.getenv('MOLTIN_TOKEN_REFRESH_MARGIN', 300)),
+        api_url=moltin_api_url
+        )
+    elastickpath_access_token = token_manager.start()
+    moltin_client = create_moltin_client(
+        elastickpath_access_token.get('access_token'),
+        elastickpath_access_token.get('expires'),
+        base_url=moltin_api_url,
+        pool_size=moltin_pool_size,
+        timeout=moltin_timeout,
+        retry_policy=retry_policy,
+        breaker=moltin_breaker
+        )
+    moltin_async_client = create_async_moltin_client(
+        elastickpath_access_token.get('access_token'),
+        elastickpath_access_token.get('expires'),
+        base_url=moltin_api_url,
+        limit=moltin_pool_size,
+        timeout=moltin_timeout,
+        retry_policy=retry_policy,
+        breaker=moltin_breaker
+        )
+    token_manager.add_client(moltin_client)
+    token_manager.add_client(moltin_async_client)
+    persistence = create_persistence(redis_base, sharded)
+    if persistence.incremental and not sharded:
+        persistence.migrate_from_blob()
+    # with shards every worker would otherwise read the same catalog on its own
+    single_flight_mode = os.getenv('SINGLE_FLIGHT', 'redis' if sharded else 'local')
+    single_flight = SingleFlight(redis_base if single_flight_mode == 'redis' else None)
+    catalog = CatalogCache(moltin_client, ttl=catalog_ttl, single_flight=single_flight)
+    catalog.warm()
+    catalog.listen(redis_base)
+    menu_renderer = MenuRenderer(catalog, page_size=int(os.getenv('MENU_PAGE_SIZE', 5)))
+    file_id_cache = FileIdCache(redis_base)
+    image_max_side = os.getenv('IMAGE_MAX_SIDE')
+    image_cache = ImageCache(
+        os.getenv('IMAGE_CACHE_DIR', './image_cache'),
+        max_bytes=int(os.getenv('IMAGE_CACHE_MAX_MB', 200)) * 1024 * 1024,
+        max_age=float(os.getenv('IMAGE_CACHE_MAX_AGE', 3600)),
+        max_side=int(image_max_side) if image_max_side else None,
+        single_flight=single_flight
+        )
+    restaurant_index = RestaurantIndex(
+        moltin_client,
+        ttl=float(os.getenv('RESTAURANTS_TTL', 600)),
+        single_flight=single_flight
+        )
+    restaurant_index.load()
+    geocode_cache = GeocodeCache(redis_base, geocoder_client, yandex_geo_api)
+    cart_store = CartStore(redis_base, catalog, moltin_client, moltin_async_client)
+    workers = int(os.getenv('DISPATCHER_WORKERS', 4))
+    bot = create_bot(token, request=Request(con_pool_size=workers + 4))
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(
+        bot,
+        update_queue,
+        workers=workers,
+        job_queue=job_queue,
+        persistence=persistence
+    )
     job_queue.set_dispatcher(dispatcher=dispatcher)
-    partial_start = partial(start, elastickpath_access_token, client_id_secret)
-    partial_handle_menu = partial(handle_menu, elastickpath_access_token, client_id_secret)
-    partial_handle_describtion = partial(handle_description, elastickpath_access_token, client_id_secret)
-    partial_handle_cart = partial(handle_cart, elastickpath_access_token, client_id_secret)
-    partial_handle_product_button = partial(handle_product_button, elastickpath_access_token, client_id_secret)
-    partial_remove_card_item = partial(remove_card_item, elastickpath_access_token, client_id_secret)
-    partial_handle_pay_request = partial(handle_pay_request, redis_base)
-    partial_handle_pay_request_geo = partial(handle_pay_request_geo, elastickpath_access_token, yandex_geo_api)
-    partial_handle_selfdeliviry = partial(handle_selfdeliviry, elastickpath_access_token)
-    partial_handle_deliviry = partial(handle_deliviry, elastickpath_access_token, job_queue)
-    partial_start_without_shipping_callback = partial(
+    partial_start = observe_handler(partial(start, menu_renderer))
+    partial_handle_menu = observe_handler(partial(handle_menu, menu_renderer))
+    partial_handle_describtion = observe_handler(partial(
+        handle_description,
+        moltin_client,
+        catalog,
+        file_id_cache,
+        image_cache
+        ))
+    partial_handle_cart = observe_handler(partial(handle_cart, cart_store))
+    partial_handle_product_button = observe_handler(partial(handle_product_button, cart_store))
+    partial_remove_card_item = observe_handler(partial(remove_card_item, cart_store))
+    partial_handle_pay_request = observe_handler(partial(handle_pay_request, redis_base))
+    partial_handle_pay_request_geo = observe_handler(partial(
+        handle_pay_request_geo,
+        restaurant_index,
+        geocode_cache
+        ))
+    partial_handle_selfdeliviry = observe_handler(partial(handle_selfdeliviry, cart_store))
+    partial_handle_deliviry = observe_handler(partial(handle_deliviry, cart_store, job_queue))
+    partial_start_without_shipping_callback = observe_handler(partial(
         start_without_shipping_callback,
-        elastickpath_access_token,
+        cart_store,
         payment_token
-        )
+        ))
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", partial_start)],
         states={
@@ -517,18 +592,121 @@ def main():
                     ),
             ]
         },
-        fallbacks=[CommandHandler("end", end_conversation)],
+        fallbacks=[CommandHandler("end", observe_handler(end_conversation))],
         name="pizza_conversation",
         persistent=True
     )
+    dispatcher.add_handler(TypeHandler(Update, record_update_latency), group=-1)
     dispatcher.add_handler(conv_handler)
     dispatcher.add_error_handler(handle_error)
-    dispatcher.add_handler(PreCheckoutQueryHandler(precheckout_callback))
+    dispatcher.add_handler(PreCheckoutQueryHandler(observe_handler(precheckout_callback)))
     dispatcher.add_handler(
-        MessageHandler(Filters.successful_payment, successful_payment_callback)
+        MessageHandler(Filters.successful_payment, observe_handler(successful_payment_callback))
     )
-    updater.start_polling()
+    register_stats('catalog_cache', catalog.get_stats)
+    register_stats('geocode_cache', geocode_cache.get_stats)
+    register_stats('file_id_cache', file_id_cache.get_stats)
+    register_stats('image_cache', image_cache.get_stats)
+    register_stats('persistence', persistence.get_stats)
+    register_stats('moltin_breaker', moltin_breaker.get_stats)
+    register_stats('geocoder_breaker', geocoder_breaker.get_stats)
+    register_stats('single_flight', single_flight.get_stats)
+    return dispatcher
+
+
+def create_redis():
+    return redis.Redis(
+        host=os.getenv('REDIS_HOST'),
+        port=os.getenv('REDIS_PORT'),
+        password=os.getenv('REDIS_PASS'),
+        db=int(os.getenv('REDIS_DB', 0))
+        )
+
+
+def create_bot(token, **kwargs):
+    return Bot(token=token, base_url=f"{os.getenv('TELEGRAM_API_URL', TELEGRAM_API_URL)}/bot", **kwargs)
+
+
+def setup_logging():
+    logging_bot = create_bot(os.getenv('TG_TOKEN_LOGGING'))
+    logging.basicConfig(
+                format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+            )
+    logger.setLevel(logging.DEBUG)
+    logs_handler = TelegramLogsHandler(tg_bot=logging_bot, chat_id=os.getenv('TG_USER_ID'))
+    logger.addHandler(logs_handler)
+    register_stats('logs_handler', logs_handler.get_stats)
+
+
+def run_worker(shard, shards):
+    """Handles the updates of one shard until SIGTERM, see BOT_SHARDS."""
+    load_dotenv()
+    setup_logging()
+    metrics_port = os.getenv('METRICS_PORT')
+    if metrics_port:
+        # the receiving process has METRICS_PORT, worker n the port after it plus n
+        start_metrics_server(int(metrics_port) + 1 + shard, os.getenv('METRICS_LISTEN', '127.0.0.1'))
+    redis_base = create_redis()
+    dispatcher = create_dispatcher(os.getenv('TOKEN_TELEGRAM'), redis_base, Queue(), sharded=True)
+    consumer = ShardConsumer(redis_base, dispatcher, shard)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: consumer.stop())
+    dispatcher.job_queue.start()
+    logger.info(f'Worker of shard {shard}/{shards} запущен')
+    try:
+        consumer.run()
+    finally:
+        dispatcher.job_queue.stop()
+        dispatcher.persistence.flush()
+
+
+def main():
+    load_dotenv()
+    token = os.getenv('TOKEN_TELEGRAM')
+    shards = int(os.getenv('BOT_SHARDS', 1))
+    update_queue_size = int(os.getenv('UPDATE_QUEUE_SIZE', 1000))
+    bot_mode = os.getenv('BOT_MODE', 'polling')
+    webhook_url = os.getenv('WEBHOOK_URL')
+    if bot_mode == 'webhook' and not webhook_url:
+        raise ValueError('BOT_MODE=webhook needs WEBHOOK_URL, the public address Telegram sends updates to')
+    redis_base = create_redis()
+    setup_logging()
+    metrics_port = os.getenv('METRICS_PORT')
+    if metrics_port:
+        start_metrics_server(int(metrics_port), os.getenv('METRICS_LISTEN', '127.0.0.1'))
+    logger.info('Pizza store bot запущен')
+    """Start the bot."""
+    worker_pool = None
+    # a full queue makes the webhook stop reading, so Telegram holds and retries the updates
+    update_queue = Queue(maxsize=update_queue_size)
+    if shards > 1:
+        # this process only receives updates, the shard workers own the conversations
+        PizzaShopPersistence(
+            redis_base,
+            incremental=True,
+            serializer=create_serializer()
+            ).migrate_from_blob()
+        router = UpdateRouter(redis_base, shards, max_pending=update_queue_size)
+        dispatcher = Dispatcher(create_bot(token), update_queue)
+        dispatcher.add_handler(TypeHandler(Update, router.route_update))
+        worker_pool = WorkerPool(run_worker, shards)
+        worker_pool.start()
+    else:
+        dispatcher = create_dispatcher(token, redis_base, update_queue)
+    updater = Updater(dispatcher=dispatcher)
+    if bot_mode == 'webhook':
+        webhook_path = os.getenv('WEBHOOK_SECRET_PATH', token)
+        updater.start_webhook(
+            listen=os.getenv('WEBHOOK_LISTEN', '127.0.0.1'),
+            port=int(os.getenv('WEBHOOK_PORT', 8443)),
+            url_path=webhook_path,
+            webhook_url=f'{webhook_url}/{webhook_path}'
+        )
+    else:
+        updater.start_polling()
     updater.idle()
+    if worker_pool is not None:
+        worker_pool.stop()
 
 
 if __name__ == '__main__':
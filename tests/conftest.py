@@ -0,0 +1,14 @@
+import time
+
+import pytest
+
+from api_client import create_moltin_client
+from benchmarks.standins import MoltinStandIn, StandInServer, load_seed_data
+
+
+@pytest.fixture
+def moltin_client():
+    '''A client of the Moltin stand-in seeded with data/menu.json and data/addresses.json.'''
+    server = StandInServer(MoltinStandIn(*load_seed_data())).start()
+    yield create_moltin_client('token', time.time() + 3600, base_url=server.url)
+    server.stop()
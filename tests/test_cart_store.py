@@ -0,0 +1,32 @@
+import fakeredis
+import requests
+
+import cart_store
+from cart_store import CartStore
+
+
+class FakeCatalog:
+    def __init__(self, products):
+        self.products = products
+
+    def get_product(self, product_id):
+        if product_id not in self.products:
+            response = requests.Response()
+            response.status_code = 404
+            raise requests.HTTPError('404 Client Error', response=response)
+        price = {'with_tax': {'amount': self.products[product_id]}}
+        return {'data': {'name': product_id, 'meta': {'display_price': price}}}
+
+
+def test_deleted_product_is_dropped_from_cart(monkeypatch):
+    monkeypatch.setattr(cart_store, 'add_product_to_card', lambda *args: {'data': []})
+    monkeypatch.setattr(cart_store, 'get_card_items', lambda *args: {'data': []})
+    store = CartStore(fakeredis.FakeRedis(), FakeCatalog({'margherita': 400}), None, None)
+    store.add(1, 'margherita', 2)
+    store.add(1, 'discontinued', 1)
+
+    items = store.get_items(1)
+
+    assert [item['product_id'] for item in items] == ['margherita']
+    assert store.get_total(1, items) == 800
+    assert store.get_quantities(1) == {'margherita': 2}
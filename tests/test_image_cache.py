@@ -0,0 +1,30 @@
+import os
+import time
+
+import image_cache
+from image_cache import ImageCache
+
+
+def create_file(path, size, age):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(b'x' * size)
+    modified = time.time() - age
+    os.utime(path, (modified, modified))
+
+
+def test_eviction_spares_files_being_written(tmp_path):
+    cache = ImageCache(str(tmp_path), max_bytes=150)
+    objects = tmp_path / 'objects' / 'ab'
+    oldest, newest = str(objects / 'ab01.jpg'), str(objects / 'ab02.jpg')
+    writing = str(objects / 'ab03.jpg.tmp')
+    abandoned = str(objects / 'ab04.jpg.tmp')
+    create_file(oldest, 100, age=30)
+    create_file(newest, 100, age=0)
+    create_file(writing, 1000, age=0)
+    create_file(abandoned, 1000, age=image_cache.TEMPORARY_FILE_GRACE + 1)
+
+    cache._evict(keep=newest)
+
+    assert sorted(os.listdir(objects)) == ['ab02.jpg', 'ab03.jpg.tmp']
+    assert cache.get_stats()['evictions'] == 1
@@ -0,0 +1,42 @@
+import pytest
+import requests
+
+from load_data_to_cms import RateLimiter
+
+
+class FlakyCall:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.calls = 0
+        self.__name__ = 'create_product'
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls == 1:
+            response = requests.Response()
+            response.status_code = self.status_code
+            raise requests.HTTPError(response=response)
+        return {'data': {'id': 'margherita'}}
+
+
+def test_create_is_not_repeated_after_503():
+    create = FlakyCall(503)
+
+    with pytest.raises(requests.HTTPError):
+        RateLimiter(backoff=0.001).create(create)
+
+    assert create.calls == 1
+
+
+def test_create_is_repeated_after_429():
+    create = FlakyCall(429)
+
+    assert RateLimiter(backoff=0.001).create(create) == {'data': {'id': 'margherita'}}
+    assert create.calls == 2
+
+
+def test_read_is_repeated_after_503():
+    read = FlakyCall(503)
+
+    assert RateLimiter(backoff=0.001).call(read) == {'data': {'id': 'margherita'}}
+    assert read.calls == 2
@@ -0,0 +1,32 @@
+from telegram.error import BadRequest, NetworkError
+
+from logging_handler import TelegramLogsHandler
+
+
+class FailingBot:
+    def __init__(self, error):
+        self.error = error
+        self.calls = 0
+
+    def send_message(self, chat_id, text):
+        self.calls += 1
+        raise self.error
+
+
+def test_bad_request_is_not_retried():
+    bot = FailingBot(BadRequest('Message is too long'))
+    handler = TelegramLogsHandler(bot, chat_id=1, min_send_interval=0, backoff=0.001)
+
+    handler._send('log record')
+
+    assert bot.calls == 1
+    assert handler.failed_messages == 1
+
+
+def test_network_error_is_retried():
+    bot = FailingBot(NetworkError('Connection reset'))
+    handler = TelegramLogsHandler(bot, chat_id=1, min_send_interval=0, max_retries=2, backoff=0.001)
+
+    handler._send('log record')
+
+    assert bot.calls == 3
@@ -0,0 +1,38 @@
+import time
+
+import catalog_cache
+from benchmarks.standins import load_seed_data
+from catalog_cache import CatalogCache
+from menu_renderer import MenuRenderer
+
+
+def get_button_texts(keyboard):
+    return [button.text for row in keyboard.inline_keyboard for button in row]
+
+
+def test_menu_picks_up_products_after_catalog_ttl(monkeypatch):
+    products = [{'id': 'margherita', 'name': 'Маргарита'}]
+    monkeypatch.setattr(catalog_cache, 'get_all_pages', lambda url, client: list(products))
+    catalog = CatalogCache(moltin_client=None, ttl=0.05)
+    catalog.warm()
+    renderer = MenuRenderer(catalog)
+    assert 'Маргарита' in get_button_texts(renderer.render())
+
+    products.append({'id': 'pepperoni', 'name': 'Пепперони'})
+    time.sleep(0.1)
+    deadline = time.monotonic() + 2
+    while 'Пепперони' not in get_button_texts(renderer.render()) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert 'Пепперони' in get_button_texts(renderer.render())
+    assert catalog.version == 2
+
+
+def test_menu_lists_every_page_of_products(moltin_client):
+    menu, _ = load_seed_data()
+    catalog = CatalogCache(moltin_client)
+    renderer = MenuRenderer(catalog, page_size=len(menu))
+
+    assert len(menu) > 25
+    assert len(catalog.get_all_products()['data']) == len(menu)
+    assert len(get_button_texts(renderer.render())) >= len(menu)
@@ -0,0 +1,66 @@
+import asyncio
+
+import aiohttp
+import pytest
+import requests
+
+from api_client import ApiClient
+from async_api_client import AsyncApiClient
+from resilience import CircuitBreaker, CircuitOpenError
+
+
+def open_breaker():
+    breaker = CircuitBreaker('moltin', failure_threshold=1, reset_timeout=0)
+    breaker.before_call()
+    breaker.record_failure()
+    return breaker
+
+
+def test_trial_call_raising_unexpected_error_does_not_jam_breaker(monkeypatch):
+    breaker = open_breaker()
+    client = ApiClient('http://moltin.test', breaker=breaker)
+
+    def broken_request(method, url, **kwargs):
+        raise requests.exceptions.ChunkedEncodingError('connection broken')
+    monkeypatch.setattr(client.session, 'request', broken_request)
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        client.get('/v2/products')
+
+    assert breaker.state == CircuitBreaker.OPEN
+    # after reset_timeout the next call is the new trial instead of being rejected
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        client.get('/v2/products')
+    assert breaker.get_stats()['rejected'] == 0
+
+
+class FailingSession:
+    def __init__(self, error):
+        self.error = error
+
+    def request(self, method, url, **kwargs):
+        raise self.error
+
+
+@pytest.mark.parametrize('error', [
+    aiohttp.ClientPayloadError('truncated body'),
+    asyncio.CancelledError(),
+])
+def test_async_trial_call_always_releases_breaker(error):
+    breaker = open_breaker()
+    client = AsyncApiClient('http://moltin.test', breaker=breaker)
+    client.session = FailingSession(error)
+
+    with pytest.raises(type(error)):
+        asyncio.run(client.request('GET', '/v2/products'))
+
+    breaker.before_call()
+    assert breaker.get_stats()['rejected'] == 0
+
+
+def test_open_breaker_rejects_without_calling():
+    breaker = CircuitBreaker('moltin', failure_threshold=1, reset_timeout=60)
+    breaker.before_call()
+    breaker.record_failure()
+
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
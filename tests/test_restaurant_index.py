@@ -0,0 +1,12 @@
+from benchmarks.standins import load_seed_data
+from restaurant_index import RestaurantIndex
+
+
+def test_load_reads_every_page_of_pizzerias(moltin_client):
+    _, addresses = load_seed_data()
+    index = RestaurantIndex(moltin_client)
+
+    index.load()
+
+    assert len(addresses) > 25
+    assert len(index.restaurants) == len(addresses)
@@ -0,0 +1,22 @@
+import pickle
+
+import pytest
+
+from serializers import JsonSerializer, PickleSerializer
+
+
+def test_json_serializer_refuses_pickle():
+    with pytest.raises(ValueError, match='PERSISTENCE_ALLOW_PICKLE'):
+        JsonSerializer().loads(pickle.dumps({'cart': ['pizza']}))
+
+
+def test_json_serializer_reads_pickle_when_allowed():
+    data_bytes = PickleSerializer().dumps({'cart': ('pizza',)})
+
+    assert JsonSerializer(allow_pickle=True).loads(data_bytes) == {'cart': ('pizza',)}
+
+
+def test_pickle_serializer_reads_json():
+    data_bytes = JsonSerializer(compress_threshold=0).dumps({42: {'cart': ('pizza',)}})
+
+    assert PickleSerializer().loads(data_bytes) == {42: {'cart': ('pizza',)}}
@@ -0,0 +1,79 @@
+from queue import Queue
+
+import fakeredis
+from telegram import Bot
+from telegram.ext import Dispatcher
+
+from storing_data import LazyRedisDict, PizzaShopPersistence
+
+
+def create_persistence(reddisdb, **kwargs):
+    kwargs.setdefault('max_cached', 2)
+    return PizzaShopPersistence(
+        reddisdb,
+        store_user_data=True,
+        store_chat_data=True,
+        lazy=True,
+        **kwargs
+    )
+
+
+def test_lazy_user_data_survives_insert_bot():
+    persistence = create_persistence(fakeredis.FakeRedis())
+
+    user_data = persistence.get_user_data()
+
+    assert isinstance(user_data, LazyRedisDict)
+    assert user_data[42] == {}
+
+
+def test_dispatcher_reads_and_writes_lazy_user_data():
+    reddisdb = fakeredis.FakeRedis()
+    persistence = create_persistence(reddisdb)
+    dispatcher = Dispatcher(Bot('123:abc'), Queue(), persistence=persistence)
+
+    dispatcher.user_data[42]['cart'] = ['pizza']
+    dispatcher.update_persistence()
+
+    assert dispatcher.user_data is persistence.user_data
+    reloaded = create_persistence(reddisdb).get_user_data()
+    assert reloaded[42] == {'cart': ['pizza']}
+
+
+def test_lazy_mapping_copy_keeps_redis():
+    reddisdb = fakeredis.FakeRedis()
+    create_persistence(reddisdb).dump_entries([('TelegramBotPersistence:user_data', 7, {'name': 'Ann'})])
+    user_data = LazyRedisDict(reddisdb, 'TelegramBotPersistence:user_data', maxsize=2)
+
+    copied = user_data.__copy__()
+
+    assert copied.reddisdb is reddisdb
+    assert copied[7] == {'name': 'Ann'}
+
+
+def test_write_behind_writes_values_as_they_were_queued():
+    reddisdb = fakeredis.FakeRedis()
+    persistence = PizzaShopPersistence(reddisdb, incremental=True, write_behind_interval=60000)
+    data = {'cart': ['pizza']}
+
+    persistence.update_user_data(42, data)
+    data['cart'].append('cola')
+    persistence.flush_pending()
+
+    reloaded = PizzaShopPersistence(reddisdb, incremental=True).get_user_data()
+    assert reloaded[42] == {'cart': ['pizza']}
+
+
+def test_lru_does_not_drop_user_data_a_handler_is_changing():
+    reddisdb = fakeredis.FakeRedis()
+    persistence = create_persistence(reddisdb, max_cached=1)
+    dispatcher = Dispatcher(Bot('123:abc'), Queue(), persistence=persistence)
+
+    user_data = dispatcher.user_data[1]
+    dispatcher.user_data[2]
+    user_data['cart'] = ['pizza']
+    dispatcher.update_persistence()
+
+    assert len(dispatcher.user_data) == 1
+    reloaded = create_persistence(reddisdb).get_user_data()
+    assert reloaded[1] == {'cart': ['pizza']}
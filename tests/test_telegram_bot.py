@@ -0,0 +1,86 @@
+import logging
+from queue import Queue
+
+import fakeredis
+import pytest
+from telegram import Bot, Update
+from telegram.ext import ConversationHandler, Dispatcher, Filters, MessageHandler
+
+import telegram_bot
+from telegram_bot import CLOSE_ORDER, create_persistence, record_update_latency
+
+
+def test_lazy_mode_persists_user_data(monkeypatch):
+    monkeypatch.setenv('PERSISTENCE_MODE', 'lazy')
+    reddisdb = fakeredis.FakeRedis()
+    dispatcher = Dispatcher(Bot('123:abc'), Queue(), persistence=create_persistence(reddisdb))
+
+    dispatcher.user_data[42]['coordinates'] = (55.75, 37.61)
+    dispatcher.update_persistence()
+
+    restarted = Dispatcher(Bot('123:abc'), Queue(), persistence=create_persistence(reddisdb))
+    assert restarted.user_data[42] == {'coordinates': (55.75, 37.61)}
+
+
+def create_text_update(bot, text):
+    return Update.de_json({
+        'update_id': 1,
+        'message': {
+            'message_id': 1,
+            'date': 0,
+            'chat': {'id': 42, 'type': 'private'},
+            'from': {'id': 42, 'is_bot': False, 'first_name': 'Ann'},
+            'text': text
+        }
+    }, bot)
+
+
+def remember_coordinates(update, context):
+    context.user_data['coordinates'] = (55.75, 37.61)
+    return CLOSE_ORDER
+
+
+def create_worker(reddisdb):
+    dispatcher = Dispatcher(Bot('123:abc'), Queue(), persistence=create_persistence(reddisdb, sharded=True))
+    dispatcher.add_handler(ConversationHandler(
+        entry_points=[MessageHandler(Filters.text, remember_coordinates)],
+        states={CLOSE_ORDER: []},
+        fallbacks=[],
+        name='pizza_conversation',
+        persistent=True
+    ))
+    return dispatcher
+
+
+def test_restarted_worker_takes_over_conversation_and_user_data(monkeypatch):
+    monkeypatch.delenv('PERSISTENCE_MODE', raising=False)
+    reddisdb = fakeredis.FakeRedis()
+    crashed_worker = create_worker(reddisdb)
+    crashed_worker.process_update(create_text_update(crashed_worker.bot, 'Москва, Тверская 1'))
+
+    restarted_worker = create_worker(reddisdb)
+
+    assert restarted_worker.handlers[0][0].conversations[(42, 42)] == CLOSE_ORDER
+    assert restarted_worker.user_data[42] == {'coordinates': (55.75, 37.61)}
+
+
+def test_update_latency_is_not_sent_to_the_admin_chat(monkeypatch):
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    monkeypatch.setattr(telegram_bot.logger, 'level', logging.DEBUG)
+    telegram_bot.logger.addHandler(handler)
+    try:
+        record_update_latency(create_text_update(Bot('123:abc'), 'Привет'), None)
+    finally:
+        telegram_bot.logger.removeHandler(handler)
+
+    assert records == []
+
+
+def test_webhook_mode_needs_webhook_url(monkeypatch):
+    monkeypatch.setenv('BOT_MODE', 'webhook')
+    monkeypatch.delenv('WEBHOOK_URL', raising=False)
+
+    with pytest.raises(ValueError, match='WEBHOOK_URL'):
+        telegram_bot.main()
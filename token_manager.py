@@ -0,0 +1,121 @@
+import json
+import logging
+import threading
+import time
+
+from redis import Redis
+
+from api_client import MOLTIN_API_URL
+from get_access_token import get_access_token
+
+logger = logging.getLogger(__name__)
+
+
+class TokenManager:
+    '''Keeps a valid Elastic Path access token and renews it ahead of expiry.
+
+    A background timer renews the token ``refresh_margin`` seconds before
+    it expires, so handlers never wait for OAuth. Renewal is single-flight:
+    one lock in the process and, with ``reddisdb``, a Redis lock shared by
+    all workers, which also read the current token from Redis instead of
+    requesting their own. Listeners added with :meth:`add_listener` get
+    every new token, e.g. to update an ApiClient's header.
+    '''
+
+    def __init__(
+        self,
+        client_id: str,
+        client_secret: str,
+        reddisdb: Redis = None,
+        refresh_margin: float = 300,
+        retry_interval: float = 30,
+        key: str = 'MoltinAccessToken',
+        api_url: str = MOLTIN_API_URL
+    ):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.reddisdb = reddisdb
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.key = key
+        self.api_url = api_url
+        self.token = None
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def add_listener(self, listener) -> None:
+        self._listeners.append(listener)
+        if self.token is not None:
+            listener(self.token)
+
+    def add_client(self, client) -> None:
+        '''Keeps the Authorization header of an ApiClient or AsyncApiClient current.'''
+        self.add_listener(lambda token: client.set_access_token(token['access_token'], token['expires']))
+
+    def start(self) -> dict:
+        return self.get_token()
+
+    def stop(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+
+    def get_token(self) -> dict:
+        if self.is_fresh(self.token):
+            return self.token
+        return self.refresh()
+
+    def get_access_token(self) -> str:
+        return self.get_token()['access_token']
+
+    def is_fresh(self, token) -> bool:
+        return token is not None and token['expires'] - self.refresh_margin > time.time()
+
+    def refresh(self) -> dict:
+        with self._lock:
+            # whoever waited on the lock gets the token the first caller fetched
+            if self.is_fresh(self.token):
+                return self.token
+            token = self._read_shared()
+            if not self.is_fresh(token):
+                token = self._fetch()
+            self._set_token(token)
+            return token
+
+    def _fetch(self) -> dict:
+        if self.reddisdb is None:
+            return get_access_token(self.client_id, self.client_secret, self.api_url)
+        with self.reddisdb.lock(f'{self.key}:lock', timeout=30, blocking_timeout=30):
+            token = self._read_shared()
+            if self.is_fresh(token):
+                return token
+            token = get_access_token(self.client_id, self.client_secret, self.api_url)
+            expires_in = max(1, int(token['expires'] - time.time()))
+            self.reddisdb.set(self.key, json.dumps(token), ex=expires_in)
+            return token
+
+    def _read_shared(self):
+        if self.reddisdb is None:
+            return None
+        token = self.reddisdb.get(self.key)
+        return json.loads(token) if token else None
+
+    def _set_token(self, token: dict) -> None:
+        self.token = token
+        for listener in self._listeners:
+            listener(token)
+        self._schedule(token['expires'] - self.refresh_margin - time.time())
+
+    def _schedule(self, delay: float) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(max(1, delay), self._refresh_in_background)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh_in_background(self) -> None:
+        try:
+            self.refresh()
+        except Exception as err:
+            logger.warning(f'Access token renewal failed, retrying in {self.retry_interval}s: {err}')
+            self._schedule(self.retry_interval)